@@ -1,47 +1,177 @@
 import serial
-from serial.tools import list_ports
 import time
 import os
 import random
+import logging
+import threading
+import importlib
 from auth import FirebaseAuthenticator
 from realtimedb import RealtimeDB
+from pipeline import IngestPipeline
+from spool import SensorSpool
+from http_pool import HTTPPool
+from token_manager import TokenManager
+from filters import DeadbandFilter
+from frame_parser import parse_frame, FrameParser, BinaryFrameParser, negotiate_binary
+from reading import Reading, get_clock
+from devices import MultiDeviceReader
+from port_discovery import PortDiscovery
+from metrics import MetricsServer, get_registry
+from profiler import SamplingProfiler
+from dashboard import Dashboard
+from valve_control import ValveController
+from upload_control import CIRCUIT_STATES, UploadController
+from retention import RetentionManager
+from archive import FrameArchive
 from env_maker import load_secrets_from_toml
-import inquirer
-import rich
-from rich.console import Console
-from rich.table import Table
-from rich.panel import Panel
-from rich.console import Console
-from rich.console import Console
-from rich.panel import Panel
-from rich.text import Text
-from rich.live import Live
-from rich.table import Table
+
+# Rich, inquirer and NumPy are imported where they are needed, so the service
+# mode and setups without rollups never pay for them at startup.
+
+logger = logging.getLogger("agribot")
 
 
 class AgribotAdmin:
 
     def __init__(
-        self, email, random_mode, forced_port, forced_baud_rate, forced_secrets_file
+        self,
+        email,
+        random_mode,
+        forced_port,
+        forced_baud_rate,
+        forced_secrets_file,
+        batch_size=10,
+        max_linger=5.0,
+        queue_size=1000,
+        backpressure="drop_oldest",
+        upload_workers=1,
+        spool_path="agribot_spool.db",
+        replay_rate=50.0,
+        http_pool_size=10,
+        http_timeout=30.0,
+        token_cache=os.path.join("~", ".agribot", "token.json"),
+        use_filter=True,
+        deadbands=None,
+        relative_deadbands=None,
+        heartbeat=60.0,
+        rollup_windows=None,
+        rollup_rate_hz=10.0,
+        device_ports=None,
+        frame_format="ascii",
+        metrics_port=None,
+        metrics_host="127.0.0.1",
+        profile_dir=None,
+        dashboard_fps=4,
+        headless=None,
+        headless_interval=10.0,
+        interactive=True,
+        valve_control=True,
+        valve_state_path=os.path.join("~", ".agribot", "valve_command.json"),
+        retention_days=None,
+        retention_rollup=None,
+        rollup_retention_days=None,
+        adaptive_upload=True,
+        wire_schema=None,
+        compress_uploads=False,
+        archive_dir=None,
+        archive_max_mb=None,
     ):
-        self.console = Console()
+        # The Firebase client takes the longest to import; load it while
+        # the secrets, the cached session and the serial ports are read.
+        threading.Thread(
+            target=importlib.import_module, args=("firebase",), daemon=True
+        ).start()
+        self.interactive = interactive
+        self.console = None
+        if interactive:
+            from rich.console import Console
+
+            self.console = Console()
+        self.metrics = get_registry()
+        self.metrics_server = (
+            MetricsServer(self.metrics, metrics_host, metrics_port)
+            if metrics_port
+            else None
+        )
+        self.profiler = None
+        if profile_dir:
+            # kill -USR1 <pid> writes a profile of the next 30 seconds
+            self.profiler = SamplingProfiler(output_dir=profile_dir)
+            self.profiler.install()
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.wire_schema = wire_schema
+        # Starts from batch_size and max_linger and adapts to the link
+        self.controller = (
+            UploadController(batch_size, max_linger) if adaptive_upload else None
+        )
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.upload_workers = upload_workers
+        self.spool_path = spool_path
+        self.archive_dir = archive_dir
+        self.archive_max_mb = archive_max_mb
+        self.archive = None
+        self.replay_rate = replay_rate
+        self.token_cache = token_cache
+        self.device_ports = device_ports
+        self.frame_format = frame_format
+        self.dashboard_fps = dashboard_fps
+        # Without a terminal there is nobody to watch a live display
+        if headless is None:
+            headless = self.console is None or not self.console.is_terminal
+        self.headless = headless
+        self.headless_interval = headless_interval
+        self.devices = None
+        self.device_reconnects = 0
+        self.valve_control = valve_control
+        self.valve_state_path = valve_state_path
+        self.valve = None
+        self.valve_stream = None
+        self.retention_days = retention_days
+        self.retention_rollup = retention_rollup
+        self.rollup_retention_days = rollup_retention_days
+        self.retention = None
+        self.aggregator = None
+        if rollup_windows:
+            from aggregation import WindowAggregator
+
+            self.aggregator = WindowAggregator(rollup_windows, rollup_rate_hz)
+        self.filter = (
+            DeadbandFilter(deadbands, relative_deadbands, heartbeat)
+            if use_filter
+            else None
+        )
+        self.pool = HTTPPool(
+            pool_maxsize=max(http_pool_size, upload_workers + 2),
+            timeout=(5.0, http_timeout),
+            compress_min=512 if compress_uploads else None,
+        )
 
         self.load_secrets(forced_secrets_file)
         self.authenticate_user(email)
         self.setup_serial_connection(random_mode, forced_port, forced_baud_rate)
         self.random_mode = random_mode
-        self.console.print(
-            Panel(
-                "Welcome to the Agribot Admin Panel!",
-                title="Agribot Admin",
-                style="bold green",
+        if self.interactive:
+            from rich.panel import Panel
+
+            self.console.print(
+                Panel(
+                    "Welcome to the Agribot Admin Panel!",
+                    title="Agribot Admin",
+                    style="bold green",
+                )
             )
-        )
-        self.table = Table(show_header=True, header_style="bold green")
-        self.table.add_column("Parameter", style="dim", width=12)
-        self.table.add_column("Value", justify="right")
-        self.table.add_row("No data", "No data")
-        self.live = Live(self.table, refresh_per_second=4)
+
+    def say(self, message, style="bold green"):
+
+        # Rich output for people, log records for the service manager
+        if self.interactive:
+            self.console.print(message, style=style, markup=False)
+        elif style == "bold red":
+            logger.error(message)
+        else:
+            logger.info(message)
 
     def load_secrets(self, forced_secrets_file):
 
@@ -52,126 +182,469 @@ class AgribotAdmin:
 
     def authenticate_user(self, email):
 
-        password = inquirer.prompt(
-            [
-                inquirer.Password(
-                    "password",
-                    message="Enter your password",
-                    validate=lambda _, response: len(response) >= 6,
-                    echo=f"{random.choice(['*', '🌱', '🌿', '🍃', '🔑'])}",
+        auth = FirebaseAuthenticator(pool=self.pool)
+        self.tokens = TokenManager(auth, cache_path=self.token_cache)
+        password = os.environ.get("AGRIBOT_AUTH_PASSWORD")
+        if self.tokens.load(email):
+            self.user_info = self.tokens.user_info
+            self.say("Signed in with the cached session.")
+        else:
+            if password is None and not self.interactive:
+                self.say(
+                    "No cached session and no [agribot_auth] password in the secrets file.",
+                    "bold red",
                 )
-            ]
-        )["password"]
-        auth = FirebaseAuthenticator()
-        try:
-            self.user_info = auth.sign_in_with_email_and_password(email, password)
-        except Exception as e:
-            self.console.print_exception(show_locals=True)
-            self.console.print("[bold red]Authentication failed. Exiting.")
-            exit(1)
-        self.db = RealtimeDB(self.user_info)
+                exit(1)
+            if password is None:
+                import inquirer
+
+                password = inquirer.prompt(
+                    [
+                        inquirer.Password(
+                            "password",
+                            message="Enter your password",
+                            validate=lambda _, response: len(response) >= 6,
+                            echo=f"{random.choice(['*', '🌱', '🌿', '🍃', '🔑'])}",
+                        )
+                    ]
+                )["password"]
+            try:
+                self.user_info = self.tokens.sign_in(email, password)
+                self.say("Signed in.")
+            except Exception as e:
+                if self.interactive:
+                    self.console.print_exception(show_locals=True)
+                else:
+                    logger.exception("Sign-in failed.")
+                self.say("Authentication failed. Exiting.", "bold red")
+                exit(1)
+        self.db = RealtimeDB(
+            self.user_info,
+            batch_size=self.batch_size,
+            max_linger=self.max_linger,
+            pool=self.pool,
+            wire_schema=self.wire_schema,
+        )
+        # Swap fresh ID tokens into the database client before the old one expires
+        self.tokens.subscribe(lambda id_token: setattr(self.db, "id_token", id_token))
+        self.tokens.start()
 
     def setup_serial_connection(self, random_mode, forced_port, forced_baud_rate):
 
-        if not random_mode:
+        if self.device_ports and not random_mode:
+            baud_rate = forced_baud_rate if forced_baud_rate else 9600
+            if self.device_ports == "auto":
+                self.device_ports = PortDiscovery(baud_rate).find_ports()
+                if not self.device_ports:
+                    raise Exception("Arduino not found.")
+            self.devices = MultiDeviceReader(self.device_ports, baud_rate)
+            self.say(
+                f"Serial connections established with {', '.join(self.devices.ports)} at {baud_rate} baud."
+            )
+            if self.frame_format == "binary":
+                binary = self.devices.use_binary()
+                self.say(
+                    f"Binary frames enabled on {len(binary)} of {len(self.devices.ports)} boards."
+                )
+        elif not random_mode:
             if not forced_port:
-                serial_port = self.find_arduino_port()
+                serial_port = self.find_arduino_port(forced_baud_rate or 9600)
             else:
                 serial_port = forced_port
             if not forced_baud_rate:
                 baud_rate = 9600
             else:
                 baud_rate = forced_baud_rate
-            self.ser = serial.Serial(serial_port, baud_rate, timeout=1)
-            self.console.print(
-                f"[bold green]Serial connection established with {serial_port} at {baud_rate} baud."
+            self.serial_port = serial_port
+            self.baud_rate = baud_rate
+            self.open_serial_port()
+            self.say(
+                f"Serial connection established with {serial_port} at {baud_rate} baud."
             )
+        elif self.interactive:
+            from rich.panel import Panel
 
-            time.sleep(2)
-        else:
             self.console.print(
                 Panel(
                     "[bold green]Random mode enabled. No serial connection needed.",
                     style="green",
                 )
             )
+        else:
+            self.say("Random mode enabled. No serial connection needed.")
+
+    def open_serial_port(self):
+
+        # The board resets when the port is opened. There is no need to wait
+        # for it: the parser skips the boot noise and the binary request is
+        # repeated until the sketch is up.
+        self.ser = serial.Serial(self.serial_port, self.baud_rate, timeout=1)
+        pending = None
+        if self.frame_format == "binary":
+            pending = negotiate_binary(self.ser)
+        if pending is not None:
+            self.parser = BinaryFrameParser(pending)
+            self.say("Binary frames enabled.")
+        else:
+            self.parser = FrameParser()
+
+    def reconnect_serial(self):
+
+        self.ser.close()
+        delay = 0.5
+        while True:
+            try:
+                self.open_serial_port()
+                break
+            except (serial.SerialException, OSError):
+                time.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        if self.valve is not None:
+            self.valve.restore()  # The reset put the valve back in auto
 
     @staticmethod
     def generate_random_data():
 
-        return {
-            "humidity": round(random.uniform(0, 100), 2),
-            "temperature": round(random.uniform(0, 40), 2),
-            "moisture": random.randint(0, 100),
-            "water_level": random.randint(0, 100),
-            "timestamp": {".sv": "timestamp"},
-        }, {"valve_status": "on" if random.randint(0, 1) == 1 else "off"}
+        return Reading(
+            round(random.uniform(0, 100), 2),
+            round(random.uniform(0, 40), 2),
+            random.randint(0, 100),
+            random.randint(0, 100),
+            "on" if random.randint(0, 1) == 1 else "off",
+            get_clock().now(),
+        )
 
-    def find_arduino_port(self):
+    def find_arduino_port(self, baud_rate=9600):
 
-        if os.name == "nt":  # Windows
-            ports = [f"COM{i}" for i in range(256)]
-        else:  # Unix-like - ignore code is unreachable warning if you're on Windows
-            
+        return PortDiscovery(baud_rate).find_port()
 
-            ports = [f"/dev/ttyUSB{i}" for i in range(10)]
-            ports += [
-                f"/dev/ttyACM{i}" for i in range(10)
-            ]  # for some Linux distributions
+    def read_from_arduino(self, ser):
 
-        for port in ports:
-            try:
-                ser = serial.Serial(port, 9600)
-                ser.close()
-                return port
-            except (serial.SerialException, OSError):
-                pass
-        raise Exception("Arduino not found.")
+        with self.metrics.timer("agribot_serial_read_seconds"):
+            reading = parse_frame(ser.readline().decode("utf-8", "ignore"))
+        self.metrics.inc(
+            "agribot_frames_total" if reading else "agribot_frames_malformed_total"
+        )
+        return reading
 
-    def read_from_arduino(self, ser):
+    def read_frame(self):
 
-        data = ser.readline().decode("utf-8", "ignore").strip()
-        if data.startswith("<") and data.endswith(">"):
-            data = data[1:-1]  # Remove the angle brackets
-            parts = data.split(",")
-            if len(parts) == 5:
-                return {
-                    "humidity": float(parts[0]),
-                    "temperature": float(parts[1]),
-                    "moisture": float(parts[2]),
-                    "water_level": float(parts[3]),
-                    "timestamp": {".sv": "timestamp"},
-                }, {"valve_status": "on" if parts[4] == "1" else "off"}
-        return None, None
+        if self.random_mode:
+            time.sleep(0.1)  # Match the 100 ms frame interval of sensors.ino
+            return self.generate_random_data()
+        return self.read_from_arduino(self.ser)
 
-    def run(self):
-        with self.live as live:  # Enter the Live context
-            while True:
-                if self.random_mode:
-                    data, valve_s = self.generate_random_data()
-                else:
-                    data, valve_s = self.read_from_arduino(self.ser)
+    def read_serial_frames(self):
 
-                if data is not None:
-                    # Create a new table for each iteration
-                    self.table = Table(show_header=True, header_style="bold magenta")
-                    self.table.add_column("Parameter")
-                    self.table.add_column("Value")
+        try:
+            with self.metrics.timer("agribot_serial_read_seconds"):
+                frames = self.parser.read(self.ser)
+        except (serial.SerialException, OSError):
+            self.metrics.inc("agribot_serial_reconnects_total")
+            self.reconnect_serial()  # The board was unplugged or reset
+            return []
+        while self.parser.acks:
+            ack = self.parser.acks.popleft()
+            if self.valve is not None:
+                self.valve.acknowledge(None, ack)
+        self.metrics.inc("agribot_frames_total", len(frames))
+        return [(None, reading) for reading in frames]
+
+    def read_device_frames(self):
+
+        with self.metrics.timer("agribot_serial_read_seconds"):
+            frames = self.devices.read_frames()  # Reconnects lost boards itself
+        lost = self.devices.reconnects - self.device_reconnects
+        if lost:
+            self.metrics.inc("agribot_serial_reconnects_total", lost)
+            self.device_reconnects += lost
+        for device, ack in self.devices.take_acks():
+            if self.valve is not None:
+                self.valve.acknowledge(device, ack)
+        self.metrics.inc("agribot_frames_total", len(frames))
+        return frames
+
+    def write_serial(self, device, payload):
+
+        # Called from the valve stream thread; pyserial allows a write while
+        # the reader thread is blocked in a read
+        if self.devices is not None:
+            self.devices.write(device, payload)
+        else:
+            self.ser.write(payload)
 
-                    # Update the table
-                    self.table.add_row("Humidity", f"{data['humidity']}%")
-                    self.table.add_row("Temperature", f"{data['temperature']}°C")
-                    self.table.add_row("Moisture", f"{data['moisture']}%")
-                    self.table.add_row("Water Level", f"{data['water_level']}%")
-                    self.table.add_row("Valve Status", valve_s["valve_status"])
+    def start_valve_control(self):
 
-                    live.update(self.table)  # Update the Live output with the new table
-                    self.db.push_sensor_data_for_user(data)
-                    self.db.update_valve_status_for_user(valve_s["valve_status"])
-                    time.sleep(1)
+        # Commands only make sense with a board to send them to
+        if not self.valve_control or self.random_mode:
+            return
+        self.valve = ValveController(
+            self.db,
+            self.write_serial,
+            devices=list(self.devices.ports) if self.devices is not None else None,
+            state_path=self.valve_state_path,
+        )
+        self.valve.start()
+        # Opening the ports reset the boards, which forgot any forced mode
+        if self.devices is not None:
+            self.devices.on_reconnect = self.valve.restore
+            for device in list(self.devices.ports):
+                self.valve.restore(device)
+        else:
+            self.valve.restore()
+        self.valve_stream = self.db.listen_for_valve_commands(self.valve.handle)
+        self.metrics.callback(
+            "agribot_valve_stream_connected",
+            lambda: self.valve_stream.connected,
+        )
+        self.metrics.callback(
+            "agribot_valve_stream_connects_total",
+            lambda: self.valve_stream.stats["connects"],
+            kind="counter",
+        )
+
+    def register_metrics(self):
+
+        metrics = self.metrics
+        metrics.describe(
+            "agribot_serial_read_seconds",
+            "Serial read and parse time, including the wait for data.",
+        )
+        metrics.callback(
+            "agribot_pipeline_readings_total",
+            lambda: dict(self.pipeline.stats),
+            kind="counter",
+            label="event",
+        )
+        metrics.callback("agribot_queue_depth", self.pipeline.queue_depth)
+        metrics.describe(
+            "agribot_queue_age_seconds",
+            "How long the oldest queued reading has waited.",
+        )
+        metrics.callback("agribot_queue_age_seconds", self.pipeline.queue_age)
+        if self.spool is not None:
+            metrics.callback("agribot_spool_backlog", self.spool.count)
+            metrics.callback("agribot_spool_rejected", self.spool.rejected_count)
+        if self.archive is not None:
+            metrics.callback("agribot_archive_bytes", self.archive.size)
+        if self.controller is not None:
+            controller = self.controller
+            metrics.callback("agribot_upload_batch_size", lambda: controller.batch_size)
+            metrics.callback("agribot_upload_linger_seconds", lambda: controller.linger)
+            metrics.callback(
+                "agribot_upload_circuit",
+                lambda: {
+                    state: int(controller.state == state) for state in CIRCUIT_STATES
+                },
+                label="state",
+            )
+        metrics.callback(
+            "agribot_http_requests_total",
+            lambda: {
+                kind: count
+                for kind, count in self.pool.stats().items()
+                if kind in ("requests", "handshakes", "reused")
+            },
+            kind="counter",
+            label="kind",
+        )
+        metrics.describe(
+            "agribot_http_request_bytes_total",
+            "Request body bytes as serialized and as sent after compression.",
+        )
+        metrics.callback(
+            "agribot_http_request_bytes_total",
+            lambda: {
+                "body": self.pool.stats()["body_bytes"],
+                "sent": self.pool.stats()["sent_bytes"],
+            },
+            kind="counter",
+            label="stage",
+        )
+        if self.devices is not None:
+            metrics.callback("agribot_frames_malformed", lambda: self.devices.malformed)
+        elif not self.random_mode:
+            metrics.callback("agribot_frames_malformed", lambda: self.parser.malformed)
+
+    def stats_panel(self):
+
+        from rich.panel import Panel
+        from rich.table import Table
+
+        metrics = self.metrics
+        stats = self.pipeline.stats
+        upload = metrics.histogram("agribot_firebase_request_seconds", op="push_batch")
+        serial_read = metrics.histogram("agribot_serial_read_seconds")
+
+        def ms(histogram, q):
+            value = histogram.quantile(q)
+            return "-" if value is None else f"{value * 1000:.0f} ms"
+
+        table = Table.grid(padding=(0, 2))
+        table.add_column(style="dim")
+        table.add_column(justify="right")
+        table.add_column(style="dim")
+        table.add_column(justify="right")
+        table.add_row(
+            "Received",
+            str(stats["received"]),
+            "Uploaded",
+            str(stats["uploaded"] + stats["replayed"]),
+        )
+        table.add_row(
+            "Filtered",
+            str(stats["filtered"]),
+            "Failed",
+            str(stats["failed"]),
+        )
+        table.add_row(
+            "Dropped",
+            str(stats["dropped"] + stats["coalesced"]),
+            "Spooled",
+            str(self.spool.count()) if self.spool is not None else "-",
+        )
+        table.add_row(
+            "Queue",
+            str(self.pipeline.queue_depth()),
+            "Behind",
+            f"{self.pipeline.queue_age():.1f} s",
+        )
+        table.add_row(
+            "Upload p50",
+            ms(upload, 0.5),
+            "Upload p95",
+            ms(upload, 0.95),
+        )
+        table.add_row(
+            "Read p95",
+            ms(serial_read, 0.95),
+            "HTTP reused",
+            str(self.pool.stats()["reused"]),
+        )
+        if self.controller is not None:
+            table.add_row(
+                "Batch",
+                f"{self.controller.batch_size} / {self.controller.linger:.1f} s",
+                "Uploads",
+                self.controller.state.replace("_", " "),
+            )
+        if self.valve is not None:
+            actuation = metrics.histogram(
+                "agribot_valve_command_seconds", stage="actuation"
+            )
+            table.add_row(
+                "Valve p95",
+                ms(actuation, 0.95),
+                "Commands",
+                "streaming" if self.valve_stream.connected else "reconnecting",
+            )
+        return Panel(table, title="Stats", border_style="dim")
+
+    def run(self):
+        self.spool = SensorSpool(self.spool_path) if self.spool_path else None
+        if self.archive_dir:
+            # Every parsed frame, before filtering, for analysis after the fact
+            self.archive = FrameArchive(
+                os.path.expanduser(self.archive_dir),
+                max_bytes=(
+                    int(self.archive_max_mb * 1024 * 1024)
+                    if self.archive_max_mb
+                    else None
+                ),
+            )
+        if self.devices is not None:
+            read_frames = self.read_device_frames
+        elif not self.random_mode:
+            read_frames = self.read_serial_frames
+        else:
+            read_frames = None
+        self.pipeline = IngestPipeline(
+            self.read_frame,
+            self.db,
+            maxsize=self.queue_size,
+            policy=self.backpressure,
+            workers=self.upload_workers,
+            spool=self.spool,
+            replay_rate=self.replay_rate,
+            filter=self.filter,
+            aggregator=self.aggregator,
+            read_frames=read_frames,
+            controller=self.controller,
+            archive=self.archive,
+            refresh_token=self.tokens.refresh,
+        )
+        self.register_metrics()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+            self.say(
+                f"Metrics at http://{self.metrics_server.host}:{self.metrics_server.port}/metrics"
+            )
+        self.dashboard = Dashboard(self.pipeline, self.stats_panel)
+        self.pipeline.start()
+        self.start_valve_control()
+        if self.retention_days:
+            # Prunes in the background, throttled so uploads keep the link
+            self.retention = RetentionManager(
+                self.db,
+                max_age=self.retention_days * 86400,
+                rollup=self.retention_rollup,
+                rollup_max_age=(
+                    self.rollup_retention_days * 86400
+                    if self.rollup_retention_days
+                    else None
+                ),
+            )
+            self.retention.start()
+        try:
+            if self.headless:
+                while True:
+                    time.sleep(self.headless_interval)
+                    if self.interactive:
+                        print(self.dashboard.summary(), flush=True)
+                    else:
+                        logger.info(self.dashboard.summary())
+            else:
+                from rich.live import Live
+
+                # Live redraws the dashboard on its own thread at a fixed rate,
+                # however fast readings arrive
+                with Live(
+                    self.dashboard,
+                    console=self.console,
+                    refresh_per_second=self.dashboard_fps,
+                ):
+                    while True:
+                        time.sleep(1)
+        finally:
+            if self.retention is not None:
+                self.retention.stop()
+            if self.valve_stream is not None:
+                self.valve_stream.stop()
+                self.valve.stop()
+            self.pipeline.stop()  # Upload whatever is still queued
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            self.tokens.stop()
+            if self.devices is not None:
+                self.devices.close()
+            if self.spool is not None:
+                self.spool.close()
+            if self.archive is not None:
+                self.archive.close()
+            stats = self.pool.stats()
+            self.say(
+                f"HTTP: {stats['requests']} requests, "
+                f"{stats['handshakes']} handshakes, {stats['reused']} reused connections."
+            )
 
 
 if __name__ == "__main__":
+    import inquirer
+    from rich.console import Console
+    from rich.panel import Panel
+    from rich.text import Text
+    from serial.tools import list_ports
+
     console = Console()
     random_mode = inquirer.prompt(
         [
@@ -0,0 +1,159 @@
+import math
+import time
+import numpy as np
+from filters import SENSOR_CHANNELS
+
+
+def window_name(seconds: int) -> str:
+    """
+    Returns the short name of a window, used in the rollup node name.
+
+    Args:
+        seconds (int): The window length in seconds.
+
+    Returns:
+        str: e.g. "10s", "1m", "15m" or "1h".
+    """
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}m"
+    return f"{seconds}s"
+
+
+class WindowAggregator:
+    """
+    Class to roll full-rate readings up into fixed time windows.
+
+    Samples are written into one preallocated NumPy ring buffer sized for the
+    longest window at rate_hz, so memory stays constant however long the
+    process runs. If readings arrive faster than that, the buffer is doubled
+    before a sample of the longest window would be overwritten.
+    When a reading crosses a window boundary, the min, max, mean, stddev, last
+    value and sample count of every channel over the closed window are returned.
+    Windows are aligned to wall clock time.
+
+    Attributes:
+        windows: The window lengths in seconds, shortest first.
+        channels: The channels that are aggregated.
+        capacity: The number of samples the ring buffer holds.
+
+    Methods:
+        add: Adds a reading and returns the rollups of the windows it closed.
+        rollup: Computes the rollup of the samples in a time range.
+        flush: Returns the rollups of the windows that are still open.
+    """
+
+    def __init__(
+        self,
+        windows: tuple = (10, 60, 900),
+        rate_hz: float = 10.0,
+        headroom: float = 2.0,
+        channels: tuple = SENSOR_CHANNELS,
+    ) -> None:
+        self.windows = tuple(sorted(windows))
+        self.channels = tuple(channels)
+        self.capacity = int(math.ceil(self.windows[-1] * rate_hz * headroom))
+        self._values = np.empty((self.capacity, len(self.channels)), dtype=np.float64)
+        # Unused slots hold NaN, which never falls inside a time range
+        self._times = np.full(self.capacity, np.nan, dtype=np.float64)
+        self._index = 0
+        self._window_start = {window: None for window in self.windows}
+
+    def add(self, data, timestamp: float = None) -> list:
+        """
+        Adds a reading and returns the rollups of the windows it closed.
+
+        Args:
+            data (Reading | dict): The sensor data.
+            timestamp (float): The capture time in seconds since the epoch, defaults to now.
+
+        Returns:
+            list: (window_name, rollup) tuples, shortest window first.
+        """
+        now = time.time() if timestamp is None else timestamp
+        rollups = []
+        for window in self.windows:
+            start = self._window_start[window]
+            if start is not None and now >= start + window:
+                rollup = self.rollup(start, start + window)
+                if rollup is not None:
+                    rollups.append((window_name(window), rollup))
+                start = None
+            if start is None:
+                self._window_start[window] = now - now % window
+        if self._times[self._index % self.capacity] >= now - self.windows[-1]:
+            self._grow()
+        slot = self._index % self.capacity
+        for column, channel in enumerate(self.channels):
+            self._values[slot, column] = data[channel]
+        self._times[slot] = now
+        self._index += 1
+        return rollups
+
+    def rollup(self, start: float, end: float) -> dict:
+        """
+        Computes the rollup of the samples in a time range.
+
+        Args:
+            start (float): The start of the range in seconds since the epoch, inclusive.
+            end (float): The end of the range in seconds since the epoch, exclusive.
+
+        Returns:
+            dict: The start and end in milliseconds, the number of samples with a
+                finite channel and per-channel count, min, max, mean, stddev and
+                last of the finite values, or None if there are no such samples.
+        """
+        mask = (self._times >= start) & (self._times < end)
+        values = self._values[mask]
+        finite = np.isfinite(values)
+        count = int(np.count_nonzero(finite.any(axis=1)))
+        if count == 0:
+            return None
+        order = np.argsort(self._times[mask], kind="stable")
+        result = {"start": int(start * 1000), "end": int(end * 1000), "count": count}
+        for column, channel in enumerate(self.channels):
+            # Failed sensor reads are NaN; a channel without any valid sample
+            # is left out, since JSON has no NaN
+            samples = values[order, column]
+            samples = samples[finite[order, column]]
+            if len(samples) == 0:
+                continue
+            result[channel] = {
+                "count": len(samples),
+                "min": float(samples.min()),
+                "max": float(samples.max()),
+                "mean": float(samples.mean()),
+                "stddev": float(samples.std()),
+                "last": float(samples[-1]),
+            }
+        return result
+
+    def flush(self) -> list:
+        """
+        Returns the rollups of the windows that are still open, e.g. on shutdown.
+
+        Returns:
+            list: (window_name, rollup) tuples, shortest window first.
+        """
+        rollups = []
+        for window in self.windows:
+            start = self._window_start[window]
+            if start is None:
+                continue
+            rollup = self.rollup(start, start + window)
+            if rollup is not None:
+                rollups.append((window_name(window), rollup))
+            self._window_start[window] = None
+        return rollups
+
+    def _grow(self) -> None:
+        # Unrolls the ring into a buffer twice as large, oldest sample first
+        order = np.roll(np.arange(self.capacity), -(self._index % self.capacity))
+        values = np.empty((self.capacity * 2, len(self.channels)), dtype=np.float64)
+        times = np.full(self.capacity * 2, np.nan, dtype=np.float64)
+        values[: self.capacity] = self._values[order]
+        times[: self.capacity] = self._times[order]
+        self._values, self._times = values, times
+        self._index = self.capacity
+        self.capacity *= 2
@@ -0,0 +1,607 @@
+import datetime
+import logging
+import math
+import os
+import re
+import struct
+import threading
+from metrics import get_registry
+
+logger = logging.getLogger("agribot")
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_archive_files_deleted_total",
+    "Day files deleted to keep the frame archive under its size limit.",
+)
+
+ARCHIVE_MAGIC = b"AGRIBOX1"
+# Every field sits at an offset that is a multiple of its size, so columns
+# of a memory-mapped file are aligned: captured, humidity, temperature,
+# moisture, water_level, valve (1 for on), 7 bytes reserved.
+RECORD_FORMAT = "<dffffB7x"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_FIELDS = (
+    "captured",
+    "humidity",
+    "temperature",
+    "moisture",
+    "water_level",
+    "valve",
+)
+# Magic, record size, index stride, reserved
+HEADER_FORMAT = "<8sII16x"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Capture time and number of the first record of every stride
+INDEX_FORMAT = "<dQ"
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+SECONDS_PER_DAY = 86400
+
+_pack_record = struct.Struct(RECORD_FORMAT).pack
+_pack_index = struct.Struct(INDEX_FORMAT).pack
+_DAY_FILE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})\.bin$")
+
+
+class FrameArchive:
+    """
+    Class to keep every parsed frame in an append-only local archive.
+
+    Frames are packed into fixed 32-byte records, one file per UTC day and
+    device, and written in blocks of `buffer_size` bytes or every
+    `flush_interval` seconds of capture time, so appending costs a
+    struct.pack and a bytearray extend. Every `index_every`-th record also
+    goes to a sparse index next to the day file, mapping capture times to
+    record numbers. Capture times only move forward within a file; one that
+    steps back at a clock recalibration is stored as the previous one.
+
+    A file left with a partial record by a crash is truncated to whole
+    records when it is opened again. When a write fails, e.g. because the
+    disk is full, the file is cut back to whole records and the records
+    held in memory are dropped and counted as lost, so memory stays bounded
+    and the file stays readable. With `max_bytes` set, the oldest day
+    files are deleted whenever a new one is started, until the archive fits.
+
+    Attributes:
+        directory: The archive directory; other devices go to devices/<id>/ under it.
+        max_bytes: The size the archive is kept under, None for no limit.
+        index_every: The number of records between index entries.
+        flush_interval: Seconds of capture time records are kept in memory at most.
+        buffer_size: Bytes of records kept in memory at most.
+        stats: Counters for archived records, flushes, rotations, deleted files and
+            records lost to failed writes.
+
+    Methods:
+        append: Adds a reading to the archive.
+        flush: Writes the records kept in memory.
+        size: Returns the bytes the archive takes on disk.
+        enforce_limit: Deletes the oldest day files until the archive fits max_bytes.
+        close: Flushes and closes the open day files.
+    """
+
+    def __init__(
+        self,
+        directory: str = "agribot_archive",
+        max_bytes: int = None,
+        index_every: int = 1024,
+        flush_interval: float = 1.0,
+        buffer_size: int = 65536,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_every = index_every
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.stats = {
+            "records": 0,
+            "flushes": 0,
+            "rotations": 0,
+            "deleted": 0,
+            "lost": 0,
+        }
+        self._writers = {}  # device -> _DayWriter
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, reading, device: str = None) -> None:
+        """
+        Adds a reading to the archive.
+
+        Args:
+            reading (Reading): The parsed frame.
+            device (str): The device the frame was read from, None for a single board.
+
+        Returns:
+            None
+        """
+        captured = reading.captured
+        with self._lock:
+            writer = self._writers.get(device)
+            if writer is None or captured >= writer.end:
+                writer = self._rotate(device, captured)
+            if captured < writer.last:
+                captured = writer.last  # Keeps the file sorted for the reader
+            writer.last = captured
+            if writer.count % writer.stride == 0:
+                writer.index += _pack_index(captured, writer.count)
+            writer.buffer += _pack_record(
+                captured,
+                reading.humidity,
+                reading.temperature,
+                reading.moisture,
+                reading.water_level,
+                reading.valve_status == "on",
+            )
+            writer.count += 1
+            self.stats["records"] += 1
+            if len(writer.buffer) >= self.buffer_size or captured >= writer.flush_at:
+                self._flush(writer)
+
+    def flush(self) -> None:
+        """
+        Writes the records kept in memory to the day files.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for writer in self._writers.values():
+                self._flush(writer)
+
+    def size(self) -> int:
+        """
+        Returns the bytes the archive takes on disk, including what is not flushed yet.
+
+        Returns:
+            int: The size in bytes.
+        """
+        total = sum(size for _, _, size in _day_files(self.directory))
+        with self._lock:
+            for writer in self._writers.values():
+                total += len(writer.buffer) + len(writer.index)
+        return total
+
+    def enforce_limit(self) -> int:
+        """
+        Deletes the oldest day files until the archive fits max_bytes.
+
+        The files being written to are never deleted.
+
+        Returns:
+            int: The number of day files deleted.
+        """
+        with self._lock:
+            return self._enforce_limit()
+
+    def close(self) -> None:
+        """
+        Flushes and closes the open day files.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for writer in self._writers.values():
+                self._flush(writer)
+                writer.file.close()
+                writer.index_file.close()
+            self._writers.clear()
+
+    def _rotate(self, device: str, captured: float):
+        # Must be called with self._lock held
+        writer = self._writers.pop(device, None)
+        if writer is not None:
+            self._flush(writer)
+            writer.file.close()
+            writer.index_file.close()
+            self.stats["rotations"] += 1
+        day = int(captured // SECONDS_PER_DAY)
+        path = day_path(self.directory, day, device)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writer = self._writers[device] = _DayWriter(path, day, self.index_every)
+        writer.flush_at = captured + self.flush_interval
+        if self.max_bytes is not None:
+            self._enforce_limit()
+        return writer
+
+    def _flush(self, writer) -> None:
+        # Must be called with self._lock held. Records are written before
+        # the index entries pointing at them. A write that fails, e.g. on a
+        # full disk, is cut back to the last whole record or entry: lost
+        # records are dropped and counted, index entries are retried.
+        if writer.buffer:
+            try:
+                _write_all(writer.file, writer.buffer)
+            except OSError as e:
+                _truncate(writer.file, writer.size)
+                lost = len(writer.buffer) // RECORD_SIZE
+                writer.count -= lost
+                writer.index = _index_below(writer.index, writer.count)
+                self.stats["lost"] += lost
+                if not writer.failing:
+                    logger.warning("Could not write to %s: %s", writer.path, e)
+                writer.failing = True
+            else:
+                writer.size += len(writer.buffer)
+                self.stats["flushes"] += 1
+                if writer.failing:
+                    logger.info("Writing to %s again.", writer.path)
+                writer.failing = False
+            writer.buffer = bytearray()
+        if writer.index:
+            try:
+                _write_all(writer.index_file, writer.index)
+            except OSError:
+                _truncate(writer.index_file, writer.index_size)
+            else:
+                writer.index_size += len(writer.index)
+                writer.index = bytearray()
+        writer.flush_at = writer.last + self.flush_interval
+
+    def _enforce_limit(self) -> int:
+        # Must be called with self._lock held
+        if self.max_bytes is None:
+            return 0
+        files = sorted(_day_files(self.directory))
+        total = sum(size for _, _, size in files)
+        open_paths = {writer.path for writer in self._writers.values()}
+        deleted = 0
+        for _, path, size in files:
+            if total <= self.max_bytes:
+                break
+            if path in open_paths:
+                continue
+            for stale in (path, _index_path(path)):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            deleted += 1
+        if deleted:
+            self.stats["deleted"] += deleted
+            _metrics.inc("agribot_archive_files_deleted_total", deleted)
+            logger.info(
+                "Deleted %s archive day files to stay under the limit.", deleted
+            )
+        return deleted
+
+
+class ArchiveReader:
+    """
+    Class to read time ranges of the frame archive through memory maps.
+
+    Day files are mapped read-only and a range is located with the sparse
+    index, so only the pages holding the range, and a few around its ends,
+    are read from disk. Ranges come back as NumPy record arrays that are
+    views of the maps, without copying. Files that are still being written
+    to are mapped again when they grew. It can read an archive another
+    process is writing; records still held in that process's memory are
+    not seen until it flushes them.
+
+    Attributes:
+        directory: The archive directory.
+
+    Methods:
+        days: Returns the days the archive holds a file for.
+        read: Returns the records in a time range, one array per day file.
+        arrays: Returns the records in a time range as one array per column.
+    """
+
+    def __init__(self, directory: str = "agribot_archive") -> None:
+        self.directory = directory
+        self._maps = {}  # path -> (size, records, index times, index numbers)
+
+    def days(self, device: str = None) -> list:
+        """
+        Returns the days the archive holds a file for.
+
+        Args:
+            device (str): The device, None for a single board.
+
+        Returns:
+            list: The days, in days since the epoch, oldest first.
+        """
+        directory = os.path.dirname(day_path(self.directory, 0, device))
+        days = []
+        for name in _list(directory):
+            match = _DAY_FILE.match(name)
+            if match:
+                days.append(_day_number(*match.groups()))
+        return sorted(days)
+
+    def read(self, start: float = None, end: float = None, device: str = None) -> list:
+        """
+        Returns the records captured in a time range, one array per day file.
+
+        The arrays are views of the memory-mapped files with the fields of
+        RECORD_FIELDS, e.g. records["temperature"]. They stay valid while
+        the reader is referenced and must not be kept past the deletion of
+        their file by the size limit.
+
+        Args:
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for the end.
+            device (str): The device, None for a single board.
+
+        Returns:
+            list: The record arrays, oldest first, without empty ones.
+        """
+        ranges = []
+        for day in self.days(device):
+            day_start = day * SECONDS_PER_DAY
+            if (start is not None and day_start + SECONDS_PER_DAY <= start) or (
+                end is not None and day_start >= end
+            ):
+                continue
+            mapped = self._map(day_path(self.directory, day, device))
+            if mapped is None:
+                continue
+            records, index_times, index_numbers = mapped
+            lo = (
+                0
+                if start is None
+                else _find(records, index_times, index_numbers, start)
+            )
+            hi = (
+                len(records)
+                if end is None
+                else _find(records, index_times, index_numbers, end)
+            )
+            if hi > lo:
+                ranges.append(records[lo:hi])
+        return ranges
+
+    def arrays(
+        self, start: float = None, end: float = None, device: str = None
+    ) -> dict:
+        """
+        Returns the records captured in a time range as one array per column.
+
+        Unlike read, this copies the records when the range spans several
+        day files.
+
+        Args:
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for the end.
+            device (str): The device, None for a single board.
+
+        Returns:
+            dict: Maps every field of RECORD_FIELDS to an array.
+        """
+        import numpy as np
+
+        ranges = self.read(start, end, device)
+        if len(ranges) == 1:
+            return {field: ranges[0][field] for field in RECORD_FIELDS}
+        dtype = _record_dtype()
+        return {
+            field: np.concatenate(
+                [records[field] for records in ranges]
+                or [np.empty(0, dtype=dtype[field])]
+            )
+            for field in RECORD_FIELDS
+        }
+
+    def _map(self, path: str):
+        import numpy as np
+
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self._maps.pop(path, None)
+            return None
+        cached = self._maps.get(path)
+        if cached is not None and cached[0] == size:
+            return cached[1:]
+        with open(path, "rb") as file:
+            magic, record_size, stride = struct.unpack(
+                HEADER_FORMAT, file.read(HEADER_SIZE).ljust(HEADER_SIZE, b"\0")
+            )
+        if magic != ARCHIVE_MAGIC or record_size != RECORD_SIZE:
+            raise Exception(f"There was an error reading {path}: not an archive file.")
+        count = (size - HEADER_SIZE) // RECORD_SIZE
+        if count <= 0:
+            return None
+        records = np.memmap(
+            path, dtype=_record_dtype(), mode="r", offset=HEADER_SIZE, shape=(count,)
+        )
+        expected = -(-count // stride)
+        index = None
+        if os.path.exists(_index_path(path)):
+            index = np.fromfile(
+                _index_path(path),
+                dtype=np.dtype([("captured", "<f8"), ("record", "<u8")]),
+            )
+        if index is not None and len(index) >= expected:
+            index_times = index["captured"][:expected]
+            index_numbers = index["record"][:expected].astype(np.int64)
+        else:
+            # The index lags behind the records after a crash; the strided
+            # view reads one page per stride instead
+            index_times = np.array(records["captured"][::stride])
+            index_numbers = np.arange(0, count, stride, dtype=np.int64)
+        self._maps[path] = (size, records, index_times, index_numbers)
+        return records, index_times, index_numbers
+
+
+class _DayWriter:
+    # The open day file of one device
+
+    __slots__ = (
+        "path",
+        "end",
+        "stride",
+        "count",
+        "last",
+        "flush_at",
+        "buffer",
+        "index",
+        "file",
+        "index_file",
+        "size",
+        "index_size",
+        "failing",
+    )
+
+    def __init__(self, path: str, day: int, index_every: int) -> None:
+        self.path = path
+        self.end = (day + 1) * SECONDS_PER_DAY
+        self.buffer = bytearray()
+        self.index = bytearray()
+        self.last = -math.inf
+        self.flush_at = 0.0
+        self.index_size = 0
+        self.failing = False
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+            self.file = open(path, "wb", buffering=0)
+            try:
+                _write_all(
+                    self.file,
+                    struct.pack(HEADER_FORMAT, ARCHIVE_MAGIC, RECORD_SIZE, index_every),
+                )
+                self.index_file = open(_index_path(path), "wb", buffering=0)
+            except OSError:
+                self.file.close()  # Recreated on the next attempt
+                raise
+            self.stride = index_every
+            self.count = 0
+            self.size = HEADER_SIZE
+            return
+        # Appending to the file of a restart on the same day
+        self.file = open(path, "r+b", buffering=0)
+        magic, record_size, self.stride = struct.unpack(
+            HEADER_FORMAT, self.file.read(HEADER_SIZE)
+        )
+        if magic != ARCHIVE_MAGIC or record_size != RECORD_SIZE:
+            self.file.close()
+            raise Exception(f"There was an error opening {path}: not an archive file.")
+        self.count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+        self.size = HEADER_SIZE + self.count * RECORD_SIZE
+        self.file.truncate(self.size)  # A partial record
+        # The index is rebuilt from the records, which were written first,
+        # and written with the next flush
+        for number in range(0, self.count, self.stride):
+            self.file.seek(HEADER_SIZE + number * RECORD_SIZE)
+            self.index += _pack_index(struct.unpack("<d", self.file.read(8))[0], number)
+        if self.count:
+            self.file.seek(HEADER_SIZE + (self.count - 1) * RECORD_SIZE)
+            self.last = struct.unpack("<d", self.file.read(8))[0]
+        self.file.seek(self.size)
+        self.index_file = open(_index_path(path), "wb", buffering=0)
+
+
+def day_path(directory: str, day: int, device: str = None) -> str:
+    """
+    Returns the path of the day file of a device.
+
+    Args:
+        directory (str): The archive directory.
+        day (int): The UTC day, in days since the epoch.
+        device (str): The device, None for a single board.
+
+    Returns:
+        str: The path of the records; the index has the same name ending in .idx.
+    """
+    year, month, date = _date(day)
+    name = f"{year:04d}-{month:02d}-{date:02d}.bin"
+    if device is None:
+        return os.path.join(directory, name)
+    return os.path.join(directory, "devices", device, name)
+
+
+def _record_dtype():
+    import numpy as np
+
+    return np.dtype(
+        {
+            "names": list(RECORD_FIELDS),
+            "formats": ["<f8", "<f4", "<f4", "<f4", "<f4", "u1"],
+            "offsets": [0, 8, 12, 16, 20, 24],
+            "itemsize": RECORD_SIZE,
+        }
+    )
+
+
+def _find(records, index_times, index_numbers, moment: float) -> int:
+    # The number of the first record captured at or after the moment. The
+    # index narrows it down to one stride, which is searched in a copy of
+    # at most `stride` capture times.
+    import numpy as np
+
+    entry = int(np.searchsorted(index_times, moment, side="left"))
+    lo = int(index_numbers[entry - 1]) if entry > 0 else 0
+    hi = int(index_numbers[entry]) if entry < len(index_numbers) else len(records)
+    return lo + int(np.searchsorted(records["captured"][lo:hi], moment, side="left"))
+
+
+def _write_all(file, data) -> None:
+    # FileIO.write may write less than it was given, e.g. on a full disk
+    view = memoryview(data)
+    while view:
+        written = file.write(view)
+        if not written:
+            raise OSError(f"Could not write to {file.name}.")
+        view = view[written:]
+
+
+def _truncate(file, size: int) -> None:
+    # Drops a partial write; shrinking a file needs no free space
+    try:
+        file.truncate(size)
+        file.seek(size)
+    except OSError as e:
+        logger.warning("Could not truncate %s: %s", file.name, e)
+
+
+def _index_below(index: bytearray, count: int) -> bytearray:
+    # The pending index entries of records that are still kept
+    kept = bytearray()
+    for offset in range(0, len(index), INDEX_SIZE):
+        if struct.unpack_from(INDEX_FORMAT, index, offset)[1] < count:
+            kept += index[offset : offset + INDEX_SIZE]
+    return kept
+
+
+def _index_path(path: str) -> str:
+    return path[: -len(".bin")] + ".idx"
+
+
+def _list(directory: str) -> list:
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+def _day_files(directory: str) -> list:
+    # (day, path, bytes of records and index) of every device, in no order
+    files = []
+    devices = os.path.join(directory, "devices")
+    for folder in [directory] + [
+        os.path.join(devices, device) for device in _list(devices)
+    ]:
+        for name in _list(folder):
+            match = _DAY_FILE.match(name)
+            if not match:
+                continue
+            path = os.path.join(folder, name)
+            try:
+                size = os.path.getsize(path)
+                if os.path.exists(_index_path(path)):
+                    size += os.path.getsize(_index_path(path))
+            except FileNotFoundError:
+                continue
+            files.append((_day_number(*match.groups()), path, size))
+    return files
+
+
+def _date(day: int) -> tuple:
+    # Days since the epoch -> (year, month, day)
+    date = datetime.date(1970, 1, 1) + datetime.timedelta(days=day)
+    return date.year, date.month, date.day
+
+
+def _day_number(year: str, month: str, date: str) -> int:
+    return (
+        datetime.date(int(year), int(month), int(date)) - datetime.date(1970, 1, 1)
+    ).days
@@ -1,8 +1,13 @@
 import json
 import requests
 from credential_loader import Credentials
+from http_pool import get_shared_pool
+from metrics import get_registry
 import re
 
+_metrics = get_registry()
+_metrics.describe("agribot_auth_request_seconds", "Firebase Auth request latency.")
+
 
 class FirebaseAuthenticator(Credentials):
     """
@@ -10,21 +15,30 @@ class FirebaseAuthenticator(Credentials):
 
     Attributes:
         firebase_config (str): Firebase configuration.
+        pool (HTTPPool): The connection pool requests are sent through.
+        identity_url (str): Base URL of the Identity Toolkit API, overridable for local stand-ins.
+        token_url (str): URL of the Secure Token API, overridable for local stand-ins.
 
     Methods:
         sign_in_with_email_and_password: Signs in a user with the provided email and password.
         get_account_info: Retrieves the account information associated with the given ID token.
+        refresh_id_token: Exchanges a refresh token for a new ID token.
         raise_detailed_error: Raises a detailed error if the HTTP request returns an error status code.
         sign_in: Signs in a user with the provided email and password.
     """
 
-    def __init__(self) -> None:
+    identity_url = "https://www.googleapis.com/identitytoolkit/v3/relyingparty"
+    token_url = "https://securetoken.googleapis.com/v1/token"
+
+    def __init__(self, pool=None) -> None:
         super().__init__()
+        self.pool = pool if pool is not None else get_shared_pool()
         self.firebase_config = self.get_firebase_config().get("apiKey")
         self.current_user = (
             None  # Add this line to keep track of the currently signed-in user
         )
 
+    @_metrics.timed("agribot_auth_request_seconds", op="sign_in")
     def sign_in_with_email_and_password(self, email: str, password: str) -> dict:
         """
         Signs in a user with the provided email and password.
@@ -39,17 +53,18 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error during the API request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}".format(
-            self.firebase_config
+        request_ref = "{0}/verifyPassword?key={1}".format(
+            self.identity_url, self.firebase_config
         )
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps(
             {"email": email, "password": password, "returnSecureToken": True}
         )
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.pool.session.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
+    @_metrics.timed("agribot_auth_request_seconds", op="get_account_info")
     def get_account_info(self, id_token: str) -> dict:
         """
         Retrieves the account information associated with the given ID token.
@@ -63,12 +78,33 @@ class FirebaseAuthenticator(Credentials):
         Raises:
             DetailedError: If there is an error in the request.
         """
-        request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getAccountInfo?key={0}".format(
-            self.firebase_config
+        request_ref = "{0}/getAccountInfo?key={1}".format(
+            self.identity_url, self.firebase_config
         )
         headers = {"content-type": "application/json; charset=UTF-8"}
         data = json.dumps({"idToken": id_token})
-        request_object = requests.post(request_ref, headers=headers, data=data)
+        request_object = self.pool.session.post(request_ref, headers=headers, data=data)
+        self.raise_detailed_error(request_object)
+        return request_object.json()
+
+    @_metrics.timed("agribot_auth_request_seconds", op="refresh")
+    def refresh_id_token(self, refresh_token: str) -> dict:
+        """
+        Exchanges a refresh token for a new ID token.
+
+        Args:
+            refresh_token (str): The refresh token returned when the user signed in.
+
+        Returns:
+            dict: The response data, with the new id_token, refresh_token and expires_in.
+
+        Raises:
+            requests.exceptions.HTTPError: If there is an error in the request.
+        """
+        request_ref = "{0}?key={1}".format(self.token_url, self.firebase_config)
+        headers = {"content-type": "application/x-www-form-urlencoded"}
+        data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
+        request_object = self.pool.session.post(request_ref, headers=headers, data=data)
         self.raise_detailed_error(request_object)
         return request_object.json()
 
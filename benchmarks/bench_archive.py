@@ -0,0 +1,157 @@
+"""
+Write overhead and scan speed benchmark for the local frame archive.
+
+Times FrameArchive.append per frame, which the reader thread pays for every
+parsed frame, then writes --days of frames at --rate Hz and scans all of
+them with ArchiveReader: the memory-mapped records of every day are read
+and the mean of every channel is computed. A one-hour range in the middle
+is read as well. The scan runs from the page cache, as it does right after
+the frames were written; a cold scan is bound by the disk.
+
+Usage:
+    python benchmarks/bench_archive.py [--days 30] [--rate 10] [--dir DIR]
+        [--output bench_archive.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive import SECONDS_PER_DAY, ArchiveReader, FrameArchive
+from reading import Reading
+
+START = 20000 * SECONDS_PER_DAY  # 2024-10-04, midnight UTC
+
+
+def make_readings(count: int, rate: float) -> list:
+    return [
+        Reading(
+            round(random.uniform(0, 100), 2),
+            round(random.uniform(0, 40), 2),
+            float(random.randint(0, 100)),
+            float(random.randint(0, 100)),
+            random.choice(["on", "off"]),
+            START + i / rate,
+        )
+        for i in range(count)
+    ]
+
+
+def bench_append(directory: str, readings: list) -> float:
+    archive = FrameArchive(directory)
+    started = time.perf_counter()
+    for reading in readings:
+        archive.append(reading)
+    elapsed = time.perf_counter() - started
+    archive.close()
+    return elapsed / len(readings)
+
+
+def write_month(directory: str, days: int, rate: float) -> tuple:
+    # One Reading is restamped for every frame, so the time is the archive's
+    archive = FrameArchive(directory)
+    reading = make_readings(1, rate)[0]
+    count = int(days * SECONDS_PER_DAY * rate)
+    started = time.perf_counter()
+    for i in range(count):
+        reading.captured = START + i / rate
+        reading.temperature = 15.0 + i % 1000 / 100
+        archive.append(reading)
+    archive.close()
+    return count, time.perf_counter() - started, archive.size()
+
+
+def scan(directory: str) -> tuple:
+    started = time.perf_counter()
+    reader = ArchiveReader(directory)
+    count = 0
+    sums = {}
+    for records in reader.read():
+        count += len(records)
+        for channel in ("humidity", "temperature", "moisture", "water_level"):
+            sums[channel] = sums.get(channel, 0.0) + float(
+                records[channel].sum(dtype="f8")
+            )
+    elapsed = time.perf_counter() - started
+    return count, elapsed, {channel: total / count for channel, total in sums.items()}
+
+
+def read_hour(directory: str, days: int) -> tuple:
+    middle = START + days * SECONDS_PER_DAY / 2
+    reader = ArchiveReader(directory)
+    started = time.perf_counter()
+    records = reader.read(middle, middle + 3600)
+    elapsed = time.perf_counter() - started
+    return sum(len(part) for part in records), elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--rate", type=float, default=10.0, help="frames per second")
+    parser.add_argument(
+        "--frames", type=int, default=200000, help="for the append timing"
+    )
+    parser.add_argument("--dir", help="archive directory, a temporary one by default")
+    parser.add_argument("--output", default="bench_archive.json")
+    args = parser.parse_args()
+
+    random.seed(0)
+    directory = args.dir or tempfile.mkdtemp(prefix="agribot_archive_")
+    try:
+        append_s = bench_append(
+            os.path.join(directory, "append"), make_readings(args.frames, args.rate)
+        )
+        month = os.path.join(directory, "month")
+        count, write_s, size = write_month(month, args.days, args.rate)
+        scanned, scan_s, means = scan(month)
+        hour, hour_s = read_hour(month, args.days)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    result = {
+        "append_us": append_s * 1e6,
+        "frame_budget_pct": append_s * args.rate * 100,
+        "days": args.days,
+        "rate": args.rate,
+        "frames": count,
+        "archive_mb": size / 1024 / 1024,
+        "write_s": write_s,
+        "scanned": scanned,
+        "scan_s": scan_s,
+        "scan_frames_per_s": scanned / scan_s,
+        "hour_frames": hour,
+        "hour_ms": hour_s * 1000,
+        "means": means,
+    }
+    print(
+        f"append {result['append_us']:.2f} us/frame,"
+        f" {result['frame_budget_pct']:.4f}% of the frame interval at {args.rate:g} Hz"
+    )
+    print(
+        f"{args.days} days at {args.rate:g} Hz: {count} frames,"
+        f" {result['archive_mb']:.0f} MB written in {write_s:.1f} s"
+    )
+    print(
+        f"scan {scanned} frames in {scan_s * 1000:.0f} ms"
+        f" ({result['scan_frames_per_s'] / 1e6:.0f} M frames/s),"
+        f" one hour ({hour} frames) in {result['hour_ms']:.2f} ms"
+    )
+    with open(args.output, "w") as out:
+        json.dump(result, out, indent=2)
+    print(f"Results written to {args.output}.")
+    if scanned != count:
+        print("FAILED: frames were lost.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
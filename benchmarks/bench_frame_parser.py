@@ -0,0 +1,102 @@
+"""
+Throughput microbenchmark for the serial frame parser.
+
+Feeds a synthetic sensors.ino byte stream to FrameParser in chunks of the size
+a serial read returns at each baud rate, and to the line-by-line parse_frame
+path for comparison. The latter is timed without the per-line read call that
+readline() costs in practice, so it is a lower bound for the old path.
+
+A serial line carries 10 bits per byte, so a parser must sustain baud / 10
+bytes per second to keep up; "headroom" is how many times faster it runs.
+It also reports the heap a parsed frame holds while it waits for upload.
+
+Usage:
+    python benchmarks/bench_frame_parser.py [--frames 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_parser import FrameParser, parse_frame
+
+BAUD_RATES = [9600, 115200, 230400, 460800, 921600]
+
+
+def make_stream(frames: int) -> bytes:
+    lines = []
+    for _ in range(frames):
+        lines.append(
+            "<{:.2f},{:.2f},{},{},{}>\r\n".format(
+                random.uniform(0, 100),
+                random.uniform(0, 40),
+                random.randint(0, 100),
+                random.randint(0, 100),
+                random.choice(["ON", "OFF"]),
+            )
+        )
+    return "".join(lines).encode()
+
+
+def bench_parser(stream: bytes, chunk: int) -> float:
+    parser = FrameParser()
+    started = time.perf_counter()
+    for i in range(0, len(stream), chunk):
+        parser.feed(stream[i : i + chunk])
+    elapsed = time.perf_counter() - started
+    assert parser.malformed == 0
+    return elapsed
+
+
+def bench_readline(stream: bytes) -> float:
+    started = time.perf_counter()
+    for line in stream.split(b"\n"):
+        parse_frame(line.decode("utf-8", "ignore"))
+    return time.perf_counter() - started
+
+
+def bytes_per_frame(stream: bytes, frames: int) -> float:
+    parser = FrameParser()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    readings = parser.feed(stream)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(readings) == frames
+    return held / frames
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--frames", type=int, default=200000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    stream = make_stream(args.frames)
+    frame_size = len(stream) / args.frames
+    elapsed = bench_readline(stream)
+    print(f"{args.frames} frames, {frame_size:.1f} bytes per frame")
+    print(f"{bytes_per_frame(stream, args.frames):.0f} heap bytes per parsed frame")
+    print(f"{'path':<24}{'frames/s':>12}{'MB/s':>10}{'headroom':>10}")
+    print(
+        f"{'parse_frame per line':<24}{args.frames / elapsed:>12.0f}"
+        f"{len(stream) / elapsed / 1e6:>10.2f}{'':>10}"
+    )
+    for baud in BAUD_RATES:
+        # About what in_waiting holds after 10 ms at this baud rate
+        chunk = max(1, baud // 10 // 100)
+        elapsed = bench_parser(stream, chunk)
+        headroom = len(stream) / elapsed / (baud / 10)
+        print(
+            f"{f'FrameParser @ {baud}':<24}{args.frames / elapsed:>12.0f}"
+            f"{len(stream) / elapsed / 1e6:>10.2f}{headroom:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+End-to-end ingest benchmark against a local Firebase stand-in.
+
+Signs in and uploads through the same FirebaseAuthenticator, TokenManager,
+RealtimeDB and IngestPipeline that AgribotAdmin.run wires together, against
+benchmarks/firebase_standin.py with the given latency and error rate. Frames
+come from a fixed-rate synthetic source parsed with parse_frame, or with
+--pty from a VirtualArduino on a pseudo-terminal read through FrameParser.
+
+For every sample rate it reports frames/s parsed while ingesting, writes/s
+(readings stored by the stand-in, including the drain on stop), requests/s,
+upload latency p50/p95/p99, queue depth, CPU and RSS. Results are written as JSON; --compare prints the change
+against an earlier run, so regressions in the hot loop show up in review.
+
+--spool commits readings to a SensorSpool first, as the daemon does.
+With --adaptive the uploads go through an UploadController, and the batch
+size it settled on is reported. --outage makes the stand-in fail every
+request for that many seconds from a third into each run, to check the
+backoff and circuit breaker: the requests it received meanwhile are reported.
+
+Usage:
+    python benchmarks/bench_ingest.py [--rates 10 100 1000] [--duration 10]
+        [--latency 0.05] [--error-rate 0.01] [--pty] [--adaptive] [--outage 10]
+        [--output bench.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_standin import FirebaseStandIn
+
+CONFIG_KEYS = [
+    "APIKEY",
+    "AUTHDOMAIN",
+    "PROJECTID",
+    "STORAGEBUCKET",
+    "MESSAGINGSENDERID",
+    "APPID",
+    "MEASUREMENTID",
+]
+EMAIL = "bench@example.com"
+# Lower is better for these metrics, higher for the rest
+LOWER_IS_BETTER = ("latency", "queue", "cpu", "rss", "failed", "dropped")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def rss_mb() -> float:
+    # Current RSS on Linux, the peak elsewhere
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        scale = 2**20 if sys.platform == "darwin" else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def synthetic_source(rate_hz: float):
+    """Returns a read_frame callable emitting sensors.ino frames at a fixed rate."""
+    from frame_parser import parse_frame
+
+    state = {"due": time.monotonic(), "n": 0}
+
+    def read_frame():
+        state["due"] += 1.0 / rate_hz
+        wait = state["due"] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        state["n"] += 1
+        n = state["n"]
+        line = f"<{50 + n % 10}.25,{20 + n % 5}.50,{n % 100},{n % 90},{'ON' if n % 7 else 'OFF'}>"
+        return parse_frame(line)
+
+    return read_frame
+
+
+def pty_source(rate_hz: float, baud_rate: int):
+    """Returns a VirtualArduino and a read_frames callable reading it through FrameParser."""
+    import serial
+    from frame_parser import FrameParser
+    from simulator import VirtualArduino
+
+    simulator = VirtualArduino(rate_hz=rate_hz, baud_rate=baud_rate, seed=0)
+    simulator.start()
+    ser = serial.Serial(simulator.port, baud_rate, timeout=0.1)
+    parser = FrameParser()
+
+    def read_frames():
+        return [(None, reading) for reading in parser.read(ser)]
+
+    return simulator, ser, parser, read_frames
+
+
+def run_once(args, standin: FirebaseStandIn, rate_hz: float) -> dict:
+    from auth import FirebaseAuthenticator
+    from http_pool import HTTPPool
+    from pipeline import IngestPipeline
+    from realtimedb import RealtimeDB
+    from spool import SensorSpool
+    from token_manager import TokenManager
+    from upload_control import UploadController
+
+    standin.tree = {}
+    standin.stats.clear()
+    pool = HTTPPool(pool_maxsize=max(10, args.workers * 2))
+    auth = FirebaseAuthenticator(pool=pool)
+    auth.identity_url = standin.identity_url
+    auth.token_url = standin.token_url
+    with tempfile.TemporaryDirectory() as tmp:
+        tokens = TokenManager(auth, cache_path=os.path.join(tmp, "token.json"))
+        user_info = tokens.sign_in(EMAIL, "benchmark")
+        db = RealtimeDB(
+            user_info,
+            batch_size=args.batch_size,
+            max_linger=args.max_linger,
+            pool=pool,
+        )
+
+        latencies = []
+        push = db.push_sensor_batch_for_user
+
+        def timed_push(*push_args, **push_kwargs):
+            started = time.perf_counter()
+            try:
+                return push(*push_args, **push_kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+        db.push_sensor_batch_for_user = timed_push
+
+        spool = SensorSpool(os.path.join(tmp, "spool.db")) if args.spool else None
+        controller = None
+        if args.adaptive:
+            controller = UploadController(args.batch_size, args.max_linger, seed=0)
+        simulator = ser = parser = None
+        if args.pty:
+            simulator, ser, parser, read_frames = pty_source(rate_hz, args.baud)
+            pipeline = IngestPipeline(
+                None,
+                db,
+                maxsize=args.queue_size,
+                policy=args.backpressure,
+                workers=args.workers,
+                read_frames=read_frames,
+                controller=controller,
+                spool=spool,
+            )
+        else:
+            pipeline = IngestPipeline(
+                synthetic_source(rate_hz),
+                db,
+                maxsize=args.queue_size,
+                policy=args.backpressure,
+                workers=args.workers,
+                controller=controller,
+                spool=spool,
+            )
+
+        outage = {}
+
+        def fail_for(seconds: float) -> None:
+            # Fails every request, as Firebase or the link being down would
+            error_rate = standin.error_rate
+            standin.error_rate = 1.0
+            requests_before = sum(standin.stats[m] for m in ("PATCH", "PUT"))
+            time.sleep(seconds)
+            standin.error_rate = error_rate
+            outage["requests"] = (
+                sum(standin.stats[m] for m in ("PATCH", "PUT")) - requests_before
+            )
+
+        depths = []
+        rss = []
+        sampling = threading.Event()
+        sampling.set()
+
+        def sample():
+            while sampling.is_set():
+                depths.append(pipeline.queue_depth())
+                rss.append(rss_mb())
+                time.sleep(0.1)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        pipeline.start()
+        sampler.start()
+        if args.outage:
+            threading.Timer(args.duration / 3, fail_for, (args.outage,)).start()
+        time.sleep(args.duration)
+        ingest_elapsed = time.perf_counter() - started
+        pipeline.stop()
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        sampling.clear()
+        sampler.join()
+        if simulator is not None:
+            ser.close()
+            simulator.stop()
+        backlog = spool.count() if spool is not None else 0
+        if spool is not None:
+            spool.close()
+
+    uid = user_info["localId"]
+    written = len(standin.get(f"users/{uid}/sensor_data") or {})
+    requests = standin.stats["PATCH"]
+    return {
+        "rate_hz": rate_hz,
+        "elapsed_s": elapsed,
+        "drain_s": elapsed - ingest_elapsed,
+        "frames_per_s": pipeline.stats["received"] / ingest_elapsed,
+        "writes_per_s": written / elapsed,
+        "requests_per_s": requests / elapsed,
+        "bytes_per_reading": standin.stats["request_bytes"] / max(1, written),
+        "latency_p50_ms": _ms(percentile(latencies, 50)),
+        "latency_p95_ms": _ms(percentile(latencies, 95)),
+        "latency_p99_ms": _ms(percentile(latencies, 99)),
+        "queue_depth_mean": sum(depths) / max(1, len(depths)),
+        "queue_depth_max": max(depths, default=0),
+        "cpu_percent": 100 * cpu / elapsed,
+        "rss_mb_max": max(rss, default=rss_mb()),
+        "malformed": parser.malformed if parser is not None else 0,
+        "stats": dict(pipeline.stats),
+        "pool": pool.stats(),
+        "batch_size": controller.batch_size if controller else args.batch_size,
+        "controller": dict(controller.stats) if controller else None,
+        "outage_requests": outage.get("requests"),
+        "spool_backlog": backlog,
+    }
+
+
+def _ms(seconds: float) -> float:
+    return None if seconds is None else seconds * 1000
+
+
+def compare(old: dict, new: dict) -> None:
+    old_runs = {run["rate_hz"]: run for run in old["runs"]}
+    print(f"\nChange against {old['meta'].get('label') or 'the previous run'}:")
+    for run in new["runs"]:
+        before = old_runs.get(run["rate_hz"])
+        if before is None:
+            continue
+        print(f"  {run['rate_hz']:g} Hz")
+        for metric, value in run.items():
+            previous = before.get(metric)
+            if not isinstance(value, (int, float)) or not previous or value is None:
+                continue
+            change = (value - previous) / previous * 100
+            worse = change > 0 if metric.startswith(LOWER_IS_BETTER) else change < 0
+            flag = "  <-- worse" if worse and abs(change) >= 10 else ""
+            print(
+                f"    {metric:<20}{previous:>12.2f}{value:>12.2f}{change:>+9.1f}%{flag}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rates", type=float, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per rate")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--max-linger", type=float, default=5.0)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--backpressure", default="drop_oldest")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--pty", action="store_true", help="read from a VirtualArduino")
+    parser.add_argument("--adaptive", action="store_true", help="use UploadController")
+    parser.add_argument("--outage", type=float, default=0.0, help="seconds of 503s")
+    parser.add_argument("--spool", action="store_true", help="spool to a temp file")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--label", help="name of this run, e.g. a git revision")
+    parser.add_argument("--output", default="bench_ingest.json")
+    parser.add_argument("--compare", help="JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    standin = FirebaseStandIn(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=0
+    )
+    standin.start()
+    os.environ["FIREBASE_CONFIG_DATABASEURL"] = standin.url
+    os.environ.setdefault("OPENAI_OPENAI_API_KEY", "benchmark")
+    for key in CONFIG_KEYS:
+        os.environ.setdefault(f"FIREBASE_CONFIG_{key}", "benchmark")
+
+    runs = []
+    try:
+        for rate_hz in args.rates:
+            run = run_once(args, standin, rate_hz)
+            runs.append(run)
+            print(
+                f"{rate_hz:>8g} Hz {run['frames_per_s']:>9.1f} frames/s"
+                f" {run['writes_per_s']:>9.1f} writes/s"
+                f" p50/p95/p99 {run['latency_p50_ms'] or 0:.1f}/"
+                f"{run['latency_p95_ms'] or 0:.1f}/{run['latency_p99_ms'] or 0:.1f} ms"
+                f" queue {run['queue_depth_max']:>5}"
+                f" cpu {run['cpu_percent']:>5.1f}% rss {run['rss_mb_max']:.1f} MB"
+                f" batch {run['batch_size']}"
+            )
+            if run["outage_requests"] is not None:
+                print(
+                    f"{'':>11}{run['outage_requests']} requests during the outage,"
+                    f" {run['stats'].get('spilled', 0)} spilled,"
+                    f" {run['stats'].get('dropped', 0)} dropped,"
+                    f" {run['spool_backlog']} left in the spool"
+                )
+    finally:
+        standin.stop()
+
+    result = {
+        "meta": {
+            "label": args.label,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "runs": runs,
+    }
+    with open(args.output, "w") as out:
+        json.dump(result, out, indent=2)
+    print(f"Results written to {args.output}.")
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), result)
+
+
+if __name__ == "__main__":
+    main()
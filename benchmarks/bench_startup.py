@@ -0,0 +1,223 @@
+"""
+Import-time and cold-start benchmark with a budget.
+
+Every measurement runs in a fresh interpreter, so nothing is cached between
+runs except what the OS caches on disk, and the median of --runs is taken:
+
+- import: `python -X importtime -c "import <module>"` for the entry modules
+- modules: which heavy packages importing daemon and admin pulls in
+- start: time from spawning daemon.py in random mode until it logs
+  "Ready to ingest." and until the first reading reaches a local Firebase
+  stand-in, for a first start (password sign-in) and a restart (cached session)
+
+The results are compared with benchmarks/startup_budget.json and the script
+exits with status 1 if any is over budget, so it can gate a CI job. Use
+--scale to stretch the time budgets on slower hardware.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--scale 3] [--output startup.json]
+"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from firebase_standin import FirebaseStandIn
+
+BUDGET_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "startup_budget.json"
+)
+
+# Runs daemon.main with the auth endpoints pointed at the stand-in
+BOOTSTRAP = """
+import sys
+sys.path.insert(0, {repo!r})
+import auth
+auth.FirebaseAuthenticator.identity_url = {identity_url!r}
+auth.FirebaseAuthenticator.token_url = {token_url!r}
+import daemon
+daemon.main(sys.argv[1:])
+"""
+
+
+def import_ms(module: str) -> float:
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def loaded_modules(module: str) -> set:
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))",
+        ],
+        cwd=REPO,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return {name.split(".")[0] for name in json.loads(output.splitlines()[-1])}
+
+
+def start_ms(standin: FirebaseStandIn, workdir: str) -> dict:
+    """Spawns the daemon and times it until it is ready and until the first upload."""
+    standin.stats.clear()
+    bootstrap = BOOTSTRAP.format(
+        repo=REPO, identity_url=standin.identity_url, token_url=standin.token_url
+    )
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            bootstrap,
+            "--config",
+            os.path.join(workdir, "agribot.toml"),
+        ],
+        cwd=workdir,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        text=True,
+    )
+    result = {}
+    try:
+        for line in process.stderr:
+            if "Ready to ingest." in line:
+                result["ready_ms"] = (time.monotonic() - started) * 1000
+                break
+        while standin.stats["PATCH"] == 0 and time.monotonic() - started < 30:
+            time.sleep(0.001)
+        result["first_upload_ms"] = (time.monotonic() - started) * 1000
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+    if "ready_ms" not in result:
+        raise RuntimeError("The daemon exited before it was ready")
+    return result
+
+
+def write_config(standin: FirebaseStandIn, workdir: str) -> None:
+    with open(os.path.join(workdir, "secrets.toml"), "w") as secrets:
+        secrets.write("[firebase_config]\n")
+        for key in (
+            "apiKey",
+            "authDomain",
+            "projectId",
+            "storageBucket",
+            "messagingSenderId",
+            "appId",
+            "measurementId",
+        ):
+            secrets.write(f'{key} = "benchmark"\n')
+        secrets.write(f'databaseURL = "{standin.url}"\n')
+        secrets.write('[agribot_auth]\npassword = "benchmark"\n')
+    with open(os.path.join(workdir, "agribot.toml"), "w") as config:
+        config.write(
+            "[agribot]\n"
+            'email = "startup@example.com"\n'
+            "random = true\n"
+            f'secrets = "{os.path.join(workdir, "secrets.toml")}"\n'
+            f'token_cache = "{os.path.join(workdir, "token.json")}"\n'
+            f'spool_path = "{os.path.join(workdir, "spool.db")}"\n'
+            "batch_size = 1\n"
+            "headless_interval = 3600\n"
+        )
+
+
+def check(results: dict, budget: dict, scale: float) -> list:
+    failures = []
+    for module, limit in budget.get("import_ms", {}).items():
+        value = results["import_ms"][module]
+        if value > limit * scale:
+            failures.append(f"import {module}: {value:.0f} ms > {limit * scale:.0f} ms")
+    for module, forbidden in budget.get("forbidden_modules", {}).items():
+        for name in sorted(set(forbidden) & set(results["modules"][module])):
+            failures.append(f"import {module} loads {name}")
+    for kind, limits in budget.get("start_ms", {}).items():
+        for metric, limit in limits.items():
+            value = results["start_ms"][kind][metric]
+            if value > limit * scale:
+                failures.append(
+                    f"{kind} {metric}: {value:.0f} ms > {limit * scale:.0f} ms"
+                )
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="budget multiplier")
+    parser.add_argument("--budget", default=BUDGET_PATH)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    with open(args.budget) as budget_file:
+        budget = json.load(budget_file)
+    modules = sorted(
+        set(budget.get("import_ms", {})) | set(budget.get("forbidden_modules", {}))
+    )
+    results = {"import_ms": {}, "modules": {}, "start_ms": {}}
+    for module in modules:
+        results["import_ms"][module] = statistics.median(
+            import_ms(module) for _ in range(args.runs)
+        )
+        print(f"import {module:<16}{results['import_ms'][module]:>8.1f} ms")
+    for module in budget.get("forbidden_modules", {}):
+        heavy = sorted(
+            loaded_modules(module) & set(budget["forbidden_modules"][module])
+        )
+        results["modules"][module] = heavy
+        print(f"import {module:<16} loads {', '.join(heavy) or 'no heavy modules'}")
+
+    standin = FirebaseStandIn()
+    standin.start()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            write_config(standin, workdir)
+            first = start_ms(standin, workdir)  # Signs in and caches the session
+            restarts = [start_ms(standin, workdir) for _ in range(args.runs)]
+    finally:
+        standin.stop()
+    results["start_ms"]["first_start"] = first
+    results["start_ms"]["restart"] = {
+        metric: statistics.median(run[metric] for run in restarts) for metric in first
+    }
+    for kind, values in results["start_ms"].items():
+        print(
+            f"{kind:<12} ready {values['ready_ms']:>7.0f} ms"
+            f"   first upload {values['first_upload_ms']:>7.0f} ms"
+        )
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+    failures = check(results, budget, args.scale)
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}")
+    if failures:
+        sys.exit(1)
+    print("Within budget.")
+
+
+if __name__ == "__main__":
+    main()
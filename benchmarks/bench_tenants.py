@@ -0,0 +1,145 @@
+"""
+Multi-tenant client registry benchmark against a local Firebase stand-in.
+
+Signs --users accounts in through one FirebaseClients registry, uploads a
+batch for each and reports what every additional user cost: Python heap
+(tracemalloc) per handle, new TCP connections opened by the shared pool,
+and how often the credentials were loaded and the Firebase app was
+initialized. A second pass signs the same users in again after they were
+evicted, which must use the cached sessions and open no connections.
+
+Usage:
+    python benchmarks/bench_tenants.py [--users 100] [--max-users 50]
+        [--latency 0.005] [--output bench_tenants.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ingest import CONFIG_KEYS
+from firebase_standin import FirebaseStandIn
+
+
+def run(args, standin: FirebaseStandIn) -> dict:
+    import auth
+    import credential_loader
+    import realtimedb
+    from clients import FirebaseClients
+    from http_pool import HTTPPool
+
+    auth.FirebaseAuthenticator.identity_url = standin.identity_url
+    auth.FirebaseAuthenticator.token_url = standin.token_url
+    counts = {"credentials": 0, "apps": 0}
+    load_credentials = credential_loader.Credentials.__init__
+    initialize_app = realtimedb.initialize_app
+
+    def counting_credentials(self):
+        counts["credentials"] += 1
+        load_credentials(self)
+
+    def counting_app(config, pool):
+        counts["apps"] += 1
+        return initialize_app(config, pool)
+
+    credential_loader.Credentials.__init__ = counting_credentials
+    realtimedb.initialize_app = counting_app
+    import clients
+
+    clients.initialize_app = counting_app
+
+    pool = HTTPPool()
+    emails = [f"tenant{i}@example.com" for i in range(args.users)]
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = FirebaseClients(pool=pool, max_users=args.max_users, token_dir=tmp)
+        registry.sign_in(emails[0], "benchmark")  # Warms the pool and the app
+        handshakes = pool.stats()["handshakes"]
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        for email in emails[1:]:
+            registry.sign_in(email, "benchmark")
+        first_s = time.perf_counter() - started
+        heap = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        first_handshakes = pool.stats()["handshakes"] - handshakes
+
+        for email in emails:
+            handle = registry.sign_in(email)
+            handle.add_reading({"temperature": 21.5, "timestamp": 0})
+            handle.flush()
+        handshakes = pool.stats()["handshakes"]
+        started = time.perf_counter()
+        for email in emails:
+            registry.sign_in(email)  # Evicted users come back from the cache
+        again_s = time.perf_counter() - started
+        again_handshakes = pool.stats()["handshakes"] - handshakes
+        registry.stop()
+
+    kept = min(args.users, args.max_users)
+    return {
+        "users": args.users,
+        "max_users": args.max_users,
+        "credential_loads": counts["credentials"],
+        "app_inits": counts["apps"],
+        "heap_per_user_kb": heap / max(1, min(args.users - 1, kept)) / 1024,
+        "sign_in_ms": first_s / max(1, args.users - 1) * 1000,
+        "sign_in_handshakes": first_handshakes,
+        "cached_sign_in_ms": again_s / args.users * 1000,
+        "cached_sign_in_handshakes": again_handshakes,
+        "evicted": registry.stats["evicted"],
+        "stored_readings": sum(
+            len(user.get("sensor_data", {}))
+            for user in (standin.get("users") or {}).values()
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--max-users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds")
+    parser.add_argument("--output", default="bench_tenants.json")
+    args = parser.parse_args()
+
+    standin = FirebaseStandIn(latency=args.latency, seed=0)
+    standin.start()
+    os.environ["FIREBASE_CONFIG_DATABASEURL"] = standin.url
+    os.environ.setdefault("OPENAI_OPENAI_API_KEY", "benchmark")
+    for key in CONFIG_KEYS:
+        os.environ.setdefault(f"FIREBASE_CONFIG_{key}", "benchmark")
+    try:
+        result = run(args, standin)
+    finally:
+        standin.stop()
+
+    print(
+        f"{result['users']} users, {result['credential_loads']} credential loads,"
+        f" {result['app_inits']} app inits, {result['evicted']} evicted"
+    )
+    print(
+        f"sign-in {result['sign_in_ms']:.2f} ms/user,"
+        f" {result['sign_in_handshakes']} handshakes,"
+        f" {result['heap_per_user_kb']:.1f} KB/user"
+    )
+    print(
+        f"cached sign-in {result['cached_sign_in_ms']:.2f} ms/user,"
+        f" {result['cached_sign_in_handshakes']} handshakes"
+    )
+    with open(args.output, "w") as out:
+        json.dump(result, out, indent=2)
+    print(f"Results written to {args.output}.")
+    if result["stored_readings"] != result["users"]:
+        print("FAILED: readings were lost.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Remote valve control benchmark against a local Firebase stand-in.
+
+Writes valve commands to the valve_command node of the stand-in the way the
+dashboard does and follows them through the same path AgribotAdmin.run
+sets up: the RealtimeDB stream, ValveController, a VirtualArduino on a
+pseudo-terminal and the acknowledgement written back to valve_command_ack.
+
+It reports the command-to-acknowledgement latency measured on the server
+clock (issued_at to acked_at) and the delivery, serial and actuation stages
+from the gateway's histograms. With --drop-every the stand-in cuts the
+stream after every few commands, so the snapshot sent on reconnect repeats
+the last one; the run fails if a command is lost or written to the board
+more than once.
+
+Usage:
+    python benchmarks/bench_valve.py [--commands 50] [--interval 0.2]
+        [--latency 0.02] [--drop-every 10] [--output bench_valve.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ingest import CONFIG_KEYS, EMAIL, percentile
+from firebase_standin import SERVER_TIMESTAMP, FirebaseStandIn
+
+STATES = ("on", "off", "auto")
+STAGES = ("delivery", "serial", "actuation", "total")
+
+
+def run(args, standin: FirebaseStandIn) -> dict:
+    import serial
+    from auth import FirebaseAuthenticator
+    from frame_parser import FrameParser
+    from http_pool import HTTPPool
+    from metrics import get_registry
+    from realtimedb import RealtimeDB
+    from simulator import VirtualArduino
+    from token_manager import TokenManager
+    from valve_control import ValveController
+
+    pool = HTTPPool()
+    auth = FirebaseAuthenticator(pool=pool)
+    auth.identity_url = standin.identity_url
+    auth.token_url = standin.token_url
+    simulator = VirtualArduino(rate_hz=args.frame_rate, baud_rate=args.baud, seed=0)
+    simulator.start()
+    ser = serial.Serial(simulator.port, args.baud, timeout=0.1)
+    parser = FrameParser()
+    with tempfile.TemporaryDirectory() as tmp:
+        tokens = TokenManager(auth, cache_path=os.path.join(tmp, "token.json"))
+        user_info = tokens.sign_in(EMAIL, "benchmark")
+        db = RealtimeDB(user_info, pool=pool)
+        controller = ValveController(
+            db,
+            lambda device, payload: ser.write(payload),
+            state_path=os.path.join(tmp, "valve_command.json"),
+        )
+        reading = threading.Event()
+        reading.set()
+
+        def read():
+            while reading.is_set():
+                parser.read(ser)
+                while parser.acks:
+                    controller.acknowledge(None, parser.acks.popleft())
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        controller.start()
+        stream = db.listen_for_valve_commands(controller.handle)
+        uid = user_info["localId"]
+        latencies = []
+        lost = []
+        try:
+            while not stream.connected:
+                time.sleep(0.01)
+            for i in range(args.commands):
+                command_id = f"bench-{i}"
+                standin.handle(
+                    "PUT",
+                    f"users/{uid}/valve_command",
+                    {
+                        "id": command_id,
+                        "state": STATES[i % len(STATES)],
+                        "issued_at": SERVER_TIMESTAMP,
+                    },
+                )
+                deadline = time.monotonic() + args.timeout
+                ack = None
+                while time.monotonic() < deadline:
+                    ack = standin.get(f"users/{uid}/valve_command_ack")
+                    if ack and ack.get("id") == command_id:
+                        break
+                    time.sleep(0.001)
+                if ack and ack.get("id") == command_id and ack["status"] == "applied":
+                    issued_at = standin.get(f"users/{uid}/valve_command/issued_at")
+                    latencies.append(ack["acked_at"] - issued_at)
+                else:
+                    lost.append(command_id)
+                if args.drop_every and (i + 1) % args.drop_every == 0:
+                    # The snapshot sent on reconnect repeats this command
+                    standin.drop_streams()
+                time.sleep(args.interval)
+        finally:
+            stream.stop()
+            controller.stop()
+            reading.clear()
+            reader.join()
+            ser.close()
+            simulator.stop()
+            tokens.stop()
+
+    registry = get_registry()
+    stages = {}
+    for stage in STAGES:
+        histogram = registry.histogram("agribot_valve_command_seconds", stage=stage)
+        stages[stage] = {
+            f"p{q}_ms": (
+                None
+                if histogram.quantile(q / 100) is None
+                else histogram.quantile(q / 100) * 1000
+            )
+            for q in (50, 95)
+        }
+    return {
+        "commands": args.commands,
+        "applied": controller.stats["applied"],
+        "lost": lost,
+        "board_writes": simulator.stats["commands"],
+        "replays_skipped": controller.stats["duplicate"],
+        "timeouts": controller.stats["timeout"],
+        "reconnects": stream.stats["connects"] - 1,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+        "stages": stages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds per ack")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--drop-every", type=int, default=10, help="0 never drops")
+    parser.add_argument("--frame-rate", type=float, default=50.0, help="board frames/s")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--output", default="bench_valve.json")
+    args = parser.parse_args()
+
+    standin = FirebaseStandIn(latency=args.latency, seed=0)
+    standin.start()
+    os.environ["FIREBASE_CONFIG_DATABASEURL"] = standin.url
+    os.environ.setdefault("OPENAI_OPENAI_API_KEY", "benchmark")
+    for key in CONFIG_KEYS:
+        os.environ.setdefault(f"FIREBASE_CONFIG_{key}", "benchmark")
+    try:
+        result = run(args, standin)
+    finally:
+        standin.stop()
+
+    print(
+        f"{result['applied']}/{result['commands']} applied,"
+        f" {result['board_writes']} board writes,"
+        f" {result['reconnects']} reconnects,"
+        f" {result['replays_skipped']} replays skipped"
+    )
+    print(
+        f"command to ack p50/p95/p99 {result['latency_p50_ms']}/"
+        f"{result['latency_p95_ms']}/{result['latency_p99_ms']} ms (server clock)"
+    )
+    for stage, values in result["stages"].items():
+        print(
+            f"  {stage:<10} p50 {values['p50_ms'] or 0:>7.1f} ms"
+            f"  p95 {values['p95_ms'] or 0:>7.1f} ms"
+        )
+    with open(args.output, "w") as out:
+        json.dump(result, out, indent=2)
+    print(f"Results written to {args.output}.")
+    if result["lost"] or result["board_writes"] != result["commands"]:
+        print("FAILED: commands were lost or written to the board more than once.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Bytes-per-reading benchmark of the upload wire formats against a local Firebase stand-in.
+
+Uploads the same readings in every wire format through RealtimeDB, in
+batches of each --batch-sizes, and reports the request body bytes the
+stand-in received per reading:
+
+    verbose      full channel names, json.dumps default separators (before)
+    verbose+     full channel names, compact separators
+    compact      the short-key, fixed-point schema of wire.py
+    compact+gz   the compact schema, gzip-compressed request bodies
+
+The stored readings of every format are read back, decoded and compared
+with what was uploaded, so a format that loses data fails the benchmark.
+
+Usage:
+    python benchmarks/bench_wire.py [--readings 1000] [--batch-sizes 1,10,100]
+        [--output bench_wire.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_ingest import CONFIG_KEYS
+from firebase_standin import FirebaseStandIn
+
+# name -> (wire_schema, compact separators, compress_min)
+FORMATS = {
+    "verbose": (None, False, None),
+    "verbose+": (None, True, None),
+    "compact": (1, True, None),
+    "compact+gz": (1, True, 0),
+}
+
+
+def make_readings(count: int) -> list:
+    from reading import Reading
+
+    captured = 1.7e9
+    readings = []
+    for _ in range(count):
+        captured += 0.1  # 10 Hz
+        readings.append(
+            Reading(
+                round(random.uniform(0, 100), 2),
+                round(random.uniform(0, 40), 2),
+                random.randint(0, 100),
+                random.randint(0, 100),
+                "off",
+                captured,
+            )
+        )
+    return readings
+
+
+def run(readings: list, batch_size: int, name: str, standin: FirebaseStandIn) -> dict:
+    import realtimedb
+    from clients import FirebaseClients
+    from http_pool import HTTPPool
+    from wire import decode_reading
+
+    schema, compact, compress_min = FORMATS[name]
+    realtimedb.COMPACT_JSON = {"separators": (",", ":")} if compact else {}
+    email = f"{name.replace('+', '-')}-{batch_size}@example.com"
+    pool = HTTPPool(compress_min=compress_min)
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = FirebaseClients(
+            pool=pool, token_dir=tmp, batch_size=batch_size, wire_schema=schema
+        )
+        handle = registry.sign_in(email, "benchmark")
+        before = standin.stats["request_bytes"]
+        body_before = pool.stats()["body_bytes"]
+        for reading in readings:
+            if handle.add_reading(reading):
+                handle.flush()
+        handle.flush()
+        sent = standin.stats["request_bytes"] - before
+        body = pool.stats()["body_bytes"] - body_before
+        registry.stop()
+
+    uid = "".join(c if c.isalnum() else "_" for c in email)
+    stored = standin.get(f"users/{uid}/sensor_data") or {}
+    decoded = sorted(
+        (
+            decode_reading(data, realtimedb.push_key_time(key))
+            for key, data in stored.items()
+        ),
+        key=lambda data: data["timestamp"],
+    )
+    lossless = len(decoded) == len(readings) and all(
+        data == reading.to_dict() for data, reading in zip(decoded, readings)
+    )
+    return {
+        "format": name,
+        "batch_size": batch_size,
+        "bytes_per_reading": sent / len(readings),
+        "body_bytes_per_reading": body / len(readings),
+        "lossless": lossless,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--readings", type=int, default=1000)
+    parser.add_argument("--batch-sizes", default="1,10,100")
+    parser.add_argument("--output", default="bench_wire.json")
+    args = parser.parse_args()
+
+    standin = FirebaseStandIn(latency=0.0, seed=0)
+    standin.start()
+    os.environ["FIREBASE_CONFIG_DATABASEURL"] = standin.url
+    os.environ.setdefault("OPENAI_OPENAI_API_KEY", "benchmark")
+    for key in CONFIG_KEYS:
+        os.environ.setdefault(f"FIREBASE_CONFIG_{key}", "benchmark")
+    import auth
+
+    auth.FirebaseAuthenticator.identity_url = standin.identity_url
+    auth.FirebaseAuthenticator.token_url = standin.token_url
+
+    random.seed(0)
+    readings = make_readings(args.readings)
+    results = []
+    try:
+        for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+            for name in FORMATS:
+                results.append(run(readings, batch_size, name, standin))
+    finally:
+        standin.stop()
+
+    print(f"{args.readings} readings, request body bytes per reading")
+    print(f"{'batch':>6}" + "".join(f"{name:>12}" for name in FORMATS))
+    for i in range(0, len(results), len(FORMATS)):
+        row = results[i : i + len(FORMATS)]
+        print(
+            f"{row[0]['batch_size']:>6}"
+            + "".join(f"{result['bytes_per_reading']:>12.1f}" for result in row)
+        )
+    with open(args.output, "w") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results written to {args.output}.")
+    if not all(result["lossless"] for result in results):
+        print("FAILED: decoded readings differ from the uploaded ones.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+Local stand-in for the Firebase REST endpoints the interface talks to.
+
+Serves the Realtime Database REST API (GET, PUT, POST, PATCH and DELETE on
+"<path>.json", including multi-location PATCH, {".sv": "timestamp"} server
+values, and orderBy, startAt, endAt, limitToFirst, limitToLast and shallow
+queries) from an in-memory tree, and the Identity Toolkit verifyPassword and
+getAccountInfo and Secure Token endpoints, with injectable latency and error
+rates. Every password is accepted. A GET with "Accept: text/event-stream"
+opens a streaming subscription that sends "put" events like Firebase does.
+
+Point FIREBASE_CONFIG_DATABASEURL at `url` and FirebaseAuthenticator's
+identity_url and token_url at `identity_url` and `token_url`.
+
+Usage:
+    python benchmarks/firebase_standin.py [--port 9000] [--latency 0.05] [--error-rate 0.01]
+"""
+
+import argparse
+import collections
+import gzip
+import json
+import queue
+import random
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SERVER_TIMESTAMP = {".sv": "timestamp"}
+
+
+class FirebaseStandIn:
+    """
+    Class to run the stand-in server on a background thread.
+
+    Attributes:
+        host: The interface the server listens on.
+        port: The port the server listens on, 0 picks a free one.
+        latency: Seconds every request is delayed by.
+        jitter: Maximum extra random delay in seconds.
+        error_rate: Probability that a request is answered with 503.
+        tree: The database contents.
+        stats: Counters for requests per method, errors, request bytes and stream events.
+        keepalive: Seconds between keep-alive events on idle streams.
+
+    Methods:
+        start: Starts serving requests.
+        stop: Stops the server.
+        url: Returns the database URL.
+        identity_url: Returns the Identity Toolkit base URL.
+        token_url: Returns the Secure Token URL.
+        get: Returns the value at a database path.
+        drop_streams: Closes every open stream, as a network failure would.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = None,
+        keepalive: float = 30.0,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tree = {}
+        self.stats = collections.Counter()
+        self.keepalive = keepalive
+        self._streams = []  # (path parts, queue of events) per open stream
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        Returns the database URL.
+
+        Returns:
+            str: The URL to use as FIREBASE_CONFIG_DATABASEURL.
+        """
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def identity_url(self) -> str:
+        """
+        Returns the Identity Toolkit base URL.
+
+        Returns:
+            str: The URL to use as FirebaseAuthenticator.identity_url.
+        """
+        return f"{self.url}/identitytoolkit/v3/relyingparty"
+
+    @property
+    def token_url(self) -> str:
+        """
+        Returns the Secure Token URL.
+
+        Returns:
+            str: The URL to use as FirebaseAuthenticator.token_url.
+        """
+        return f"{self.url}/v1/token"
+
+    def start(self) -> None:
+        """
+        Starts serving requests.
+
+        Returns:
+            None
+        """
+        standin = self
+
+        class Handler(_Handler):
+            server_standin = standin
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="firebase-standin", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the server.
+
+        Returns:
+            None
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join(5.0)
+            self._server = None
+
+    def get(self, path: str):
+        """
+        Returns the value at a database path.
+
+        Args:
+            path (str): The path, e.g. "users/<uid>/sensor_data".
+
+        Returns:
+            The value, or None if nothing is stored there.
+        """
+        with self._lock:
+            return self._get(_split(path))
+
+    def drop_streams(self) -> None:
+        """
+        Closes every open stream, as a network failure would.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for _, events in self._streams:
+                events.put(None)
+
+    def _subscribe(self, path: str) -> queue.Queue:
+        # The first event is the current value, like Firebase sends it
+        parts = _split(path)
+        events = queue.Queue()
+        with self._lock:
+            events.put(("put", {"path": "/", "data": self._get(parts)}))
+            self._streams.append((parts, events))
+        return events
+
+    def _unsubscribe(self, events: queue.Queue) -> None:
+        with self._lock:
+            self._streams = [s for s in self._streams if s[1] is not events]
+
+    def _notify(self, parts: list) -> None:
+        # Sends the new value of every stream at or below the written path,
+        # and of every stream above it; called with the lock held
+        for stream_parts, events in self._streams:
+            common = min(len(parts), len(stream_parts))
+            if parts[:common] == stream_parts[:common]:
+                events.put(("put", {"path": "/", "data": self._get(stream_parts)}))
+
+    def _get(self, parts: list):
+        node = self.tree
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _set(self, parts: list, value) -> None:
+        if not parts:
+            self.tree = value if isinstance(value, dict) else {}
+            return
+        node = self.tree
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def _push_key(self) -> str:
+        # Ordered like real push keys: a millisecond prefix, then random characters
+        return "-{:011d}{}".format(
+            int(time.time() * 1000) % 10**11,
+            "".join(self._random.choice(string.ascii_letters) for _ in range(8)),
+        )
+
+    def handle(self, method: str, path: str, body, query: dict = None):
+        """
+        Applies a database request to the tree.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The database path, without ".json".
+            body: The decoded JSON body, or None.
+            query (dict): The query parameters of a GET, values still JSON encoded.
+
+        Returns:
+            The JSON response.
+        """
+        parts = _split(path)
+        body = _resolve(body, int(time.time() * 1000))
+        with self._lock:
+            if method == "GET":
+                return _query(self._get(parts), query or {})
+            if method == "PUT":
+                self._set(parts, body)
+                self._notify(parts)
+                return body
+            if method == "POST":
+                key = self._push_key()
+                self._set(parts + [key], body)
+                self._notify(parts + [key])
+                return {"name": key}
+            if method == "PATCH":
+                for sub_path, value in body.items():
+                    self._set(parts + _split(sub_path), value)
+                self._notify(parts)
+                return body
+            if method == "DELETE":
+                self._set(parts, None)
+                self._notify(parts)
+                return None
+        raise ValueError(method)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real endpoints
+    disable_nagle_algorithm = True  # Or headers and body wait on delayed ACKs
+    server_standin = None
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _respond(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self) -> None:
+        standin = self.server_standin
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        standin.stats[self.command] += 1
+        standin.stats["request_bytes"] += length  # As sent, compressed or not
+        if self.headers.get("Content-Encoding") == "gzip":
+            raw = gzip.decompress(raw)
+        delay = standin.latency + standin._random.uniform(0, standin.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if standin._random.random() < standin.error_rate:
+            standin.stats["errors"] += 1
+            self._respond(503, {"error": "Service Unavailable"})
+            return
+        url = urlsplit(self.path)
+        if url.path.startswith("/identitytoolkit/") or url.path == "/v1/token":
+            self._respond(200, self._auth(url.path, raw))
+            return
+        if not url.path.endswith(".json"):
+            self._respond(404, {"error": "Not Found"})
+            return
+        if self.command == "GET" and "text/event-stream" in self.headers.get(
+            "Accept", ""
+        ):
+            self._stream(url.path[:-5])
+            return
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            self._respond(400, {"error": "Invalid data; couldn't parse JSON object."})
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        query.pop("auth", None)
+        self._respond(200, standin.handle(self.command, url.path[:-5], body, query))
+
+    def _stream(self, path: str) -> None:
+        standin = self.server_standin
+        events = standin._subscribe(path)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    item = events.get(timeout=standin.keepalive)
+                except queue.Empty:
+                    item = ("keep-alive", None)
+                if item is None:
+                    break
+                event, data = item
+                standin.stats["stream_events"] += 1
+                chunk = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            standin._unsubscribe(events)
+            self.close_connection = True
+
+    def _auth(self, path: str, raw: bytes) -> dict:
+        if path.endswith("/verifyPassword"):
+            email = json.loads(raw)["email"]
+            return {
+                "localId": _uid(email),
+                "email": email,
+                "idToken": "standin-" + _uid(email),
+                "refreshToken": "standin-refresh-" + _uid(email),
+                "expiresIn": "3600",
+                "registered": True,
+            }
+        if path.endswith("/getAccountInfo"):
+            uid = json.loads(raw)["idToken"][len("standin-") :]
+            return {"users": [{"localId": uid, "emailVerified": True}]}
+        refresh_token = parse_qs(raw.decode()).get("refresh_token", [""])[0]
+        uid = refresh_token[len("standin-refresh-") :]
+        return {
+            "id_token": "standin-" + uid,
+            "refresh_token": refresh_token,
+            "expires_in": "3600",
+            "user_id": uid,
+        }
+
+    do_GET = do_PUT = do_POST = do_PATCH = do_DELETE = _dispatch
+
+
+def _split(path: str) -> list:
+    return [part for part in path.split("/") if part]
+
+
+def _uid(email: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in email)
+
+
+def _query(value, query: dict):
+    # Filters a node like the REST query parameters do
+    if not isinstance(value, dict) or not query:
+        return value
+    if query.get("shallow") == "true":
+        return {key: True for key in value}
+    order_by = json.loads(query.get("orderBy", '"$key"'))
+    if order_by == "$key":
+        items = sorted(value.items())
+        sort_key = lambda item: item[0]
+    else:
+        items = sorted(
+            value.items(),
+            key=lambda item: (
+                isinstance(item[1], dict) and order_by in item[1],
+                item[1].get(order_by, 0) if isinstance(item[1], dict) else 0,
+                item[0],
+            ),
+        )
+        sort_key = lambda item: (
+            item[1].get(order_by) if isinstance(item[1], dict) else None
+        )
+    if "startAt" in query:
+        start = json.loads(query["startAt"])
+        items = [i for i in items if sort_key(i) is not None and sort_key(i) >= start]
+    if "endAt" in query:
+        end = json.loads(query["endAt"])
+        items = [i for i in items if sort_key(i) is not None and sort_key(i) <= end]
+    if "limitToFirst" in query:
+        items = items[: int(query["limitToFirst"])]
+    if "limitToLast" in query:
+        items = items[-int(query["limitToLast"]) :]
+    return dict(items) or None
+
+
+def _resolve(value, now: int):
+    # Replaces server values the way the database does on write
+    if value == SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, dict):
+        return {key: _resolve(item, now) for key, item in value.items()}
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    standin = FirebaseStandIn(
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    standin.start()
+    print(f"Firebase stand-in on {standin.url}. Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.stop()
+        print(dict(standin.stats))
@@ -0,0 +1,288 @@
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+from auth import FirebaseAuthenticator
+from http_pool import get_shared_pool
+from metrics import get_registry
+from realtimedb import RealtimeDB, initialize_app
+from token_manager import TokenManager
+
+logger = logging.getLogger("agribot")
+
+_metrics = get_registry()
+_metrics.describe("agribot_tenants", "Users with a live client in the registry.")
+_metrics.describe(
+    "agribot_tenant_evictions_total", "Users evicted from the client registry."
+)
+
+
+class FirebaseClients:
+    """
+    Class to serve many users from one gateway process with shared Firebase clients.
+
+    The credentials are loaded and the Firebase app is initialized once, on
+    the first sign-in. Every user then gets a RealtimeDB handle built on
+    that app, which only holds the user's tokens and upload buffer, and a
+    TokenManager that shares one FirebaseAuthenticator. All requests go
+    through the same keep-alive pool, so adding a user costs a few
+    kilobytes and no handshakes once the pool is warm, and one background
+    thread refreshes the ID tokens of every user instead of a thread each.
+
+    Handles are kept in least recently used order. When there are more than
+    `max_users`, or a user has not been used for `idle_timeout` seconds,
+    the handle is flushed and dropped; its tokens stay cached on disk, so
+    signing the user in again needs no password and at most one refresh.
+
+    Attributes:
+        pool: The connection pool shared by all users.
+        auth: The FirebaseAuthenticator shared by the token managers.
+        app: The Firebase app shared by the handles, None until the first sign-in.
+        max_users: The maximum number of users kept at once.
+        idle_timeout: Seconds after which an unused user is evicted, None to never.
+        token_dir: The directory the tokens of every user are cached in.
+        batch_size: The batch size of the handles.
+        max_linger: The maximum linger of the handles.
+        wire_schema: The compact wire schema version of the handles, None for verbose.
+        stats: Counters for sign-ins, cache hits, evictions and token refreshes.
+
+    Methods:
+        sign_in: Returns the handle of a user, signing in if needed.
+        get: Returns the handle of a user that is signed in.
+        release: Flushes and drops the handle of a user.
+        evict_idle: Drops the users idle for longer than `idle_timeout`.
+        start: Starts the token refresh thread.
+        stop: Stops the token refresh thread and flushes every handle.
+    """
+
+    def __init__(
+        self,
+        pool=None,
+        max_users: int = 100,
+        idle_timeout: float = None,
+        token_dir: str = os.path.join("~", ".agribot", "tokens"),
+        batch_size: int = 10,
+        max_linger: float = 5.0,
+        refresh_margin: float = 300.0,
+        wire_schema: int = None,
+    ) -> None:
+        self.pool = pool if pool is not None else get_shared_pool()
+        self.auth = FirebaseAuthenticator(pool=self.pool)
+        self.app = None
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.token_dir = os.path.expanduser(token_dir)
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.refresh_margin = refresh_margin
+        self.wire_schema = wire_schema
+        self.stats = {"sign_ins": 0, "hits": 0, "evicted": 0, "refreshes": 0}
+        self._tenants = collections.OrderedDict()  # email -> _Tenant, oldest first
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        _metrics.callback("agribot_tenants", lambda: len(self))
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    def sign_in(self, email: str, password: str = None) -> RealtimeDB:
+        """
+        Returns the handle of a user, signing in if they have none.
+
+        The cached session is tried first, so the password is only needed
+        the first time a user signs in on this gateway.
+
+        Args:
+            email (str): The user's email address.
+            password (str): The user's password, None to rely on the cached session.
+
+        Returns:
+            RealtimeDB: The handle of the user.
+        """
+        handle = self.get(email)
+        if handle is not None:
+            return handle
+        tokens = TokenManager(
+            self.auth,
+            cache_path=os.path.join(self.token_dir, _token_file(email)),
+            refresh_margin=self.refresh_margin,
+        )
+        if not tokens.load(email):
+            if password is None:
+                raise Exception(
+                    f"There was an error signing in {email}: no cached session and no password."
+                )
+            tokens.sign_in(email, password)
+        with self._lock:
+            if self.app is None:
+                self.app = initialize_app(self.auth.get_firebase_config(), self.pool)
+            tenant = self._tenants.get(email)
+            if tenant is None:
+                # Built under the lock so a concurrent sign-in reuses it
+                handle = RealtimeDB(
+                    tokens.user_info,
+                    batch_size=self.batch_size,
+                    max_linger=self.max_linger,
+                    pool=self.pool,
+                    app=self.app,
+                    wire_schema=self.wire_schema,
+                )
+                tokens.subscribe(lambda id_token: setattr(handle, "id_token", id_token))
+                tenant = self._tenants[email] = _Tenant(handle, tokens)
+                self.stats["sign_ins"] += 1
+            tenant.last_used = time.monotonic()
+            evicted = self._take_over_limit()
+        self._wake.set()  # The refresh thread picks up the new expiry
+        self._drop(evicted)
+        return tenant.handle
+
+    def get(self, email: str) -> RealtimeDB:
+        """
+        Returns the handle of a user that is signed in and marks it as used.
+
+        Args:
+            email (str): The user's email address.
+
+        Returns:
+            RealtimeDB: The handle, or None if the user is not signed in or was evicted.
+        """
+        with self._lock:
+            tenant = self._tenants.get(email)
+            if tenant is None:
+                return None
+            self._tenants.move_to_end(email)
+            tenant.last_used = time.monotonic()
+            self.stats["hits"] += 1
+            return tenant.handle
+
+    def release(self, email: str) -> None:
+        """
+        Flushes and drops the handle of a user.
+
+        Args:
+            email (str): The user's email address.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            tenant = self._tenants.pop(email, None)
+        if tenant is not None:
+            self._drop([(email, tenant)])
+
+    def evict_idle(self, now: float = None) -> int:
+        """
+        Flushes and drops the users that were not used for `idle_timeout` seconds.
+
+        Args:
+            now (float): The current time.monotonic(), defaults to now.
+
+        Returns:
+            int: The number of users evicted.
+        """
+        if self.idle_timeout is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        evicted = []
+        with self._lock:
+            for email, tenant in list(self._tenants.items()):
+                if now - tenant.last_used < self.idle_timeout:
+                    break  # The rest were used more recently
+                evicted.append((email, self._tenants.pop(email)))
+        self._drop(evicted)
+        return len(evicted)
+
+    def start(self) -> None:
+        """
+        Starts the thread that refreshes the ID tokens of every user and evicts idle ones.
+
+        Returns:
+            None
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="agribot-tenants", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the refresh thread and flushes the buffered readings of every user.
+
+        Returns:
+            None
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
+        with self._lock:
+            tenants = list(self._tenants.items())
+            self._tenants.clear()
+        self._drop(tenants, count=False)
+
+    def _take_over_limit(self) -> list:
+        # Must be called with self._lock held
+        evicted = []
+        while len(self._tenants) > self.max_users:
+            evicted.append(self._tenants.popitem(last=False))
+        return evicted
+
+    def _drop(self, tenants: list, count: bool = True) -> None:
+        # Flushing needs the network, so it happens outside the lock
+        for email, tenant in tenants:
+            try:
+                tenant.handle.flush()
+            except Exception as e:
+                logger.warning("Could not flush the readings of %s: %s", email, e)
+            if count:
+                self.stats["evicted"] += 1
+                _metrics.inc("agribot_tenant_evictions_total")
+
+    def _refresh_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.clear()
+            self.evict_idle()
+            now = time.time()
+            with self._lock:
+                tenants = list(self._tenants.values())
+            wake_at = now + (self.idle_timeout or 3600.0)
+            for tenant in tenants:
+                due = max(
+                    tenant.tokens.expires_at - self.refresh_margin, tenant.retry_at
+                )
+                if due > now:
+                    wake_at = min(wake_at, due)
+                    continue
+                try:
+                    tenant.tokens.refresh()
+                    tenant.retry_delay = 5.0
+                    self.stats["refreshes"] += 1
+                except Exception as e:
+                    # The old token stays valid for up to refresh_margin seconds
+                    logger.warning("Token refresh failed: %s", e)
+                    tenant.retry_at = now + tenant.retry_delay
+                    tenant.retry_delay = min(tenant.retry_delay * 2, 60.0)
+                    wake_at = min(wake_at, tenant.retry_at)
+            self._wake.wait(max(0.0, wake_at - time.time()))
+
+
+class _Tenant:
+    # The handle and token manager of one user, and when it was last used
+    __slots__ = ("handle", "tokens", "last_used", "retry_at", "retry_delay")
+
+    def __init__(self, handle: RealtimeDB, tokens: TokenManager) -> None:
+        self.handle = handle
+        self.tokens = tokens
+        self.last_used = time.monotonic()
+        self.retry_at = 0.0
+        self.retry_delay = 5.0
+
+
+def _token_file(email: str) -> str:
+    # Emails are hashed so any address makes a safe file name
+    return hashlib.sha256(email.lower().encode()).hexdigest()[:16] + ".json"
@@ -1,5 +1,4 @@
 import os
-from firebase_admin import credentials
 
 
 class Credentials:
@@ -7,7 +6,7 @@ class Credentials:
     Class to manage credentials for Firebase and OpenAI.
 
     Attributes:
-        firebase_credentials (service_account.Credentials): Firestore credentials.
+        firebase_cert (credentials.Certificate): Firebase Admin credentials, built on first use.
         firebase_config (dict): Firebase configuration.
         openai_credentials (str): OpenAI API key.
         db_url (str): URL of the Firebase database.
@@ -19,16 +18,7 @@ class Credentials:
     """
 
     def __init__(self) -> None:
-        try:
-            self.firebase_cert = self.make_firebase_cert()
-        except Exception as e:
-            print(
-                """
-            There was an error initializing admin credentials.
-            It's only for development purposes. You can ignore this error.
-            Continuing with the program...
-            """
-            )
+        self._firebase_cert = None
         try:
             self.firebase_config = self.get_firebase_config()
         except Exception as e:
@@ -62,13 +52,39 @@ class Credentials:
             )
             exit(1)
 
-    def make_firebase_cert(self) -> credentials.Certificate:
+    @property
+    def firebase_cert(self):
+        """
+        Returns the Firebase Admin credentials, building them on first use.
+
+        firebase_admin is slow to import and the certificate is only needed
+        for development, so neither is loaded unless this is accessed.
+
+        Returns:
+            credentials.Certificate: The credentials, or None if they could not be built.
+        """
+        if self._firebase_cert is None:
+            try:
+                self._firebase_cert = self.make_firebase_cert()
+            except Exception as e:
+                print(
+                    """
+                There was an error initializing admin credentials.
+                It's only for development purposes. You can ignore this error.
+                Continuing with the program...
+                """
+                )
+        return self._firebase_cert
+
+    def make_firebase_cert(self) -> "credentials.Certificate":
         """
         Retrieves the Firestore credentials from the environment variables.
 
         Returns:
             credentials (service_account.Credentials): Firestore credentials.
         """
+        from firebase_admin import credentials
+
         credentials_dict = {
             "type": os.environ["FIREBASE_AUTH_TYPE"],
             "project_id": os.environ["FIREBASE_AUTH_PROJECT_ID"],
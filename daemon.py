@@ -0,0 +1,193 @@
+import argparse
+import json
+import logging
+import signal
+import sys
+import time
+import toml
+
+# AgribotAdmin arguments that may be set in the [agribot] section of the config file
+ADMIN_OPTIONS = (
+    "batch_size",
+    "max_linger",
+    "queue_size",
+    "backpressure",
+    "upload_workers",
+    "spool_path",
+    "replay_rate",
+    "http_pool_size",
+    "http_timeout",
+    "token_cache",
+    "use_filter",
+    "deadbands",
+    "relative_deadbands",
+    "heartbeat",
+    "rollup_windows",
+    "rollup_rate_hz",
+    "device_ports",
+    "frame_format",
+    "metrics_port",
+    "metrics_host",
+    "profile_dir",
+    "headless_interval",
+    "valve_control",
+    "valve_state_path",
+    "retention_days",
+    "retention_rollup",
+    "rollup_retention_days",
+    "adaptive_upload",
+    "wire_schema",
+    "compress_uploads",
+    "archive_dir",
+    "archive_max_mb",
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Class to format log records as one JSON object per line.
+
+    Attributes:
+        fields: Extra record attributes copied into the object when present.
+
+    Methods:
+        format: Formats a record as JSON.
+    """
+
+    fields = ("device", "count", "elapsed")
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        Formats a record as JSON.
+
+        Args:
+            record (logging.LogRecord): The log record.
+
+        Returns:
+            str: The JSON object.
+        """
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def load_config(path: str) -> dict:
+    """
+    Loads the [agribot] section of a TOML config file.
+
+    Args:
+        path (str): The path of the config file, or None.
+
+    Returns:
+        dict: The settings, empty if no file was given.
+    """
+    if not path:
+        return {}
+    return dict(toml.load(path).get("agribot", {}))
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the Agribot interface as an unattended service."
+    )
+    parser.add_argument("--config", help="TOML file with an [agribot] section")
+    parser.add_argument("--email", help="the account to upload as")
+    parser.add_argument("--secrets", help="secrets file, defaults to secrets.toml")
+    parser.add_argument(
+        "--random", action="store_true", default=None, help="send random data"
+    )
+    parser.add_argument("--port", help="serial port, found automatically if not set")
+    parser.add_argument("--ports", nargs="+", help='several ports, or "auto"')
+    parser.add_argument("--baud", type=int, help="baud rate, defaults to 9600")
+    parser.add_argument("--frame-format", choices=("ascii", "binary"))
+    parser.add_argument("--batch-size", type=int)
+    parser.add_argument("--workers", type=int, dest="upload_workers")
+    parser.add_argument("--spool", dest="spool_path")
+    parser.add_argument("--metrics-port", type=int)
+    parser.add_argument("--profile-dir")
+    parser.add_argument("--log-format", choices=("json", "text"))
+    parser.add_argument("--log-level")
+    return parser.parse_args(argv)
+
+
+def setup_logging(log_format: str = "json", level: str = "INFO") -> None:
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        # journald adds its own timestamps
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=level.upper(), handlers=[handler], force=True)
+
+
+def _terminate(signum, frame) -> None:
+    # Unwinds AgribotAdmin.run, whose finally block drains the queue;
+    # a second signal must not interrupt the drain
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise SystemExit(0)
+
+
+def main(argv: list = None) -> None:
+    """
+    Runs AgribotAdmin without prompts, configured by flags and a config file.
+
+    Flags override the config file. The password is only needed once: it is
+    read from the [agribot_auth] section of the secrets file, and later
+    starts use the cached session. SIGTERM stops ingesting and uploads what
+    is still queued; readings that could not be uploaded stay in the spool.
+
+    Args:
+        argv (list): The command line arguments, sys.argv[1:] by default.
+
+    Returns:
+        None
+    """
+    started = time.monotonic()
+    args = parse_args(argv)
+    config = load_config(args.config)
+    cli = {key: value for key, value in vars(args).items() if value is not None}
+    config.update(cli)
+    if "ports" in config:
+        ports = config.pop("ports")
+        config["device_ports"] = "auto" if ports in ("auto", ["auto"]) else ports
+    setup_logging(config.get("log_format", "json"), config.get("log_level", "INFO"))
+    log = logging.getLogger("agribot")
+    signal.signal(signal.SIGTERM, _terminate)
+
+    if not config.get("email"):
+        log.error("No email given, set it with --email or in the config file.")
+        sys.exit(2)
+
+    from admin import AgribotAdmin
+
+    admin = AgribotAdmin(
+        config["email"],
+        config.get("random", False),
+        config.get("port", False),
+        config.get("baud", False),
+        config.get("secrets", None),
+        interactive=False,
+        headless=True,
+        **{key: config[key] for key in ADMIN_OPTIONS if key in config},
+    )
+    log.info(
+        "Ready to ingest.", extra={"elapsed": round(time.monotonic() - started, 3)}
+    )
+    try:
+        admin.run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    log.info("Stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import collections
+import time
+from filters import SENSOR_CHANNELS
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+UNITS = {"humidity": "%", "temperature": "°C", "moisture": "%", "water_level": "%"}
+LABELS = {
+    "humidity": "Humidity",
+    "temperature": "Temperature",
+    "moisture": "Moisture",
+    "water_level": "Water Level",
+}
+
+
+def sparkline(values) -> str:
+    """
+    Draws values as a line of block characters, scaled to their own range.
+
+    Args:
+        values (Iterable): The values, oldest first.
+
+    Returns:
+        str: One character per value.
+    """
+    values = list(values)
+    if not values:
+        return ""
+    low = min(values)
+    span = max(values) - low
+    if span == 0:
+        return SPARK_CHARS[0] * len(values)
+    scale = (len(SPARK_CHARS) - 1) / span
+    return "".join(SPARK_CHARS[int((value - low) * scale)] for value in values)
+
+
+class Dashboard:
+    """
+    Class to show the latest readings of an IngestPipeline without slowing it down.
+
+    The dashboard is a Rich renderable that only reads the pipeline's latest
+    state when Live refreshes it, at a fixed frame rate on Live's own thread,
+    so the amount of rendering does not depend on the sensor rate. The table
+    is built once per set of devices and its cells are updated in place.
+    Every frame with a new reading adds it to a bounded history per device
+    and channel, which feeds a sparkline and the min and max of the recent
+    values. Rich is only imported to render, so headless mode runs without it.
+
+    Attributes:
+        pipeline: The IngestPipeline whose latest readings are shown.
+        stats_panel: Optional callable returning a renderable shown under the readings.
+        history: The number of readings kept per channel for the trend column.
+        stats_interval: Seconds between refreshes of the stats panel.
+
+    Methods:
+        refresh: Updates the cells from the pipeline's latest readings.
+        summary: Returns a one-line plain text summary, for headless mode.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        stats_panel=None,
+        history: int = 60,
+        stats_interval: float = 1.0,
+    ) -> None:
+        self.pipeline = pipeline
+        self.stats_panel = stats_panel
+        self.history = history
+        self.stats_interval = stats_interval
+        self._devices = None
+        self._seen = {}
+        self._trends = {}
+        self._cells = {}
+        self._table = None
+        self._stats = None
+        self._stats_at = 0.0
+
+    def __rich__(self):
+        from rich.console import Group
+        from rich.text import Text
+
+        self.refresh()
+        if self._table is None:
+            body = Text("Waiting for data...", style="dim")
+        else:
+            body = self._table
+        return Group(body, self._stats) if self._stats is not None else body
+
+    def refresh(self) -> None:
+        """
+        Updates the cells from the pipeline's latest readings.
+
+        Returns:
+            None
+        """
+        readings = dict(self.pipeline.latest_by_device)
+        if readings and list(readings) != self._devices:
+            self._build(list(readings))
+        for device, reading in readings.items():
+            if reading is self._seen.get(device):
+                continue  # Nothing new from this device since the last frame
+            self._seen[device] = reading
+            cells = self._cells[device]
+            for channel in SENSOR_CHANNELS:
+                trend = self._trends[device][channel]
+                trend.append(reading[channel])
+                cells[channel][0].plain = f"{reading[channel]}{UNITS[channel]}"
+                cells[channel][
+                    1
+                ].plain = f"{sparkline(trend)} {min(trend):g}–{max(trend):g}"
+            cells["valve_status"][0].plain = reading.valve_status
+        if (
+            self.stats_panel is not None
+            and time.monotonic() - self._stats_at >= self.stats_interval
+        ):
+            self._stats = self.stats_panel()
+            self._stats_at = time.monotonic()
+
+    def _build(self, devices: list) -> None:
+        from rich.table import Table
+        from rich.text import Text
+
+        self._devices = devices
+        self._table = Table(show_header=True, header_style="bold magenta")
+        self._table.add_column("Parameter")
+        for device in devices:
+            name = device or "Value"
+            self._table.add_column(name, justify="right")
+            self._table.add_column("Trend", style="cyan", no_wrap=True)
+            if device not in self._trends:
+                self._trends[device] = {
+                    channel: collections.deque(maxlen=self.history)
+                    for channel in SENSOR_CHANNELS
+                }
+            self._cells[device] = {
+                key: (Text("-"), Text(""))
+                for key in SENSOR_CHANNELS + ("valve_status",)
+            }
+            self._seen.pop(device, None)
+        for key in SENSOR_CHANNELS + ("valve_status",):
+            row = [LABELS.get(key, "Valve Status")]
+            for device in devices:
+                row.extend(self._cells[device][key])
+            self._table.add_row(*row)
+
+    def summary(self) -> str:
+        """
+        Returns a one-line plain text summary of the latest readings and pipeline stats.
+
+        Returns:
+            str: The summary.
+        """
+        stats = self.pipeline.stats
+        parts = [
+            f"received={stats['received']}",
+            f"uploaded={stats['uploaded'] + stats['replayed']}",
+            f"failed={stats['failed']}",
+            f"dropped={stats['dropped'] + stats['coalesced']}",
+            f"queue={self.pipeline.queue_depth()}",
+            f"behind={self.pipeline.queue_age():.1f}s",
+        ]
+        for device, reading in dict(self.pipeline.latest_by_device).items():
+            values = " ".join(
+                f"{channel}={reading[channel]}" for channel in SENSOR_CHANNELS
+            )
+            parts.append(
+                f"[{device or 'sensor'}] {values} valve={reading.valve_status}"
+            )
+        return " ".join(parts)
@@ -0,0 +1,302 @@
+import logging
+import os
+import re
+import selectors
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from serial.tools import list_ports
+from frame_parser import BinaryFrameParser, FrameParser, negotiate_binary
+
+logger = logging.getLogger("agribot")
+
+
+def device_id_for_port(port: str) -> str:
+    """
+    Returns a stable device id for a serial port.
+
+    The USB serial number is used when the port reports one, so a board keeps
+    its id when it is plugged into another port; otherwise the port name is used.
+
+    Args:
+        port (str): The serial port, e.g. "/dev/ttyACM0" or "COM3".
+
+    Returns:
+        str: A device id that is safe to use as a Firebase key.
+    """
+    device_id = os.path.basename(port)
+    for info in list_ports.comports():
+        if info.device == port and info.serial_number:
+            device_id = info.serial_number
+            break
+    # Firebase keys must not contain . $ # [ ] or /
+    return re.sub(r"[.$#\[\]/]", "_", device_id)
+
+
+class MultiDeviceReader:
+    """
+    Class to read frames from several Arduinos in one thread.
+
+    All ports are opened non-blocking and registered with a selector, so a
+    single reader waits on every board at once and CPU use stays flat however
+    many boards are attached. Windows cannot select on serial handles, so
+    there the ports are polled instead.
+
+    A board that is unplugged or reset is closed and dropped from the
+    selector without disturbing the others, and reopened with a backoff of
+    up to `max_reconnect_delay` seconds, also under another port name if its
+    USB serial number shows up there. A board that was sending binary frames
+    is switched back in a worker thread, so the handshake never holds up the
+    reads from the other boards.
+
+    Attributes:
+        baud_rate: The baud rate used for every port.
+        ports: Maps device ids to their open serial.Serial objects.
+        parsers: Maps device ids to the FrameParser of their byte stream.
+        malformed: The number of malformed frames over all ports.
+        reconnects: The number of times a board was lost.
+        max_reconnect_delay: The longest wait in seconds between attempts to reopen a board.
+        on_reconnect: Optional callable taking the device id of a board that was reopened.
+
+    Methods:
+        read_frames: Waits for data and returns the frames that arrived.
+        use_binary: Switches every board that supports it to binary frames.
+        write: Writes a command to one board.
+        take_acks: Returns the command acknowledgements received from the boards.
+        close: Closes all ports.
+    """
+
+    def __init__(
+        self, ports, baud_rate: int = 9600, max_reconnect_delay: float = 5.0
+    ) -> None:
+        self.baud_rate = baud_rate
+        self.max_reconnect_delay = max_reconnect_delay
+        if not isinstance(ports, dict):
+            ports = {device_id_for_port(port): port for port in ports}
+        self.ports = {}
+        self.parsers = {}
+        self.reconnects = 0
+        self.on_reconnect = None
+        self._paths = dict(ports)
+        self._fds = {}
+        self._binary = {}  # Device id -> handshake timeout, for boards sending binary
+        self._retry = {}  # Device id -> (time of the next attempt, delay)
+        self._negotiating = {}  # Device id -> (port, serial, delay, future)
+        self._executor = None
+        self._selector = selectors.DefaultSelector() if os.name != "nt" else None
+        for device_id in ports:
+            self._open(device_id, self._paths[device_id])
+
+    def read_frames(self, timeout: float = 1.0) -> list:
+        """
+        Waits for data on any port and returns the frames that arrived.
+
+        Boards that were lost are reopened first when their backoff is over.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            list: (device_id, reading) tuples in arrival order per device.
+        """
+        if self._retry or self._negotiating:
+            self._reopen()
+        if not self.ports:
+            time.sleep(min(timeout, 0.5))
+            return []
+        if self._selector is not None:
+            ready = [key.data for key, _ in self._selector.select(timeout)]
+        else:
+            ready = []
+            for device_id, ser in list(self.ports.items()):
+                try:
+                    if ser.in_waiting:
+                        ready.append(device_id)
+                except (serial.SerialException, OSError):
+                    self._drop(device_id)
+            if not ready:
+                time.sleep(min(timeout, 0.01))
+        frames = []
+        for device_id in ready:
+            ser = self.ports.get(device_id)
+            if ser is None:
+                continue
+            try:
+                readings = self.parsers[device_id].read(ser)
+            except (serial.SerialException, OSError):
+                self._drop(device_id)  # Unplugged or reset
+                continue
+            for reading in readings:
+                frames.append((device_id, reading))
+        return frames
+
+    def use_binary(self, timeout: float = 5.0) -> list:
+        """
+        Switches every board that supports it to binary frames.
+
+        The handshakes run in parallel, so boards with older sketches only
+        cost one timeout in total.
+
+        Args:
+            timeout (float): Seconds to wait for each board's acknowledgement.
+
+        Returns:
+            list: The device ids of the boards now sending binary frames.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.ports) or 1) as executor:
+            results = dict(
+                zip(
+                    self.ports,
+                    executor.map(
+                        lambda ser: negotiate_binary(ser, timeout), self.ports.values()
+                    ),
+                )
+            )
+        binary = []
+        for device_id, pending in results.items():
+            if pending is not None:
+                self.parsers[device_id] = BinaryFrameParser(pending)
+                self._binary[device_id] = timeout
+                binary.append(device_id)
+        return binary
+
+    def write(self, device_id: str, payload: bytes) -> None:
+        """
+        Writes a command to one board.
+
+        Args:
+            device_id (str): The device id of the board.
+            payload (bytes): The command bytes.
+
+        Returns:
+            None
+        """
+        ser = self.ports.get(device_id)
+        if ser is None:
+            raise serial.SerialException(f"{device_id} is reconnecting.")
+        ser.write(payload)
+
+    def take_acks(self) -> list:
+        """
+        Returns the command acknowledgements received since the last call.
+
+        Returns:
+            list: (device_id, fields) tuples.
+        """
+        acks = []
+        for device_id, parser in self.parsers.items():
+            while parser.acks:
+                acks.append((device_id, parser.acks.popleft()))
+        return acks
+
+    @property
+    def malformed(self) -> int:
+        """
+        Returns the number of malformed frames over all ports.
+
+        Returns:
+            int: The number of truncated or unparseable frames.
+        """
+        return sum(parser.malformed for parser in self.parsers.values())
+
+    def close(self) -> None:
+        """
+        Closes all ports.
+
+        Returns:
+            None
+        """
+        if self._selector is not None:
+            self._selector.close()
+        for _, ser, _, _ in self._negotiating.values():
+            ser.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for ser in self.ports.values():
+            ser.close()
+        self.ports.clear()
+        self._retry.clear()
+        self._negotiating.clear()
+
+    def _open(self, device_id: str, port: str, delay: float = 0.5) -> bool:
+        # Returns False while the board is switched back to binary frames
+        ser = serial.Serial(port, self.baud_rate, timeout=0)
+        if device_id in self._binary:
+            # The board restarted in ASCII mode when the port was opened
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=len(self._paths), thread_name_prefix="agribot-handshake"
+                )
+            future = self._executor.submit(
+                negotiate_binary, ser, self._binary[device_id]
+            )
+            self._negotiating[device_id] = (port, ser, delay, future)
+            return False
+        self._attach(device_id, port, ser, FrameParser())
+        return True
+
+    def _attach(self, device_id: str, port: str, ser, parser) -> None:
+        previous = self.parsers.get(device_id)
+        if previous is not None:
+            parser.malformed = previous.malformed
+        self.ports[device_id] = ser
+        self.parsers[device_id] = parser
+        self._paths[device_id] = port
+        if self._selector is not None:
+            self._fds[device_id] = ser.fileno()
+            self._selector.register(
+                self._fds[device_id], selectors.EVENT_READ, device_id
+            )
+
+    def _drop(self, device_id: str) -> None:
+        ser = self.ports.pop(device_id)
+        if self._selector is not None:
+            self._selector.unregister(self._fds.pop(device_id))
+        try:
+            ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.reconnects += 1
+        self._retry[device_id] = (time.monotonic() + 0.5, 0.5)
+        logger.warning("Lost the connection to %s, reconnecting.", device_id)
+
+    def _reopen(self) -> None:
+        now = time.monotonic()
+        for device_id, (port, ser, delay, future) in list(self._negotiating.items()):
+            if not future.done():
+                continue
+            del self._negotiating[device_id]
+            try:
+                pending = future.result()
+            except (serial.SerialException, OSError):
+                ser.close()
+                delay = min(delay * 2, self.max_reconnect_delay)
+                self._retry[device_id] = (now + delay, delay)
+                continue
+            parser = FrameParser() if pending is None else BinaryFrameParser(pending)
+            self._attach(device_id, port, ser, parser)
+            self._reconnected(device_id, port)
+        for device_id, (retry_at, delay) in list(self._retry.items()):
+            if now < retry_at:
+                continue
+            port = self._paths[device_id]
+            if not os.path.exists(port) and os.name != "nt":
+                # Plugged back in under another name, found by its serial number
+                for info in list_ports.comports():
+                    if device_id_for_port(info.device) == device_id:
+                        port = info.device
+                        break
+            del self._retry[device_id]
+            try:
+                opened = self._open(device_id, port, delay)
+            except (serial.SerialException, OSError):
+                delay = min(delay * 2, self.max_reconnect_delay)
+                self._retry[device_id] = (now + delay, delay)
+                continue
+            if opened:
+                self._reconnected(device_id, port)
+
+    def _reconnected(self, device_id: str, port: str) -> None:
+        logger.info("Reconnected to %s on %s.", device_id, port)
+        if self.on_reconnect is not None:
+            self.on_reconnect(device_id)
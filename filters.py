@@ -0,0 +1,102 @@
+import math
+import time
+
+SENSOR_CHANNELS = ("humidity", "temperature", "moisture", "water_level")
+
+
+class DeadbandFilter:
+    """
+    Class to drop readings that did not change meaningfully since the last upload.
+
+    A reading passes when any channel moved by more than its deadband, which is
+    the larger of the absolute deadband and the relative deadband times the last
+    uploaded value, or when a channel became unreadable (NaN) or readable
+    again. The valve_status is only passed on transitions. A heartbeat
+    forces a reading and the valve_status through every so often, so the
+    dashboard can tell a quiet sensor from a dead one.
+
+    Attributes:
+        absolute: Per-channel absolute deadbands, in the channel's unit.
+        relative: Per-channel relative deadbands, as a fraction of the last uploaded value.
+        heartbeat: Seconds after which a reading is passed even if nothing changed.
+
+    Methods:
+        accept: Returns what of a reading should be uploaded.
+        reset: Forgets the last uploaded values so the next reading passes.
+    """
+
+    DEFAULT_ABSOLUTE = {
+        "humidity": 1.0,
+        "temperature": 0.5,
+        "moisture": 2.0,
+        "water_level": 2.0,
+    }
+
+    def __init__(
+        self, absolute: dict = None, relative: dict = None, heartbeat: float = 60.0
+    ) -> None:
+        self.absolute = dict(self.DEFAULT_ABSOLUTE, **(absolute or {}))
+        self.relative = {channel: 0.0 for channel in SENSOR_CHANNELS}
+        self.relative.update(relative or {})
+        self.heartbeat = heartbeat
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets the last uploaded values so the next reading passes.
+
+        Returns:
+            None
+        """
+        self._last_data = None
+        self._last_valve_status = None
+        self._last_sent_at = float("-inf")
+        self._last_valve_sent_at = float("-inf")
+
+    def accept(self, data, valve_status: str) -> tuple:
+        """
+        Returns what of a reading should be uploaded.
+
+        Args:
+            data (Reading): The reading.
+            valve_status (str): The valve_status reported with the reading.
+
+        Returns:
+            tuple: (data, valve_status), where data is None if the reading is
+                filtered out and valve_status is None if it did not change.
+        """
+        now = time.monotonic()
+        valve_due = (
+            valve_status != self._last_valve_status
+            or now - self._last_valve_sent_at >= self.heartbeat
+        )
+        if not (
+            valve_due
+            or now - self._last_sent_at >= self.heartbeat
+            or self._changed(data)
+        ):
+            return None, None
+        self._last_data = data
+        self._last_sent_at = now
+        if not valve_due:
+            return data, None
+        self._last_valve_status = valve_status
+        self._last_valve_sent_at = now
+        return data, valve_status
+
+    def _changed(self, data) -> bool:
+        if self._last_data is None:
+            return True
+        for channel in SENSOR_CHANNELS:
+            last = self._last_data[channel]
+            value = data[channel]
+            if not (math.isfinite(last) and math.isfinite(value)):
+                # NaN compares unequal to everything, so a failed read is only
+                # a change when it starts or ends
+                if math.isfinite(last) != math.isfinite(value):
+                    return True
+                continue
+            band = max(self.absolute[channel], self.relative[channel] * abs(last))
+            if abs(value - last) > band:
+                return True
+        return False
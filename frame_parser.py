@@ -0,0 +1,403 @@
+import binascii
+import collections
+import re
+import struct
+import time
+from reading import Reading, get_clock
+
+# Binary frame: magic, sequence number, humidity and temperature in hundredths,
+# moisture, water level and valve as bytes, then a CRC-16/CCITT-FALSE over
+# everything between the magic and the CRC. Little-endian, 13 bytes.
+BINARY_MAGIC = b"\xaa\x55"
+BINARY_FRAME = struct.Struct("<2sHHhBBBH")
+HUMIDITY_NAN = 0xFFFF
+TEMPERATURE_NAN = -0x8000
+# "<ACK,...>" replies to host commands, which sensors.ino sends in both modes
+ACK_FRAME = re.compile(rb"<ACK,([^<>]*)>")
+# sensors.ino waits this many seconds after every frame
+FRAME_INTERVAL = 0.1
+
+
+def parse_frame(line: str, captured: float = None) -> Reading:
+    """
+    Parses a "<humidity,temperature,moisture,water_level,valve>" frame sent by sensors.ino.
+
+    The valve is reported as "ON"/"OFF" by the sketch, "1"/"0" is accepted as well.
+
+    Args:
+        line (str): The decoded line, with or without surrounding whitespace.
+        captured (float): The capture time in seconds since the epoch, defaults to now.
+
+    Returns:
+        Reading: The reading, or None if the line is not a valid frame.
+    """
+    line = line.strip()
+    if line.startswith("<") and line.endswith(">"):
+        parts = line[1:-1].split(",")  # Remove the angle brackets
+        if len(parts) == 5:
+            try:
+                return Reading(
+                    float(parts[0]),
+                    float(parts[1]),
+                    float(parts[2]),
+                    float(parts[3]),
+                    "on" if parts[4] in ("1", "ON") else "off",
+                    get_clock().now() if captured is None else captured,
+                )
+            except ValueError:
+                pass
+    return None
+
+
+class FrameParser:
+    """
+    Class to parse "<...>" frames out of a raw serial byte stream in bulk.
+
+    Whatever bytes are available are scanned in one regex pass, so a single
+    read can yield many frames and the parser keeps up at high baud rates.
+    A frame split across two reads is completed on the next one; truncated,
+    garbled and oversized frames are counted instead of silently discarded.
+    Acknowledgements of host commands are kept in `acks` rather than
+    returned as readings. The last frame of a chunk is stamped with the
+    calibrated monotonic clock when the chunk is fed and the frames before
+    it one `interval` earlier each, or closer together where that would
+    reach back before the previous chunk, so a backlog read at once keeps
+    distinct, ordered capture times.
+
+    Attributes:
+        max_frame: The longest frame body accepted, in bytes.
+        interval: Seconds between the frames of the sketch.
+        frames: The number of frames parsed.
+        malformed: The number of frames that were truncated or could not be parsed.
+        acks: The fields of the "<ACK,...>" frames received and not yet taken.
+
+    Methods:
+        feed: Parses a chunk of bytes and returns the complete frames in it.
+        read: Reads whatever a serial port has waiting and parses it.
+    """
+
+    FRAME = re.compile(rb"<([^<>]*)>")
+
+    def __init__(self, max_frame: int = 128, interval: float = FRAME_INTERVAL) -> None:
+        self.max_frame = max_frame
+        self.interval = interval
+        self.frames = 0
+        self.malformed = 0
+        self.acks = collections.deque(maxlen=64)
+        self._clock = get_clock()
+        self._buffer = b""
+        self._captured = None  # Capture time of the last frame
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Parses a chunk of bytes and returns the complete frames in it.
+
+        Args:
+            chunk (bytes): The bytes read from the serial port.
+
+        Returns:
+            list: Readings in the order they were received.
+        """
+        captured = self._clock.now()
+        buffer = self._buffer + chunk if self._buffer else bytes(chunk)
+        bodies = self.FRAME.findall(buffer)
+        end = buffer.rfind(b">") + 1
+        # Every "<" before the last complete frame either opened a frame or
+        # was cut off by the next one
+        self.malformed += buffer.count(b"<", 0, end) - len(bodies)
+        readings = []
+        append = readings.append
+        for body in bodies:
+            parts = body.split(b",")
+            if parts[0] == b"ACK":
+                self.acks.append(
+                    [part.decode("ascii", "replace") for part in parts[1:]]
+                )
+                continue
+            if len(parts) != 5 or len(body) > self.max_frame:
+                self.malformed += 1
+                continue
+            try:
+                append(
+                    Reading(
+                        float(parts[0]),
+                        float(parts[1]),
+                        float(parts[2]),
+                        float(parts[3]),
+                        "on" if parts[4].strip() in (b"1", b"ON") else "off",
+                        captured,
+                    )
+                )
+            except ValueError:
+                self.malformed += 1
+        start = buffer.find(b"<", end)
+        if start == -1:
+            self._buffer = b""  # Only noise or line endings left
+        else:
+            last = buffer.rfind(b"<")
+            self.malformed += buffer.count(b"<", start, last)
+            self._buffer = buffer[last:]
+            if len(self._buffer) > self.max_frame + 2:
+                self.malformed += 1
+                self._buffer = b""
+        if len(readings) > 1:
+            _space(readings, captured, self._captured, self.interval)
+        if readings:
+            self._captured = captured
+        self.frames += len(readings)
+        return readings
+
+    def read(self, ser) -> list:
+        """
+        Reads whatever a serial port has waiting and parses it.
+
+        Blocks for up to the port's timeout if nothing is waiting.
+
+        Args:
+            ser (serial.Serial): The open serial port.
+
+        Returns:
+            list: Readings in the order they were received.
+        """
+        return self.feed(ser.read(max(ser.in_waiting, 1)))
+
+
+def encode_binary_frame(
+    sequence: int,
+    humidity: float,
+    temperature: float,
+    moisture: int,
+    water_level: int,
+    valve_on: bool,
+) -> bytes:
+    """
+    Encodes a reading the way sensors.ino does in binary mode.
+
+    Args:
+        sequence (int): The frame sequence number, wrapping at 65536.
+        humidity (float): The humidity in percent, NaN if the sensor read failed.
+        temperature (float): The temperature in °C, NaN if the sensor read failed.
+        moisture (int): The soil moisture in percent.
+        water_level (int): The water level in percent.
+        valve_on (bool): Whether the valve is open.
+
+    Returns:
+        bytes: The 13 byte frame.
+    """
+    body = BINARY_FRAME.pack(
+        BINARY_MAGIC,
+        sequence & 0xFFFF,
+        HUMIDITY_NAN if humidity != humidity else round(humidity * 100),
+        TEMPERATURE_NAN if temperature != temperature else round(temperature * 100),
+        moisture,
+        water_level,
+        1 if valve_on else 0,
+        0,
+    )
+    crc = binascii.crc_hqx(body[2:-2], 0xFFFF)
+    return body[:-2] + struct.pack("<H", crc)
+
+
+def encode_valve_command(sequence: int, state: str) -> bytes:
+    """
+    Encodes a valve command the way sensors.ino reads it.
+
+    The board switches the relay and answers "<ACK,V,sequence,mode,pump>",
+    mode being ON, OFF or AUTO and pump the resulting pump state.
+
+    Args:
+        sequence (int): The command sequence number, echoed in the acknowledgement.
+        state (str): "1" to force the pump on, "0" to force it off, "A" for automatic.
+
+    Returns:
+        bytes: The command line.
+    """
+    return b"!V%d,%s\n" % (sequence & 0xFFFF, state.encode())
+
+
+def negotiate_binary(ser, timeout: float = 5.0, retry: float = 0.5):
+    """
+    Asks sensors.ino to switch to binary frames and waits for its acknowledgement.
+
+    The request is repeated every `retry` seconds, so it also reaches a board
+    that is still booting after the port was opened: the sketch only reads
+    commands after the bootloader and the 2 s delay in setup(). Sketches
+    without binary support ignore the request and keep sending ASCII.
+
+    Args:
+        ser (serial.Serial): The open serial port.
+        timeout (float): Seconds to wait for the acknowledgement.
+        retry (float): Seconds between requests.
+
+    Returns:
+        bytes: The bytes received after the acknowledgement, which already belong
+            to the binary stream, or None if the board kept sending ASCII.
+    """
+    ser.reset_input_buffer()
+    deadline = time.monotonic() + timeout
+    sent_at = None
+    received = b""
+    while time.monotonic() < deadline:
+        if sent_at is None or time.monotonic() - sent_at >= retry:
+            ser.write(b"!B\n")
+            ser.flush()
+            sent_at = time.monotonic()
+        chunk = ser.read(max(ser.in_waiting, 1))
+        if not chunk:
+            time.sleep(0.01)  # Non-blocking ports return immediately
+            continue
+        received += chunk
+        if b"<ACK,B>" in received:
+            return received.split(b"<ACK,B>", 1)[1].lstrip(b"\r\n")
+    return None
+
+
+class BinaryFrameParser:
+    """
+    Class to decode the compact binary frames sent by sensors.ino in binary mode.
+
+    Frames are located by their magic bytes and decoded with a precompiled
+    struct straight from a memoryview of the buffer. The CRC rejects corrupted
+    frames and the sequence numbers reveal frames lost on the line.
+    Acknowledgements of host commands arrive as "<ACK,...>" text between
+    frames and are kept in `acks`. Capture times are spaced back from the
+    last frame of a chunk like FrameParser does, by the sequence numbers,
+    so frames lost on the line leave their gap.
+
+    Attributes:
+        interval: Seconds between the frames of the sketch.
+        frames: The number of frames decoded.
+        malformed: The number of frames rejected by the CRC check.
+        dropped: The number of frames missing according to the sequence numbers.
+        acks: The fields of the "<ACK,...>" frames received and not yet taken.
+
+    Methods:
+        feed: Decodes a chunk of bytes and returns the complete frames in it.
+        read: Reads whatever a serial port has waiting and decodes it.
+    """
+
+    def __init__(self, pending: bytes = b"", interval: float = FRAME_INTERVAL) -> None:
+        self.interval = interval
+        self.frames = 0
+        self.malformed = 0
+        self.dropped = 0
+        self.acks = collections.deque(maxlen=64)
+        self._clock = get_clock()
+        self._buffer = pending  # Bytes read past the handshake acknowledgement
+        self._last_sequence = None
+        self._captured = None  # Capture time of the last frame
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Decodes a chunk of bytes and returns the complete frames in it.
+
+        Args:
+            chunk (bytes): The bytes read from the serial port.
+
+        Returns:
+            list: Readings in the order they were received.
+        """
+        captured = self._clock.now()
+        buffer = self._buffer + chunk if self._buffer else bytes(chunk)
+        view = memoryview(buffer)
+        size = BINARY_FRAME.size
+        readings = []
+        sequences = []
+        scanned = 0  # Bytes before this belong to decoded frames
+        position = buffer.find(BINARY_MAGIC)
+        while position != -1 and position + size <= len(buffer):
+            _, sequence, humidity, temperature, moisture, water_level, valve, crc = (
+                BINARY_FRAME.unpack_from(view, position)
+            )
+            if (
+                binascii.crc_hqx(view[position + 2 : position + size - 2], 0xFFFF)
+                != crc
+            ):
+                # Not a frame after all, or a corrupted one: resync on the next magic
+                self.malformed += 1
+                position = buffer.find(BINARY_MAGIC, position + 1)
+                continue
+            if self._last_sequence is not None:
+                gap = (sequence - self._last_sequence - 1) & 0xFFFF
+                if gap < 0x8000:  # A larger gap means the board restarted
+                    self.dropped += gap
+            self._last_sequence = sequence
+            if position > scanned:
+                self._take_acks(buffer, scanned, position)
+            scanned = position + size
+            sequences.append(sequence)
+            readings.append(
+                Reading(
+                    float("nan") if humidity == HUMIDITY_NAN else humidity / 100,
+                    (
+                        float("nan")
+                        if temperature == TEMPERATURE_NAN
+                        else temperature / 100
+                    ),
+                    float(moisture),
+                    float(water_level),
+                    "on" if valve else "off",
+                    captured,
+                )
+            )
+            position = buffer.find(BINARY_MAGIC, position + size)
+        if position == -1:
+            # Keep a trailing byte that may be the first half of the magic,
+            # or an acknowledgement that is not complete yet
+            end = self._take_acks(buffer, scanned, len(buffer))
+            start = buffer.rfind(b"<", max(end, len(buffer) - 32))
+            if start != -1 and b">" not in buffer[start:]:
+                self._buffer = buffer[start:]
+            else:
+                self._buffer = buffer[-1:] if buffer.endswith(BINARY_MAGIC[:1]) else b""
+        else:
+            self._take_acks(buffer, scanned, position)
+            self._buffer = buffer[position:]
+        view.release()
+        if len(readings) > 1:
+            offsets = [(sequences[-1] - s) & 0xFFFF for s in sequences]
+            if offsets[0] >= 0x8000:
+                offsets = None  # The board restarted within the chunk
+            _space(readings, captured, self._captured, self.interval, offsets)
+        if readings:
+            self._captured = captured
+        self.frames += len(readings)
+        return readings
+
+    def _take_acks(self, buffer: bytes, start: int, end: int) -> int:
+        # Returns the end of the last acknowledgement between start and end
+        last = start
+        for match in ACK_FRAME.finditer(buffer, start, end):
+            self.acks.append(match.group(1).decode("ascii", "replace").split(","))
+            last = match.end()
+        return last
+
+    def read(self, ser) -> list:
+        """
+        Reads whatever a serial port has waiting and decodes it.
+
+        Blocks for up to the port's timeout if nothing is waiting.
+
+        Args:
+            ser (serial.Serial): The open serial port.
+
+        Returns:
+            list: Readings in the order they were received.
+        """
+        return self.feed(ser.read(max(ser.in_waiting, 1)))
+
+
+def _space(
+    readings: list, captured: float, previous: float, interval: float, offsets=None
+) -> None:
+    # Stamps the frames of a chunk `offsets` frame intervals, by default
+    # one each, before the last one, which was captured at `captured`,
+    # keeping them after `previous`
+    last = len(readings) - 1
+    oldest = last if offsets is None else offsets[0]
+    step = interval
+    if previous is not None:
+        step = max(0.0, min(step, (captured - previous) / (oldest + 1)))
+    for index, reading in enumerate(readings):
+        offset = last - index if offsets is None else offsets[index]
+        reading.captured = captured - offset * step
@@ -0,0 +1,389 @@
+import itertools
+import sqlite3
+import threading
+import time
+from filters import SENSOR_CHANNELS
+from realtimedb import BACKFILL_NODE, push_key_for_time, push_key_time
+from wire import decode_reading
+
+COLUMNS = ("time",) + SENSOR_CHANNELS
+
+
+class SensorHistory:
+    """
+    Class to read the sensor history of a user through a local SQLite cache.
+
+    The first sync pages through the node oldest first with key-ordered
+    range queries and commits every page before fetching the next, so
+    memory stays bounded however long the history is. Later syncs only
+    fetch keys after the last one seen, minus `overlap` seconds to pick up
+    readings uploaded a little late. Readings uploaded later than that,
+    e.g. replayed from the spool hours after they were captured, are found
+    through the backfill log the pipeline writes with them, which lists the
+    key range of every late upload in upload order.
+    Queries are answered from the cache, indexed by capture time, and only
+    sync first when they reach past what was synced; otherwise they only
+    read the backfill log, so repeating a query costs one small request.
+    Results can be exported column by column to NumPy arrays, .npz files or
+    Parquet.
+
+    Attributes:
+        db: The RealtimeDB the history is read from.
+        path: The path of the SQLite cache file.
+        page_size: The number of readings fetched per request.
+        overlap: Seconds before the last synced key, or backfill log entry, that every
+            sync fetches again; more than the pipeline's BACKFILL_AGE.
+        conn: The SQLite connection, shared between threads behind a lock.
+
+    Methods:
+        sync: Fetches the readings added since the last sync.
+        query: Returns the readings in a time range.
+        arrays: Returns the readings in a time range as NumPy columns.
+        to_npz: Writes the readings in a time range to an .npz file.
+        to_parquet: Writes the readings in a time range to a Parquet file.
+        close: Closes the cache.
+    """
+
+    def __init__(
+        self,
+        db,
+        path: str = "agribot_history.db",
+        page_size: int = 1000,
+        overlap: float = 120.0,
+    ) -> None:
+        self.db = db
+        self.path = path
+        self.page_size = page_size
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS readings (
+                node TEXT NOT NULL,
+                push_key TEXT NOT NULL,
+                captured INTEGER NOT NULL,
+                timestamp INTEGER,
+                humidity REAL,
+                temperature REAL,
+                moisture REAL,
+                water_level REAL,
+                PRIMARY KEY (node, push_key)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS readings_captured ON readings (node, captured)"
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                node TEXT PRIMARY KEY,
+                last_key TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS backfill_seen (
+                node TEXT NOT NULL,
+                log_key TEXT NOT NULL,
+                PRIMARY KEY (node, log_key)
+            ) WITHOUT ROWID
+            """
+        )
+        self.conn.commit()
+
+    def sync(self, node: str = "sensor_data") -> int:
+        """
+        Fetches the readings added to a node since the last sync.
+
+        Args:
+            node (str): The node under the user, e.g. "sensor_data" or "devices/<id>/sensor_data".
+
+        Returns:
+            int: The number of readings fetched.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT last_key FROM sync_state WHERE node = ?", (node,)
+            ).fetchone()
+        # Read first: the log is written with the readings, so whatever it
+        # lists is already there for the first sync to fetch
+        fetched = self._backfill(node, fetch=row is not None)
+        last_key = row[0] if row is not None else ""
+        start_at = None
+        if last_key:
+            start_at = push_key_for_time(
+                max(0, push_key_time(last_key) - int(self.overlap * 1000))
+            )
+        while True:
+            synced_at = time.time()  # Everything written before this is in the page
+            page = self.db.get_sensor_range_for_user(
+                node, start_at=start_at, limit=self.page_size
+            )
+            rows = [_row(node, key, data) for key, data in page]
+            if page:
+                last_key = max(last_key, page[-1][0])
+            with self._lock:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row for row in rows if row is not None],
+                )
+                if len(page) < self.page_size:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                        (node, last_key, synced_at),
+                    )
+                elif page:
+                    # Progress of an interrupted first sync is kept
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                        (node, last_key, 0.0),
+                    )
+                self.conn.commit()
+            fetched += len(page)
+            if len(page) < self.page_size:
+                return fetched
+            start_at = page[-1][0]  # Inclusive, so the last key comes back once
+
+    def query(
+        self, start: float = None, end: float = None, node: str = "sensor_data"
+    ) -> list:
+        """
+        Returns the readings captured in a time range, syncing first only if needed.
+
+        Args:
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for now.
+            node (str): The node under the user.
+
+        Returns:
+            list: (time_ms, humidity, temperature, moisture, water_level) tuples, oldest first.
+        """
+        self._sync_for(end, node)
+        with self._lock:
+            return self._select(start, end, node).fetchall()
+
+    def arrays(
+        self, start: float = None, end: float = None, node: str = "sensor_data"
+    ) -> dict:
+        """
+        Returns the readings captured in a time range as NumPy columns.
+
+        Args:
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for now.
+            node (str): The node under the user.
+
+        Returns:
+            dict: Maps "time" (int64 milliseconds) and every channel (float64, NaN if
+                missing) to an array.
+        """
+        import numpy as np
+
+        self._sync_for(end, node)
+        with self._lock:
+            cursor = self._select(start, end, node)
+            # Rows are decoded straight into one buffer, without a list of tuples
+            values = np.fromiter(
+                (
+                    np.nan if value is None else value
+                    for value in itertools.chain.from_iterable(cursor)
+                ),
+                dtype=np.float64,
+            ).reshape(-1, len(COLUMNS))
+        columns = {"time": values[:, 0].astype(np.int64)}
+        for index, channel in enumerate(SENSOR_CHANNELS, start=1):
+            columns[channel] = np.ascontiguousarray(values[:, index])
+        return columns
+
+    def to_npz(
+        self,
+        path: str,
+        start: float = None,
+        end: float = None,
+        node: str = "sensor_data",
+    ) -> int:
+        """
+        Writes the readings captured in a time range to an .npz file, one array per column.
+
+        Args:
+            path (str): The output file.
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for now.
+            node (str): The node under the user.
+
+        Returns:
+            int: The number of readings written.
+        """
+        import numpy as np
+
+        columns = self.arrays(start, end, node)
+        np.savez(path, **columns)
+        return len(columns["time"])
+
+    def to_parquet(
+        self,
+        path: str,
+        start: float = None,
+        end: float = None,
+        node: str = "sensor_data",
+    ) -> int:
+        """
+        Writes the readings captured in a time range to a Parquet file.
+
+        Needs pyarrow, which is not installed with the requirements.
+
+        Args:
+            path (str): The output file.
+            start (float): The start in seconds since the epoch, inclusive, None for the beginning.
+            end (float): The end in seconds since the epoch, exclusive, None for now.
+            node (str): The node under the user.
+
+        Returns:
+            int: The number of readings written.
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("There was an error exporting to Parquet: install pyarrow.")
+        columns = self.arrays(start, end, node)
+        table = pyarrow.table(
+            {
+                "time": pyarrow.array(columns["time"]).cast(pyarrow.timestamp("ms")),
+                **{channel: columns[channel] for channel in SENSOR_CHANNELS},
+            }
+        )
+        pyarrow.parquet.write_table(table, path)
+        return table.num_rows
+
+    def close(self) -> None:
+        """
+        Closes the cache.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
+
+    def _sync_for(self, end: float, node: str) -> None:
+        # The cache answers for ranges that ended before the last sync,
+        # once the readings uploaded late into them are fetched
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT synced_at FROM sync_state WHERE node = ?", (node,)
+            ).fetchone()
+        if row is None or end is None or end > row[0]:
+            self.sync(node)
+        else:
+            self._backfill(node)
+
+    def _backfill(self, node: str, fetch: bool = True) -> int:
+        # Fetches the key ranges the log lists for the node since it was last
+        # read. Concurrent uploads may commit slightly out of key order, so
+        # the log is read again from `overlap` before the newest entry seen.
+        with self._lock:
+            newest = self.conn.execute(
+                "SELECT MAX(log_key) FROM backfill_seen WHERE node = ?", (node,)
+            ).fetchone()[0]
+        start_at = None
+        if newest is not None:
+            start_at = push_key_for_time(
+                max(0, push_key_time(newest) - int(self.overlap * 1000))
+            )
+        with self._lock:
+            seen = {
+                key
+                for key, in self.conn.execute(
+                    "SELECT log_key FROM backfill_seen WHERE node = ? AND log_key >= ?",
+                    (node, start_at or ""),
+                )
+            }
+            # Only what can be read again needs to be remembered
+            self.conn.execute(
+                "DELETE FROM backfill_seen WHERE node = ? AND log_key < ?",
+                (node, start_at or ""),
+            )
+            self.conn.commit()
+        fetched = 0
+        while True:
+            page = self.db.get_sensor_range_for_user(
+                BACKFILL_NODE, start_at=start_at, limit=self.page_size
+            )
+            for key, entry in page:
+                if (
+                    fetch
+                    and key not in seen
+                    and isinstance(entry, dict)
+                    and entry.get("node") == node
+                ):
+                    fetched += self._fetch_range(node, entry["start"], entry["end"])
+                seen.add(key)  # Pages overlap by one entry
+            with self._lock:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO backfill_seen VALUES (?, ?)",
+                    [(node, key) for key, _ in page],
+                )
+                self.conn.commit()
+            if len(page) < self.page_size:
+                return fetched
+            start_at = page[-1][0]
+
+    def _fetch_range(self, node: str, start_at: str, end_at: str) -> int:
+        fetched = 0
+        while True:
+            page = self.db.get_sensor_range_for_user(
+                node, start_at=start_at, end_at=end_at, limit=self.page_size
+            )
+            rows = [_row(node, key, data) for key, data in page]
+            with self._lock:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [row for row in rows if row is not None],
+                )
+                self.conn.commit()
+            fetched += len(page)
+            if len(page) < self.page_size:
+                return fetched
+            start_at = page[-1][0]
+
+    def _select(self, start: float, end: float, node: str):
+        start_ms = 0 if start is None else int(start * 1000)
+        end_ms = int((time.time() if end is None else end) * 1000)
+        return self.conn.execute(
+            "SELECT captured, humidity, temperature, moisture, water_level FROM readings"
+            " WHERE node = ? AND captured >= ? AND captured < ? ORDER BY captured",
+            (node, start_ms, end_ms),
+        )
+
+
+def _row(node: str, key: str, data) -> tuple:
+    if not isinstance(data, dict):
+        return None
+    try:
+        captured = push_key_time(key)
+    except ValueError:
+        data = decode_reading(data)
+        captured = data.get("timestamp")  # Not a push ID
+        if not isinstance(captured, int):
+            return None
+    else:
+        data = decode_reading(data, captured)
+    timestamp = data.get("timestamp")
+    return (
+        node,
+        key,
+        captured,
+        timestamp if isinstance(timestamp, int) else None,
+        *(_number(data.get(channel)) for channel in SENSOR_CHANNELS),
+    )
+
+
+def _number(value) -> float:
+    return float(value) if isinstance(value, (int, float)) else None
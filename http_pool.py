@@ -0,0 +1,146 @@
+import gzip
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    # requests has no session-wide timeout, and the firebase client never
+    # passes one, so the default is applied here for every request. Bodies
+    # are compressed here too, after the client has serialized them.
+
+    def __init__(self, timeout, compress_min=None, *args, **kwargs) -> None:
+        self.timeout = timeout
+        self.compress_min = compress_min
+        self.body_bytes = 0
+        self.sent_bytes = 0
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, bytes):
+            size = len(body)
+            if (
+                self.compress_min is not None
+                and size >= self.compress_min
+                and "Content-Encoding" not in request.headers
+            ):
+                body = gzip.compress(body, compresslevel=6)
+                request.body = body
+                request.headers["Content-Encoding"] = "gzip"
+                request.headers["Content-Length"] = str(len(body))
+            with self._lock:
+                self.body_bytes += size
+                self.sent_bytes += len(body)
+        return super().send(request, **kwargs)
+
+
+class HTTPPool:
+    """
+    Class to share keep-alive HTTP connections between the Firebase clients.
+
+    FirebaseAuthenticator and RealtimeDB send all their requests through the
+    same session, so a TCP and TLS handshake is only paid when the pool has no
+    idle connection to the host.
+
+    With `compress_min` set, request bodies of at least that many bytes are
+    sent gzip-compressed with "Content-Encoding: gzip". The Realtime
+    Database REST API does not document compressed request bodies, so this
+    is off by default and meant for gateways and proxies that accept them.
+
+    Attributes:
+        session: The requests.Session shared by the clients.
+        pool_connections: The number of hosts a connection pool is kept for.
+        pool_maxsize: The maximum number of connections kept alive per host.
+        timeout: The default (connect, read) timeout in seconds.
+        compress_min: The smallest request body that is compressed, None for none.
+
+    Methods:
+        stats: Returns request, handshake, connection reuse and byte counts.
+        close: Closes all pooled connections.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 4,
+        pool_maxsize: int = 10,
+        timeout: tuple = (5.0, 30.0),
+        max_retries: int = 3,
+        compress_min: int = None,
+    ) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.compress_min = compress_min
+        self._adapter = _TimeoutHTTPAdapter(
+            timeout,
+            compress_min,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+        )
+        self.session = requests.Session()
+        for scheme in ("http://", "https://"):
+            self.session.mount(scheme, self._adapter)
+
+    def stats(self) -> dict:
+        """
+        Returns request, handshake, connection reuse and byte counts.
+
+        Handshakes are the connections urllib3 had to open; every other
+        request went over a kept-alive connection. "body_bytes" counts the
+        request bodies as serialized, "sent_bytes" as sent after compression.
+
+        Returns:
+            dict: The "requests", "handshakes", "reused", "body_bytes" and "sent_bytes" counts.
+        """
+        total_requests = 0
+        handshakes = 0
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            total_requests += pool.num_requests
+            handshakes += pool.num_connections
+        return {
+            "requests": total_requests,
+            "handshakes": handshakes,
+            "reused": max(0, total_requests - handshakes),
+            "body_bytes": self._adapter.body_bytes,
+            "sent_bytes": self._adapter.sent_bytes,
+        }
+
+    def close(self) -> None:
+        """
+        Closes all pooled connections.
+
+        Returns:
+            None
+        """
+        self.session.close()
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool(**kwargs) -> HTTPPool:
+    """
+    Returns the process-wide HTTPPool, creating it on first use.
+
+    Args:
+        **kwargs: HTTPPool arguments, only used when the pool is created.
+
+    Returns:
+        HTTPPool: The shared pool.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = HTTPPool(**kwargs)
+        return _shared_pool
@@ -0,0 +1,431 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers a fast serial read up to a slow upload on a bad link
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+class Histogram:
+    """
+    Class to count observations in fixed buckets, like a Prometheus histogram.
+
+    Observing costs a bisect and a few additions under a lock, so it can sit
+    in the ingest loop; quantiles are estimated from the buckets when needed.
+
+    Attributes:
+        buckets: The upper bounds of the buckets, ascending.
+        counts: The number of observations per bucket, the last one above all bounds.
+        count: The number of observations.
+        sum: The sum of all observations.
+
+    Methods:
+        observe: Records an observation.
+        quantile: Estimates a quantile from the buckets.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """
+        Records an observation.
+
+        Args:
+            value (float): The observed value.
+
+        Returns:
+            None
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by interpolating within its bucket.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The estimate, or None if nothing was observed.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    Class to collect the counters, gauges and histograms of the process.
+
+    Metrics are created on first use and keyed by name and labels. Values
+    owned by other objects, like the pipeline stats, are read through
+    callbacks when the metrics are rendered instead of being copied.
+
+    Attributes:
+        counters: Maps (name, labels) to counter values.
+        histograms: Maps (name, labels) to Histogram objects.
+
+    Methods:
+        describe: Sets the help text of a metric.
+        inc: Increments a counter.
+        observe: Records an observation in a histogram.
+        timer: Context manager observing the seconds its block takes.
+        timed: Decorator observing the seconds every call takes.
+        callback: Registers a gauge or counter read from a callable.
+        unregister: Removes a callback metric.
+        histogram: Returns the histogram for a name and labels.
+        render: Returns all metrics in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self.histograms = {}
+        self._callbacks = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help: str) -> None:
+        """
+        Sets the help text of a metric.
+
+        Args:
+            name (str): The metric name.
+            help (str): The help text.
+
+        Returns:
+            None
+        """
+        self._help[name] = help
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increments a counter.
+
+        Args:
+            name (str): The counter name, ending in "_total".
+            value (float): The amount to add.
+            **labels: The label values.
+
+        Returns:
+            None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        """
+        Returns the histogram for a name and labels, creating it on first use.
+
+        Args:
+            name (str): The histogram name.
+            **labels: The label values.
+
+        Returns:
+            Histogram: The histogram.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Records an observation in a histogram.
+
+        Args:
+            name (str): The histogram name.
+            value (float): The observed value.
+            **labels: The label values.
+
+        Returns:
+            None
+        """
+        self.histogram(name, **labels).observe(value)
+
+    def timer(self, name: str, **labels):
+        """
+        Returns a context manager observing the seconds its block takes.
+
+        A block that raises is counted in a counter as well, named like the
+        histogram with "_errors_total" in place of "_seconds".
+
+        Args:
+            name (str): The histogram name.
+            **labels: The label values.
+
+        Returns:
+            _Timer: The context manager.
+        """
+        return _Timer(self, name, labels)
+
+    def timed(self, name: str, **labels):
+        """
+        Returns a decorator observing the seconds every call takes.
+
+        Args:
+            name (str): The histogram name.
+            **labels: The label values.
+
+        Returns:
+            Callable: The decorator.
+        """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def callback(
+        self, name: str, function, kind: str = "gauge", label: str = None
+    ) -> None:
+        """
+        Registers a gauge or counter whose value is read from a callable.
+
+        Args:
+            name (str): The metric name.
+            function (Callable): Returns a number, or a dict mapping values of `label` to numbers.
+            kind (str): "gauge" or "counter".
+            label (str): The label name for dict results.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._callbacks[name] = (function, kind, label)
+
+    def unregister(self, name: str) -> None:
+        """
+        Removes a callback metric.
+
+        Args:
+            name (str): The metric name.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._callbacks.pop(name, None)
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            callbacks = sorted(self._callbacks.items())
+        for name, samples in _group(counters).items():
+            self._header(lines, name, "counter")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        for name, samples in _group(histograms).items():
+            self._header(lines, name, "histogram")
+            for labels, histogram in samples:
+                cumulative = 0
+                for bound, bucket_count in zip(
+                    histogram.buckets + (float("inf"),), list(histogram.counts)
+                ):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        for name, (function, kind, label) in callbacks:
+            try:
+                value = function()
+            except Exception:
+                continue  # The owner may be shutting down
+            self._header(lines, name, kind)
+            if isinstance(value, dict):
+                for key, item in sorted(value.items(), key=lambda item: str(item[0])):
+                    labels = ((label, key),) if key is not None else ()
+                    lines.append(f"{name}{_labels(labels)} {_number(item)}")
+            else:
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, name: str, kind: str) -> None:
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+class _Timer:
+    __slots__ = ("registry", "name", "labels", "started")
+
+    def __init__(self, registry: MetricsRegistry, name: str, labels: dict) -> None:
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self.registry.observe(
+            self.name, time.perf_counter() - self.started, **self.labels
+        )
+        if exc_type is not None:
+            self.registry.inc(
+                self.name.removesuffix("_seconds") + "_errors_total", **self.labels
+            )
+        return False
+
+
+def _group(items: list) -> dict:
+    groups = {}
+    for (name, labels), value in items:
+        groups.setdefault(name, []).append((labels, value))
+    return groups
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class MetricsServer:
+    """
+    Class to serve a MetricsRegistry over HTTP for Prometheus to scrape.
+
+    Attributes:
+        registry: The MetricsRegistry that is served.
+        host: The interface the server listens on, local only by default.
+        port: The port the server listens on.
+
+    Methods:
+        start: Starts serving /metrics on a background thread.
+        stop: Stops the server.
+    """
+
+    def __init__(self, registry, host: str = "127.0.0.1", port: int = 9108) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Starts serving /metrics on a background thread.
+
+        Returns:
+            None
+        """
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="agribot-metrics", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the server.
+
+        Returns:
+            None
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+_shared_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    """
+    Returns the process-wide MetricsRegistry the clients report to.
+
+    Returns:
+        MetricsRegistry: The shared registry.
+    """
+    return _shared_registry
@@ -0,0 +1,593 @@
+import collections
+import copy
+import json
+import logging
+import threading
+import time
+from metrics import get_registry
+from reading import to_wire
+from realtimedb import BACKFILL_NODE, push_key_for_time
+from upload_control import is_auth_failure, is_rejected
+
+logger = logging.getLogger("agribot")
+
+BACKPRESSURE_POLICIES = ("drop_oldest", "block", "coalesce")
+SERVER_TIMESTAMP = {".sv": "timestamp"}
+# Seconds after which an upload is logged under BACKFILL_NODE; SensorHistory
+# fetches more than this again on every sync
+BACKFILL_AGE = 60.0
+# Seconds between ID token refreshes after uploads are refused with 401 or 403
+REFRESH_INTERVAL = 30.0
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_upload_lag_seconds", "Time from reading a frame to its upload."
+)
+
+
+class IngestPipeline:
+    """
+    Class to decouple serial ingestion from Firebase uploads.
+
+    A reader thread drains the sensor source into a bounded queue and one or
+    more uploader threads send the queued readings to the Realtime Database in
+    batches, so the ingest rate is limited by the sensor and not by the network.
+
+    Failed batches are retried, except when the database refuses them for
+    their content with a 4xx other than 408, 429, 401 and 403: such a batch
+    is split until the refused readings are found, which are logged,
+    counted as rejected and moved to the spool's rejected table, so the
+    readings queued behind them are still uploaded. A 401 or 403 means the
+    ID token expired or was revoked, so the token is refreshed through
+    `refresh_token` and the batch is retried like after an outage.
+
+    Readings uploaded more than BACKFILL_AGE seconds after their push key
+    was generated, e.g. replayed from the spool, are listed under
+    BACKFILL_NODE in the same update, so SensorHistory fetches them even
+    after it synced past their keys.
+
+    Attributes:
+        read_frame: Callable returning a Reading, or None if no frame was read.
+        read_frames: Callable returning a list of (device_id, reading) tuples, used
+            instead of read_frame for multi-device sources.
+        db: The RealtimeDB instance the readings are uploaded to.
+        maxsize: The maximum number of readings held in the queue.
+        policy: What to do when the queue is full: "drop_oldest", "block" or "coalesce".
+        workers: The number of uploader threads.
+        retry_delay: Seconds an uploader waits after a failed upload.
+        spool: Optional SensorSpool readings are committed to before they are queued.
+        replay_rate: The maximum number of spooled readings replayed per second.
+        filter: Optional DeadbandFilter deciding which readings are worth uploading.
+        aggregator: Optional WindowAggregator; if set, only its rollups are uploaded.
+        controller: Optional UploadController adapting the batch size and flush interval,
+            backing off after failures and holding uploads back while its breaker is open.
+        archive: Optional FrameArchive every reading is kept in, before it is filtered.
+        refresh_token: Optional callable fetching a fresh ID token, e.g.
+            TokenManager.refresh, called after a 401 or 403.
+        latest: The most recent Reading read from the source.
+        latest_by_device: The most recent Reading of every device.
+        stats: Counters for received, filtered, uploaded, dropped, coalesced, spilled, replayed, failed,
+            rejected and unarchived readings.
+
+    Methods:
+        start: Starts the reader and uploader threads.
+        stop: Stops the reader and drains the queue before stopping the uploaders.
+        put: Adds a reading to the queue, applying the backpressure policy.
+        queue_depth: Returns the number of readings waiting to be uploaded.
+        queue_age: Returns how long the oldest queued reading has been waiting.
+    """
+
+    def __init__(
+        self,
+        read_frame,
+        db,
+        maxsize: int = 1000,
+        policy: str = "drop_oldest",
+        workers: int = 1,
+        retry_delay: float = 1.0,
+        spool=None,
+        replay_rate: float = 50.0,
+        filter=None,
+        aggregator=None,
+        read_frames=None,
+        controller=None,
+        archive=None,
+        refresh_token=None,
+    ) -> None:
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(
+                f"Unknown backpressure policy {policy!r}, expected one of {BACKPRESSURE_POLICIES}."
+            )
+        if replay_rate <= 0:
+            raise ValueError(f"replay_rate must be positive, got {replay_rate!r}.")
+        self.read_frame = read_frame
+        self.read_frames = read_frames
+        self.db = db
+        self.maxsize = maxsize
+        self.policy = policy
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.filter = filter
+        self.aggregator = aggregator
+        self.controller = controller
+        self.archive = archive
+        self.refresh_token = refresh_token
+        self.latest = None
+        self.latest_by_device = {}
+        # Filters and aggregators are stateful, so each device gets its own copy
+        self._filters = {None: filter}
+        self._aggregators = {None: aggregator}
+        self.stats = collections.Counter()
+        self._queue = collections.deque()
+        self._live_ids = set()  # Spool ids queued or being uploaded
+        # Valve path -> push key of the reading whose valve_status was last
+        # written; push keys sort by time, so replays never overwrite newer ones
+        self._valve_keys = {}
+        self._cond = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = None
+        self._reading = threading.Event()
+        self._uploading = threading.Event()
+        self._threads = []
+
+    def start(self) -> None:
+        """
+        Starts the reader and uploader threads.
+
+        Returns:
+            None
+        """
+        self._reading.set()
+        self._uploading.set()
+        self._threads = [
+            threading.Thread(target=self._reader, name="agribot-reader", daemon=True)
+        ]
+        if self.spool is not None:
+            self._threads.append(
+                threading.Thread(
+                    target=self._replayer, name="agribot-replayer", daemon=True
+                )
+            )
+        for i in range(self.workers):
+            self._threads.append(
+                threading.Thread(
+                    target=self._uploader, name=f"agribot-uploader-{i}", daemon=True
+                )
+            )
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        Stops the reader, then lets the uploaders drain the queue before stopping them.
+
+        Rollups of windows that are still open are queued before draining.
+
+        Args:
+            timeout (float): Seconds to wait for the queue to drain.
+
+        Returns:
+            None
+        """
+        self._reading.clear()
+        deadline = time.monotonic() + timeout
+        self._threads[0].join(timeout)  # Let the reader queue its last frame
+        if self.aggregator is not None:
+            for device, aggregator in list(self._aggregators.items()):
+                if aggregator is None or device not in self.latest_by_device:
+                    continue
+                reading = self.latest_by_device[device]
+                for window, rollup in aggregator.flush():
+                    self.put(
+                        rollup,
+                        reading.valve_status,
+                        self._node(device, f"sensor_data_{window}"),
+                    )
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+        self._uploading.clear()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()) + 1.0)
+
+    def queue_depth(self) -> int:
+        """
+        Returns the number of readings waiting to be uploaded.
+
+        Returns:
+            int: The current queue depth.
+        """
+        with self._cond:
+            return len(self._queue)
+
+    def queue_age(self) -> float:
+        """
+        Returns how long the oldest queued reading has been waiting, i.e. how far behind uploads are.
+
+        Returns:
+            float: Seconds since the oldest queued reading was put, 0.0 if the queue is empty.
+        """
+        with self._cond:
+            if not self._queue:
+                return 0.0
+            return time.monotonic() - self._queue[0][3]
+
+    def put(self, data, valve_status: str, node: str = "sensor_data") -> None:
+        """
+        Adds a reading to the queue, applying the backpressure policy when it is full.
+
+        The push key is generated here, from the capture time and in arrival
+        order, so readings keep their order in the database even when several
+        uploaders run concurrently.
+        With a spool, the reading is committed to disk first and readings pushed
+        out of a full queue are spilled to the replayer instead of being lost.
+
+        Args:
+            data (Reading | dict): The reading, or a rollup.
+            valve_status (str): The valve_status to write, or None to leave it untouched.
+            node (str): The node under the user the reading is pushed to.
+
+        Returns:
+            None
+        """
+        # Keyed by the capture time, so frames read in one chunk keep theirs
+        captured = getattr(data, "captured", None)
+        key = self.db.generate_push_key(
+            None if captured is None else int(captured * 1000)
+        )
+        spool_id = None
+        if self.spool is not None:
+            spool_id = self.spool.append(key, data, valve_status, node)
+        item = [key, data, valve_status, time.monotonic(), spool_id, node]
+        with self._cond:
+            self.stats["received"] += 1
+            if len(self._queue) >= self.maxsize:
+                if self.policy == "drop_oldest":
+                    self._evict(self._queue.popleft(), "dropped")
+                elif self.policy == "coalesce":
+                    # Keep the newest values but the original queue time
+                    coalesced = self._queue.pop()
+                    self._evict(coalesced, "coalesced")
+                    item[3] = coalesced[3]
+                    if item[2] is None:
+                        # Don't lose a valve transition carried by the replaced reading
+                        item[2] = coalesced[2]
+                else:
+                    while len(self._queue) >= self.maxsize and self._uploading.is_set():
+                        self._cond.wait(0.5)
+            self._queue.append(item)
+            if spool_id is not None:
+                self._live_ids.add(spool_id)
+            self._cond.notify_all()
+
+    def _evict(self, item: list, reason: str) -> None:
+        # Must be called with self._cond held
+        if item[4] is None:
+            self.stats[reason] += 1
+        else:
+            self._live_ids.discard(item[4])
+            self.stats["spilled"] += 1
+
+    @staticmethod
+    def _node(device, node: str) -> str:
+        return node if device is None else f"devices/{device}/{node}"
+
+    @staticmethod
+    def _valve_path(node: str) -> str:
+        # sensor_data -> valve_status, devices/<id>/sensor_data -> devices/<id>/valve_status
+        prefix = node.rpartition("/")[0]
+        return f"{prefix}/valve_status" if prefix else "valve_status"
+
+    def _stage(self, stages: dict, device):
+        if device not in stages:
+            stages[device] = copy.deepcopy(stages[None])
+        return stages[device]
+
+    def _reader(self) -> None:
+        while self._reading.is_set():
+            if self.read_frames is not None:
+                frames = self.read_frames()
+            else:
+                reading = self.read_frame()
+                frames = [] if reading is None else [(None, reading)]
+            for device, reading in frames:
+                self._ingest(device, reading)
+
+    def _ingest(self, device, reading) -> None:
+        self.latest = reading
+        self.latest_by_device[device] = reading
+        if self.archive is not None:
+            try:
+                self.archive.append(reading, device)
+            except OSError:
+                with self._cond:
+                    self.stats["unarchived"] += 1  # A full disk must not stop uploads
+        valve_status = reading.valve_status
+        aggregator = self._stage(self._aggregators, device)
+        if aggregator is not None:
+            for window, rollup in aggregator.add(reading, reading.captured):
+                self.put(
+                    rollup, valve_status, self._node(device, f"sensor_data_{window}")
+                )
+            return
+        filter = self._stage(self._filters, device)
+        if filter is not None:
+            reading, valve_status = filter.accept(reading, valve_status)
+            if reading is None:
+                with self._cond:
+                    self.stats["filtered"] += 1
+                return
+        self.put(reading, valve_status, self._node(device, "sensor_data"))
+
+    def _batch_limits(self) -> tuple:
+        if self.controller is not None:
+            return self.controller.batch_size, self.controller.linger
+        return self.db.batch_size, self.db.max_linger
+
+    def _admitted(self, probe: bool = True) -> bool:
+        # Waits until the controller lets an upload through; False if the
+        # pipeline stopped first. The replayer never sends the probe.
+        while self.controller is not None:
+            if not probe and self.controller.state != "closed":
+                wait = 1.0
+            else:
+                wait = self.controller.admit()
+            if wait <= 0:
+                return True
+            if not self._uploading.is_set():
+                return False
+            time.sleep(min(wait, 0.5))
+        return True
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while self._uploading.is_set():
+                batch_size, linger = self._batch_limits()
+                if self._queue and (
+                    len(self._queue) >= batch_size
+                    or not self._reading.is_set()
+                    or time.monotonic() - self._queue[0][3] >= linger
+                ):
+                    break
+                self._cond.wait(0.1)
+            batch_size = self._batch_limits()[0]
+            batch = [
+                self._queue.popleft() for _ in range(min(len(self._queue), batch_size))
+            ]
+            self._cond.notify_all()
+            return batch
+
+    def _requeue(self, batch: list) -> None:
+        with self._cond:
+            if self.spool is not None:
+                # Spooled readings are retried by the replayer
+                for item in batch:
+                    self._evict(item, "dropped")
+            else:
+                self._queue.extendleft(reversed(batch))
+                while len(self._queue) > self.maxsize and self.policy != "block":
+                    self._evict(self._queue.popleft(), "dropped")
+            self._cond.notify_all()
+
+    def _valve_statuses(self, batch: list) -> dict:
+        # The last valve_status of every device in the batch wins, unless
+        # one of a newer reading was already written
+        with self._cond:
+            return {
+                self._valve_path(item[5]): item[2]
+                for item in batch
+                if item[2] is not None
+                and item[0] > self._valve_keys.get(self._valve_path(item[5]), "")
+            }
+
+    def _wrote_valve_statuses(self, batch: list) -> None:
+        # Must be called with self._cond held
+        for item in batch:
+            if item[2] is not None:
+                path = self._valve_path(item[5])
+                if item[0] > self._valve_keys.get(path, ""):
+                    self._valve_keys[path] = item[0]
+
+    def _ack(self, batch: list) -> None:
+        ids = [item[4] for item in batch if item[4] is not None]
+        if ids:
+            self.spool.ack(ids)
+            with self._cond:
+                self._live_ids.difference_update(ids)
+
+    def _push(self, batch: list) -> None:
+        updates = self._valve_statuses(batch)
+        updates.update(_backfill_entries(batch))
+        self.db.push_sensor_batch_for_user(
+            [item[1] for item in batch],
+            updates or None,
+            keys=[item[0] for item in batch],
+            nodes=[item[5] for item in batch],
+        )
+        with self._cond:
+            self._wrote_valve_statuses(batch)
+
+    def _uploaded(self, batch: list, stat: str) -> None:
+        with self._cond:
+            self.stats[stat] += len(batch)
+        uploaded_at = time.monotonic()
+        for item in batch:
+            if item[3] is not None:  # Replayed readings were never queued
+                _metrics.observe("agribot_upload_lag_seconds", uploaded_at - item[3])
+        self._ack(batch)
+
+    def _failed(self, batch: list, error: Exception, stat: str, requeue: bool) -> None:
+        # Uploads what can be uploaded of a failed batch, sets aside what the
+        # database refuses and backs off before the rest is retried
+        unsent = batch
+        if is_rejected(error):
+            uploaded, rejected, unsent, error = self._isolate(batch)
+            if uploaded:
+                self._uploaded(uploaded, stat)
+            if rejected:
+                self._reject(rejected)
+        if not unsent:
+            return
+        if is_auth_failure(error):
+            self._refresh()
+        with self._cond:
+            self.stats["failed"] += len(unsent)
+        if requeue:
+            self._requeue(unsent)
+        if self.controller is not None:
+            self.controller.record_failure(error)
+        else:
+            time.sleep(self.retry_delay)
+
+    def _refresh(self) -> None:
+        # The token expired or was revoked, e.g. while an outage outlasted
+        # it; one uploader refreshes it and the others retry with the new one
+        if self.refresh_token is None:
+            return
+        with self._refresh_lock:
+            now = time.monotonic()
+            if (
+                self._refreshed_at is not None
+                and now - self._refreshed_at < REFRESH_INTERVAL
+            ):
+                return
+            self._refreshed_at = now
+            logger.warning(
+                "Uploads were refused with HTTP 401/403, refreshing the ID token."
+            )
+            try:
+                self.refresh_token()
+            except Exception as e:
+                logger.warning("Could not refresh the ID token: %s", e)
+
+    def _isolate(self, batch: list) -> tuple:
+        # The database refused the batch for its content, e.g. a 400 for a
+        # value it cannot store, so the batch is split in halves until the
+        # readings it refuses on their own are found and the rest can still
+        # be uploaded. Returns the uploaded and rejected items, then the items
+        # left when another error stopped the search, and that error.
+        uploaded = []
+        rejected = []
+        parts = [(batch, True)]  # (items, known to be refused)
+        while parts:
+            part, refused = parts.pop(0)
+            if not refused:
+                try:
+                    self._push(part)
+                    uploaded += part
+                    continue
+                except Exception as e:
+                    if not is_rejected(e):
+                        unsent = part + [item for rest, _ in parts for item in rest]
+                        return uploaded, rejected, unsent, e
+            if len(part) == 1:
+                rejected += part
+                continue
+            middle = len(part) // 2
+            parts[:0] = [(part[:middle], False), (part[middle:], False)]
+        return uploaded, rejected, [], None
+
+    def _reject(self, batch: list) -> None:
+        with self._cond:
+            self.stats["rejected"] += len(batch)
+        for item in batch:
+            logger.warning(
+                "The database refused reading %s for %s, setting it aside: %s",
+                item[0],
+                item[5],
+                json.dumps(to_wire(item[1])),
+            )
+        ids = [item[4] for item in batch if item[4] is not None]
+        if ids:
+            self.spool.reject(ids)
+            with self._cond:
+                self._live_ids.difference_update(ids)
+
+    def _uploader(self) -> None:
+        while self._uploading.is_set():
+            batch = self._take_batch()
+            if not batch:
+                continue
+            if not self._admitted():
+                self._requeue(batch)  # Stopped while uploads were held back
+                return
+            started = time.monotonic()
+            try:
+                self._push(batch)
+            except Exception as e:
+                self._failed(batch, e, "uploaded", requeue=True)
+                continue
+            if self.controller is not None:
+                self.controller.record_success(time.monotonic() - started, len(batch))
+            self._uploaded(batch, "uploaded")
+
+    def _replayer(self) -> None:
+        # Uploads spooled readings that are not in the live queue, oldest first
+        # and at no more than replay_rate readings per second, so a large
+        # backlog catches up without starving live ingestion.
+        # A reading appended while the snapshot is taken may be uploaded twice;
+        # that is harmless since it is written under the same push key.
+        while self._uploading.is_set():
+            if not self._admitted(probe=False):
+                return
+            with self._cond:
+                live_ids = set(self._live_ids)
+            rows = self.spool.pending(self._batch_limits()[0], exclude=live_ids)
+            if not rows:
+                time.sleep(1.0)
+                continue
+            ids = [row[0] for row in rows]
+            with self._cond:
+                self._live_ids.update(ids)
+            started = time.monotonic()
+            items = []
+            for spool_id, key, data, valve_status, created_at, node in rows:
+                if data.get("timestamp") == SERVER_TIMESTAMP:
+                    # Spooled before readings carried their capture time
+                    data["timestamp"] = int(created_at * 1000)
+                # A valve transition that failed to upload live is written
+                # now, unless a newer valve_status already was
+                items.append([key, data, valve_status, None, spool_id, node])
+            try:
+                self._push(items)
+            except Exception as e:
+                # Readings that are not uploaded stay in the spool
+                self._failed(items, e, "replayed", requeue=False)
+            else:
+                if self.controller is not None:
+                    self.controller.record_success(
+                        time.monotonic() - started, len(items)
+                    )
+                self._uploaded(items, "replayed")
+            finally:
+                with self._cond:
+                    self._live_ids.difference_update(ids)
+            time.sleep(
+                max(0.0, len(rows) / self.replay_rate - (time.monotonic() - started))
+            )
+
+
+def _backfill_entries(batch: list) -> dict:
+    # Lists the key range of every node a batch uploads to late, e.g. from
+    # the spool after an outage, in the same update as the readings. The log
+    # key is the upload time followed by the suffix of a key in the range.
+    late = push_key_for_time(int((time.time() - BACKFILL_AGE) * 1000))
+    ranges = {}
+    for item in batch:
+        if item[0] < late:
+            start, end = ranges.get(item[5], (item[0], item[0]))
+            ranges[item[5]] = (min(start, item[0]), max(end, item[0]))
+    uploaded = push_key_for_time(int(time.time() * 1000))
+    return {
+        f"{BACKFILL_NODE}/{uploaded}{start[8:]}": {
+            "node": node,
+            "start": start,
+            "end": end,
+        }
+        for node, (start, end) in ranges.items()
+    }
@@ -0,0 +1,166 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import serial
+from serial.tools import list_ports
+from frame_parser import parse_frame
+
+# USB vendor ids of Arduino boards and of the USB-serial chips used on clones
+ARDUINO_VIDS = {
+    0x2341: "Arduino",
+    0x2A03: "Arduino",
+    0x1A86: "CH340",
+    0x0403: "FTDI",
+    0x10C4: "CP210x",
+}
+
+# Printed by sensors.ino in setup(), before its first frame
+BOOT_BANNER = b"Reading From the Sensor"
+
+
+class PortDiscovery:
+    """
+    Class to find the serial ports Arduinos running sensors.ino are connected to.
+
+    Ports are shortlisted from their USB metadata instead of opening every
+    possible port name, and the candidates are probed in parallel until a
+    "<...>" frame or the boot banner of the sketch actually arrives. Confirmed
+    ports are cached by the board's USB serial number, so a board that is
+    still on the same port is found without probing at all.
+
+    Attributes:
+        baud_rate: The baud rate used to probe the ports.
+        probe_timeout: Seconds to wait for a frame; the board resets when the port opens,
+            and its first frame follows the bootloader and a 2 s delay in setup().
+        cache_path: The path of the last-known-port cache file.
+
+    Methods:
+        candidates: Returns the ports that look like Arduinos, most likely first.
+        probe: Checks whether a frame arrives on a port.
+        find_ports: Returns all ports with an Arduino sending frames.
+        find_port: Returns the first port with an Arduino sending frames.
+    """
+
+    def __init__(
+        self,
+        baud_rate: int = 9600,
+        probe_timeout: float = 5.0,
+        cache_path: str = os.path.join("~", ".agribot", "ports.json"),
+    ) -> None:
+        self.baud_rate = baud_rate
+        self.probe_timeout = probe_timeout
+        self.cache_path = os.path.expanduser(cache_path)
+
+    def candidates(self) -> list:
+        """
+        Returns the ports that look like Arduinos, most likely first.
+
+        Ports with a known Arduino or USB-serial vendor id come first, then
+        other USB ports. Ports without USB metadata are only returned if there
+        is nothing else.
+
+        Returns:
+            list: serial.tools.list_ports ListPortInfo objects.
+        """
+        ports = list_ports.comports()
+        known = [p for p in ports if p.vid in ARDUINO_VIDS]
+        usb = [p for p in ports if p.vid is not None and p.vid not in ARDUINO_VIDS]
+        return known + usb or list(ports)
+
+    def probe(self, port: str) -> bool:
+        """
+        Checks whether a frame or the boot banner of sensors.ino arrives on a port.
+
+        Args:
+            port (str): The serial port.
+
+        Returns:
+            bool: True if a valid frame or the banner arrived within probe_timeout.
+        """
+        deadline = time.monotonic() + self.probe_timeout
+        try:
+            with serial.Serial(port, self.baud_rate, timeout=0.2) as ser:
+                while time.monotonic() < deadline:
+                    line = ser.readline()
+                    if BOOT_BANNER in line or (
+                        line and parse_frame(line.decode("utf-8", "ignore"))
+                    ):
+                        return True
+        except (serial.SerialException, OSError):
+            pass
+        return False
+
+    def find_ports(self, find_all: bool = True) -> list:
+        """
+        Returns the ports with an Arduino sending frames.
+
+        Cached ports whose board is still attached are returned without probing.
+
+        Args:
+            find_all (bool): Whether to keep probing after the first port is confirmed.
+
+        Returns:
+            list: The confirmed port names.
+        """
+        candidates = self.candidates()
+        cache = self._load_cache()
+        cached = [
+            p.device
+            for p in candidates
+            if p.serial_number and cache.get(p.serial_number) == p.device
+        ]
+        if cached and not find_all:
+            return cached[:1]
+        to_probe = [p for p in candidates if p.device not in cached]
+        found = list(cached)
+        if to_probe:
+            executor = ThreadPoolExecutor(max_workers=len(to_probe))
+            futures = {executor.submit(self.probe, p.device): p for p in to_probe}
+            try:
+                for future in as_completed(futures):
+                    if not future.result():
+                        continue
+                    info = futures[future]
+                    found.append(info.device)
+                    if info.serial_number:
+                        cache[info.serial_number] = info.device
+                    if not find_all:
+                        break
+            finally:
+                # When only one port is needed, don't wait for the slower probes
+                executor.shutdown(wait=find_all, cancel_futures=True)
+        self._save_cache(cache)
+        return found
+
+    def find_port(self) -> str:
+        """
+        Returns the first port with an Arduino sending frames.
+
+        Returns:
+            str: The port name.
+
+        Raises:
+            Exception: If no Arduino was found.
+        """
+        ports = self.find_ports(find_all=False)
+        if not ports:
+            raise Exception("Arduino not found.")
+        return ports[0]
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache: dict) -> None:
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.cache_path, "w") as cache_file:
+                json.dump(cache, cache_file)
+        except OSError:
+            pass  # The cache only speeds up the next start
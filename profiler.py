@@ -0,0 +1,110 @@
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """
+    Class to profile the running process by sampling the stacks of its threads.
+
+    A background thread records the stack of every other thread at a fixed
+    interval for a limited time and writes the counts in the collapsed format
+    flamegraph.pl and speedscope read. Nothing runs until a profile is
+    requested, so it can stay installed on production gateways.
+
+    Attributes:
+        interval: Seconds between samples.
+        duration: Seconds a profile runs for.
+        output_dir: The directory profiles are written to.
+        samples: The number of samples taken in the last profile.
+
+    Methods:
+        install: Starts a profile whenever the process receives a signal.
+        start: Starts a profile in the background.
+        profile: Samples for `duration` seconds and writes the profile.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.005,
+        duration: float = 30.0,
+        output_dir: str = ".",
+    ) -> None:
+        self.interval = interval
+        self.duration = duration
+        self.output_dir = output_dir
+        self.samples = 0
+        self._thread = None
+
+    def install(self, signum: int = None) -> bool:
+        """
+        Starts a profile whenever the process receives a signal, SIGUSR1 by default.
+
+        Args:
+            signum (int): The signal number.
+
+        Returns:
+            bool: False if the platform has no such signal, e.g. SIGUSR1 on Windows.
+        """
+        if signum is None:
+            signum = getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            return False
+        signal.signal(signum, lambda *_: self.start())
+        return True
+
+    def start(self) -> bool:
+        """
+        Starts a profile in the background unless one is already running.
+
+        Returns:
+            bool: True if a profile was started.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._thread = threading.Thread(
+            target=self.profile, name="agribot-profiler", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def profile(self) -> str:
+        """
+        Samples all other threads for `duration` seconds and writes the profile.
+
+        Returns:
+            str: The path of the collapsed stack file.
+        """
+        own = threading.get_ident()
+        names = {}
+        stacks = collections.Counter()
+        self.samples = 0
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        path = os.path.join(
+            self.output_dir,
+            time.strftime("agribot-profile-%Y%m%d-%H%M%S.collapsed"),
+        )
+        with open(path, "w") as out:
+            for stack, count in stacks.most_common():
+                out.write(f"{stack} {count}\n")
+        return path
@@ -0,0 +1,180 @@
+import math
+import threading
+import time
+
+
+class CaptureClock:
+    """
+    Class to timestamp readings from the monotonic clock, calibrated to wall time.
+
+    time.monotonic() never jumps, but counts from an arbitrary point, so
+    the offset to time.time() is measured once and added to every reading.
+    The offset is measured again every `recalibrate` seconds to follow NTP
+    adjustments of the wall clock; between calibrations, timestamps only
+    move forward.
+
+    Attributes:
+        recalibrate: Seconds between calibrations.
+        offset: time.time() minus time.monotonic() at the last calibration.
+
+    Methods:
+        calibrate: Measures the offset between the monotonic and wall clocks.
+        now: Returns the current time in seconds since the epoch.
+        wall_time: Converts a time.monotonic() value to seconds since the epoch.
+    """
+
+    def __init__(self, recalibrate: float = 60.0) -> None:
+        self.recalibrate = recalibrate
+        self._lock = threading.Lock()
+        self.calibrate()
+
+    def calibrate(self) -> None:
+        """
+        Measures the offset between the monotonic and wall clocks.
+
+        The wall clock is read between two monotonic reads a few times and
+        the tightest pair is kept, so a preemption does not skew the offset.
+
+        Returns:
+            None
+        """
+        best = None
+        for _ in range(5):
+            before = time.monotonic()
+            wall = time.time()
+            after = time.monotonic()
+            if best is None or after - before < best[0]:
+                best = (after - before, wall - (before + after) / 2)
+        with self._lock:
+            self.offset = best[1]
+            self._next_calibration = time.monotonic() + self.recalibrate
+
+    def now(self) -> float:
+        """
+        Returns the current time in seconds since the epoch.
+
+        Returns:
+            float: The time.
+        """
+        now = time.monotonic()
+        if now >= self._next_calibration:
+            self.calibrate()
+        return now + self.offset
+
+    def wall_time(self, monotonic: float) -> float:
+        """
+        Converts a time.monotonic() value to seconds since the epoch.
+
+        Args:
+            monotonic (float): The time.monotonic() value.
+
+        Returns:
+            float: The time.
+        """
+        return monotonic + self.offset
+
+
+_clock = None
+_clock_lock = threading.Lock()
+
+
+def get_clock() -> CaptureClock:
+    """
+    Returns the process-wide CaptureClock, creating it on first use.
+
+    Returns:
+        CaptureClock: The shared clock.
+    """
+    global _clock
+    with _clock_lock:
+        if _clock is None:
+            _clock = CaptureClock()
+        return _clock
+
+
+class Reading:
+    """
+    Class holding one sensor reading from capture until it is uploaded.
+
+    Readings are created for every frame, so they only hold slots: no
+    per-instance dict and no nested timestamp placeholder. Channels can be
+    read as attributes or by name like a dict. The wire format is only
+    built by to_dict, when a reading is uploaded or spooled.
+
+    Attributes:
+        humidity: The humidity in percent.
+        temperature: The temperature in °C.
+        moisture: The soil moisture in percent.
+        water_level: The water level in percent.
+        valve_status: "on" or "off".
+        captured: The capture time in seconds since the epoch.
+
+    Methods:
+        to_dict: Returns the reading in the format stored under sensor_data.
+    """
+
+    __slots__ = (
+        "humidity",
+        "temperature",
+        "moisture",
+        "water_level",
+        "valve_status",
+        "captured",
+    )
+
+    def __init__(
+        self,
+        humidity: float,
+        temperature: float,
+        moisture: float,
+        water_level: float,
+        valve_status: str,
+        captured: float,
+    ) -> None:
+        self.humidity = humidity
+        self.temperature = temperature
+        self.moisture = moisture
+        self.water_level = water_level
+        self.valve_status = valve_status
+        self.captured = captured
+
+    def __getitem__(self, channel: str):
+        return getattr(self, channel)
+
+    def __repr__(self) -> str:
+        return (
+            f"Reading(humidity={self.humidity}, temperature={self.temperature},"
+            f" moisture={self.moisture}, water_level={self.water_level},"
+            f" valve_status={self.valve_status!r}, captured={self.captured})"
+        )
+
+    def to_dict(self) -> dict:
+        """
+        Returns the reading in the format stored under sensor_data.
+
+        Channels that are not finite, like a failed sensor read, are left out:
+        json.dumps would write them as NaN, which the database rejects.
+
+        Returns:
+            dict: The finite channels and the capture time in milliseconds as "timestamp".
+        """
+        data = {}
+        for channel in ("humidity", "temperature", "moisture", "water_level"):
+            value = getattr(self, channel)
+            if math.isfinite(value):
+                data[channel] = value
+        data["timestamp"] = int(self.captured * 1000)
+        return data
+
+
+def to_wire(data) -> dict:
+    """
+    Returns what is uploaded for a reading or a rollup.
+
+    Args:
+        data (Reading | dict): A reading, or a rollup or other dict that is sent as is.
+
+    Returns:
+        dict: The JSON-serializable data.
+    """
+    return data.to_dict() if isinstance(data, Reading) else data
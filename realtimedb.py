@@ -1,12 +1,90 @@
 from credential_loader import Credentials
-import firebase
+from http_pool import get_shared_pool
+from metrics import get_registry
+from reading import to_wire
+from wire import encode_reading
+from valve_control import ValveCommandStream
+import random
+import time
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_firebase_request_seconds", "Realtime Database request latency."
+)
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+# json.dumps puts a space after every separator unless told otherwise
+COMPACT_JSON = {"separators": (",", ":")}
+# Readings uploaded long after their push key was generated are listed here
+# in upload order, so a reader that already synced past them finds them
+BACKFILL_NODE = "sensor_backfill"
+
+
+def push_key_time(key: str) -> int:
+    """
+    Returns the time encoded in the first 8 characters of a push ID.
+
+    Args:
+        key (str): The push ID.
+
+    Returns:
+        int: Milliseconds since the epoch.
+    """
+    ms = 0
+    for char in key[:8]:
+        ms = ms * 64 + PUSH_CHARS.index(char)
+    return ms
+
+
+def push_key_for_time(ms: int) -> str:
+    """
+    Returns the 8 character time prefix of push IDs generated at a time.
+
+    Every push ID generated at or after that millisecond sorts after the
+    prefix and every earlier one before it, so it can bound a key range.
+
+    Args:
+        ms (int): Milliseconds since the epoch.
+
+    Returns:
+        str: The prefix.
+    """
+    chars = []
+    for _ in range(8):
+        chars.append(PUSH_CHARS[ms % 64])
+        ms //= 64
+    return "".join(reversed(chars))
+
+
+def initialize_app(config: dict, pool):
+    """
+    Initializes a Firebase app that sends its requests through a pool.
+
+    Args:
+        config (dict): The Firebase configuration.
+        pool (HTTPPool): The connection pool the database requests are sent through.
+
+    Returns:
+        Firebase: The app.
+    """
+    try:
+        import firebase  # Slow to import, so only when a client is created
+
+        app = firebase.initialize_app(config)
+    except Exception as e:
+        raise Exception("There was an error initializing the Firebase app.")
+    # Route database requests through the shared keep-alive pool
+    app.requests = pool.session
+    return app
 
 
 class RealtimeDB(Credentials):
     """
     A class representing a Realtime Database.
 
-    Inherits from the Credentials class.
+    Inherits from the Credentials class. Passing an `app` skips loading the
+    credentials, so FirebaseClients can hand out one handle per user that
+    shares the app and pool of all the others.
 
     Attributes:
         app: The Firebase app instance.
@@ -14,41 +92,234 @@ class RealtimeDB(Credentials):
         db: The Firebase database instance.
         user_info: The user information such as the localId and idToken.
         id_token: The ID token of the user, used for authentication.
+        pool: The connection pool shared with the other Firebase clients.
+        batch_size: The number of readings buffered before a batch is flushed.
+        max_linger: The maximum time in seconds a reading waits in the buffer.
+        wire_schema: The compact wire schema version readings are uploaded in,
+            None for the verbose format with full channel names.
 
     Methods:
         push_sensor_data_for_user: Pushes new sensor data for the user.
+        push_sensor_batch_for_user: Pushes several readings and the valve_status in one request.
+        put_rollups_for_user: Writes rollups keyed by their window start.
+        generate_push_key: Generates an ordered Firebase push ID on the client.
+        add_reading: Buffers a reading and flushes the batch when it is due.
+        flush: Uploads all buffered readings.
         update_valve_status_for_user: Updates the valve_status for the user.
+        listen_for_valve_commands: Streams the valve_command node of the user.
+        ack_valve_command_for_user: Writes the outcome of a valve command.
+        get_sensor_range_for_user: Reads a page of readings in key or child order.
+        delete_keys_for_user: Deletes children of a node in one request.
+        list_devices_for_user: Returns the ids of the devices that uploaded data.
+        list_children_for_user: Returns the keys of the children of a node.
         delete_sensor_data_for_user: Deletes all the sensor data for the user.
     """
 
-    def __init__(self, user_info) -> None:
-        super().__init__()
-        try:
-            self.app = firebase.initialize_app(self.firebase_config)
-        except Exception as e:
-            raise Exception("There was an error initializing the Firebase app.")
+    def __init__(
+        self,
+        user_info,
+        batch_size: int = 10,
+        max_linger: float = 5.0,
+        pool=None,
+        app=None,
+        wire_schema: int = None,
+    ) -> None:
+        self.pool = pool if pool is not None else get_shared_pool()
+        if app is None:
+            super().__init__()
+            app = initialize_app(self.firebase_config, self.pool)
+        # Handles given an app by FirebaseClients skip the credential loading
+        self.app = app
         self.db = self.app.database()
         self.user_info = user_info
         self.id_token = user_info["idToken"]
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.wire_schema = wire_schema
+        self._pending = []
+        self._pending_valve_status = None
+        self._first_pending_at = None
+        self._last_push_time = 0
+        self._last_rand_chars = []
 
+    @_metrics.timed("agribot_firebase_request_seconds", op="push")
     def push_sensor_data_for_user(self, data: dict) -> None:
         """
         Sets the sensor data for the user.
 
         Args:
-            data (dict): The sensor data to set.
+            data (Reading | dict): The sensor data to set.
 
         Returns:
             None
         """
+        data = to_wire(data)
+        if self.wire_schema is not None:
+            data = encode_reading(data, schema=self.wire_schema)
         try:
             uid = self.user_info["localId"]
             self.db.child("users").child(uid).child("sensor_data").push(
-                data=data, token=self.id_token
+                data=data, token=self.id_token, json_kwargs=COMPACT_JSON
             )
         except Exception as e:
             raise Exception("There was an error pushing the sensor data.")
 
+    @_metrics.timed("agribot_firebase_request_seconds", op="push_batch")
+    def push_sensor_batch_for_user(
+        self,
+        readings: list,
+        valve_status: str = None,
+        keys: list = None,
+        nodes: list = None,
+    ) -> None:
+        """
+        Pushes several sensor readings and the valve_status in a single multi-location update.
+
+        Push keys are generated on the client, so the readings keep their order
+        under the sensor_data node just like individual pushes would. With a
+        wire_schema, readings are sent in the compact format of wire.py,
+        which decode_reading turns back into this one.
+
+        Args:
+            readings (list): The Readings, or rollup dicts, to push, oldest first.
+            valve_status (str | dict): The latest valve_status value, or None to leave it
+                untouched. A dict maps valve_status paths under the user to their values.
+            keys (list): Push keys for the readings, generated here if not given.
+            nodes (list): The node under the user each reading goes to, defaults to sensor_data.
+
+        Returns:
+            None
+        """
+        if keys is None:
+            keys = [self.generate_push_key() for _ in readings]
+        if nodes is None:
+            nodes = ["sensor_data"] * len(readings)
+        updates = {}
+        for key, data, node in zip(keys, readings, nodes):
+            data = to_wire(data)  # Serialized only here
+            if self.wire_schema is not None and node.endswith("sensor_data"):
+                # Rollups under sensor_data_<window> keep their format
+                data = encode_reading(data, push_key_time(key), self.wire_schema)
+            updates[node + "/" + key] = data
+        if isinstance(valve_status, dict):
+            updates.update(valve_status)
+        elif valve_status is not None:
+            updates["valve_status"] = valve_status
+        if not updates:
+            return
+        try:
+            self._user_ref().update(
+                updates, token=self.id_token, json_kwargs=COMPACT_JSON
+            )
+        except Exception as e:
+            raise Exception("There was an error pushing the sensor data batch.")
+
+    @_metrics.timed("agribot_firebase_request_seconds", op="put_rollups")
+    def put_rollups_for_user(self, node: str, rollups: dict) -> None:
+        """
+        Writes rollups under a node, keyed by their window start, in one request.
+
+        Args:
+            node (str): The node under the user, e.g. "sensor_history_1h".
+            rollups (dict): Maps window start keys to rollups.
+
+        Returns:
+            None
+        """
+        if not rollups:
+            return
+        try:
+            self._user_ref().child(node).update(rollups, token=self.id_token)
+        except Exception as e:
+            raise Exception("There was an error writing the rollups.")
+
+    def _user_ref(self):
+        # Database references keep their path as mutable state, so every
+        # caller gets its own to stay safe across uploader threads.
+        return self.app.database().child("users").child(self.user_info["localId"])
+
+    def generate_push_key(self, ms: int = None) -> str:
+        """
+        Generates a Firebase push ID on the client.
+
+        Keys generated within the same millisecond, or for a time before the
+        previous key, increment the random suffix of the previous key, so they
+        always sort in the order they were generated.
+
+        Args:
+            ms (int): The time to encode in milliseconds since the epoch, defaults to now.
+
+        Returns:
+            str: A 20 character push ID.
+        """
+        now = int(time.time() * 1000) if ms is None else ms
+        if now <= self._last_push_time:
+            now = self._last_push_time
+            for i in reversed(range(12)):
+                if self._last_rand_chars[i] != 63:
+                    self._last_rand_chars[i] += 1
+                    break
+                self._last_rand_chars[i] = 0
+        else:
+            self._last_rand_chars = [random.randrange(64) for _ in range(12)]
+        self._last_push_time = now
+
+        return push_key_for_time(now) + "".join(
+            PUSH_CHARS[i] for i in self._last_rand_chars
+        )
+
+    def add_reading(self, data: dict, valve_status: str = None) -> bool:
+        """
+        Buffers a reading and flushes the batch once it is full or has lingered too long.
+
+        Args:
+            data (Reading | dict): The sensor data to push.
+            valve_status (str): The valve_status reported with the reading.
+
+        Returns:
+            bool: True if the batch was flushed.
+        """
+        if not self._pending:
+            self._first_pending_at = time.monotonic()
+        self._pending.append(data)
+        if valve_status is not None:
+            self._pending_valve_status = valve_status
+        if self.batch_due():
+            self.flush()
+            return True
+        return False
+
+    def batch_due(self) -> bool:
+        """
+        Checks whether the buffered readings should be flushed.
+
+        Returns:
+            bool: True if the batch is full or the oldest reading has lingered too long.
+        """
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.batch_size:
+            return True
+        return time.monotonic() - self._first_pending_at >= self.max_linger
+
+    def flush(self) -> None:
+        """
+        Uploads all buffered readings and the latest valve_status.
+
+        The buffer is only cleared once the upload succeeded, so a failed flush
+        can be retried without losing readings.
+
+        Returns:
+            None
+        """
+        if not self._pending and self._pending_valve_status is None:
+            return
+        self.push_sensor_batch_for_user(self._pending, self._pending_valve_status)
+        self._pending = []
+        self._pending_valve_status = None
+        self._first_pending_at = None
+
+    @_metrics.timed("agribot_firebase_request_seconds", op="update_valve_status")
     def update_valve_status_for_user(self, valve_status: str) -> None:
         """
         Updates the valve_status for the user.
@@ -69,19 +340,178 @@ class RealtimeDB(Credentials):
         except Exception as e:
             raise Exception("There was an error updating the valve status.")
 
-    def delete_sensor_data_for_user(self) -> None:
+    def valve_command_url(self, path: str = "valve_command") -> str:
+        """
+        Returns the REST URL of a node under the user, with the current ID token.
+
+        Args:
+            path (str): The node under the user.
+
+        Returns:
+            str: The URL.
+        """
+        return self._user_ref().child(path).build_request_url(self.id_token)
+
+    def listen_for_valve_commands(self, handler, **kwargs) -> ValveCommandStream:
+        """
+        Keeps a streaming subscription on the valve_command node of the user.
+
+        The stream runs on its own thread over the shared connection pool and
+        reconnects by itself, picking up the latest ID token every time.
+
+        Args:
+            handler (Callable): Receives the value of the node after every change.
+            **kwargs: ValveCommandStream arguments.
+
+        Returns:
+            ValveCommandStream: The started stream, stop it when done.
+        """
+        stream = ValveCommandStream(self, handler, **kwargs)
+        stream.start()
+        return stream
+
+    @_metrics.timed("agribot_firebase_request_seconds", op="ack_valve_command")
+    def ack_valve_command_for_user(self, ack: dict, device: str = None) -> None:
+        """
+        Writes the outcome of a valve command for the dashboard to show.
+
+        Args:
+            ack (dict): The command id, state, status and latency.
+            device (str): The device the command was applied on, None for a single board.
+
+        Returns:
+            None
+        """
+        try:
+            ref = self._user_ref().child("valve_command_ack")
+            if device is not None:
+                ref = ref.child(device)
+            ref.set(ack, token=self.id_token)
+        except Exception as e:
+            raise Exception("There was an error acknowledging the valve command.")
+
+    @_metrics.timed("agribot_firebase_request_seconds", op="get_range")
+    def get_sensor_range_for_user(
+        self,
+        node: str = "sensor_data",
+        start_at=None,
+        end_at=None,
+        limit: int = None,
+        order_by: str = "$key",
+    ) -> list:
+        """
+        Reads a page of children of a node in key or child order.
+
+        Push IDs sort by the time they were generated, so ordering by key is
+        ordering by capture time and needs no index rule; ordering by a child
+        such as "timestamp" needs ".indexOn" in the database rules.
+
+        Args:
+            node (str): The node under the user, e.g. "sensor_data".
+            start_at (str | int): The first key or child value to include, None for the start.
+            end_at (str | int): The last key or child value to include, None for the end.
+            limit (int): The maximum number of children, taken from the start.
+            order_by (str): "$key" or the child to order by.
+
+        Returns:
+            list: (key, value) tuples in order.
+        """
+        try:
+            query = self._user_ref().child(node)
+            if order_by == "$key":
+                query = query.order_by_key()
+            else:
+                query = query.order_by_child(order_by)
+            if start_at is not None:
+                query = query.start_at(start_at)
+            if end_at is not None:
+                query = query.end_at(end_at)
+            if limit is not None:
+                query = query.limit_to_first(limit)
+            items = query.get(token=self.id_token).each()
+        except Exception as e:
+            raise Exception("There was an error reading the sensor data.")
+        return [(item.key(), item.val()) for item in items or []]
+
+    @_metrics.timed("agribot_firebase_request_seconds", op="delete_keys")
+    def delete_keys_for_user(self, node: str, keys: list) -> None:
+        """
+        Deletes children of a node in a single multi-location update.
+
+        Args:
+            node (str): The node under the user, e.g. "sensor_data".
+            keys (list): The keys of the children to delete.
+
+        Returns:
+            None
+        """
+        if not keys:
+            return
+        try:
+            self._user_ref().child(node).update(
+                {key: None for key in keys}, token=self.id_token
+            )
+        except Exception as e:
+            raise Exception("There was an error deleting the sensor data.")
+
+    def list_devices_for_user(self) -> list:
+        """
+        Returns the ids of the devices that uploaded data under the devices node.
+
+        Returns:
+            list: The device ids, read with a shallow query.
+        """
+        try:
+            keys = self._user_ref().child("devices").shallow().get(token=self.id_token)
+        except Exception as e:
+            raise Exception("There was an error listing the devices.")
+        return sorted(keys.val() or [])
+
+    def list_children_for_user(self, node: str = None) -> list:
+        """
+        Returns the keys of the children of a node under the user.
+
+        Args:
+            node (str): The node under the user, e.g. "devices/<id>", None for the user itself.
+
+        Returns:
+            list: The keys, read with a shallow query.
+        """
+        ref = self._user_ref()
+        if node:
+            ref = ref.child(node)
+        try:
+            keys = ref.shallow().get(token=self.id_token)
+        except Exception as e:
+            raise Exception("There was an error listing the nodes.")
+        return sorted(keys.val() or [])
+
+    def delete_sensor_data_for_user(self, chunk_size: int = 500) -> None:
         """
         Deletes all the sensor data for the user.
         Also deletes the valve_status field for the user.
 
+        Readings are deleted oldest first in chunks of `chunk_size`, so a
+        long history neither needs one huge request nor fails all at once.
+
+        Args:
+            chunk_size (int): The number of readings deleted per request.
+
         Returns:
             None
         """
+        while True:
+            keys = [
+                key
+                for key, _ in self.get_sensor_range_for_user(
+                    "sensor_data", limit=chunk_size
+                )
+            ]
+            self.delete_keys_for_user("sensor_data", keys)
+            if len(keys) < chunk_size:
+                break
         try:
             uid = self.user_info["localId"]
-            self.db.child("users").child(uid).child("sensor_data").remove(
-                token=self.id_token
-            )
             self.db.child("users").child(uid).child("valve_status").remove(
                 token=self.id_token
             )
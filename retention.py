@@ -0,0 +1,333 @@
+import logging
+import math
+import threading
+import time
+from filters import SENSOR_CHANNELS
+from metrics import get_registry
+from realtimedb import BACKFILL_NODE, push_key_for_time, push_key_time
+from wire import decode_reading
+
+logger = logging.getLogger("agribot")
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_retention_deleted_total", "Readings deleted by the retention manager."
+)
+_metrics.describe(
+    "agribot_retention_pass_seconds", "Duration of a retention pass over all nodes."
+)
+
+# Rollup windows the retention manager can fold old readings into
+ROLLUP_WINDOWS = {"1h": 3600, "1d": 86400}
+
+
+class RetentionManager:
+    """
+    Class to keep the sensor data of a user bounded by age.
+
+    Readings older than `max_age` are read oldest first in pages of
+    `chunk_size` with a key-ordered range query, which needs no index rule
+    because push IDs sort by the time they were generated, and every page
+    is deleted with one multi-location update. Requests are spaced to stay
+    under `rate` per second, so a pass over a long backlog never competes
+    with the uploads for the link or the database.
+
+    With `rollup` set, every page is first folded into per-window rollups
+    under sensor_history_<window>, keyed by the window start in
+    milliseconds and in the format WindowAggregator produces. The rollup is
+    written before the page is deleted and records the last key it
+    includes, so a pass that is interrupted resumes without counting any
+    reading twice, and windows spanning several pages are merged with what
+    is already stored.
+
+    The sensor_data_<window> nodes WindowAggregator uploads to, and their
+    per-device variants, are pruned the same way, without folding, once
+    their rollups are older than `rollup_max_age`, and the backfill log
+    entries the pipeline writes with late uploads once they are older than
+    `max_age`. The sensor_history_<window> rollups written here are kept.
+
+    Attributes:
+        db: The RealtimeDB whose data is pruned.
+        max_age: Seconds readings are kept at full resolution.
+        rollup: "1h", "1d" or None to delete without folding.
+        rollup_max_age: Seconds sensor_data_<window> rollups are kept, defaults to max_age.
+        chunk_size: The number of readings read and deleted per request.
+        rate: The maximum number of requests per second.
+        interval: Seconds between passes when running in the background.
+        nodes: The nodes under the user to prune, None for sensor_data, every
+            sensor_data_<window> node, every device and the backfill log.
+        stats: Counters for deleted readings, written rollups, requests and passes.
+
+    Methods:
+        run_once: Prunes every node once.
+        prune: Prunes one node.
+        start: Runs a pass every `interval` seconds on a background thread.
+        stop: Stops the background thread after the current page.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_age: float = 30 * 86400,
+        rollup: str = None,
+        chunk_size: int = 500,
+        rate: float = 2.0,
+        interval: float = 3600.0,
+        nodes: list = None,
+        rollup_max_age: float = None,
+    ) -> None:
+        if rollup is not None and rollup not in ROLLUP_WINDOWS:
+            raise Exception(f"There is no {rollup} rollup window.")
+        self.db = db
+        self.max_age = max_age
+        self.rollup = rollup
+        self.rollup_max_age = max_age if rollup_max_age is None else rollup_max_age
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.interval = interval
+        self.nodes = nodes
+        self.stats = {"deleted": 0, "rollups": 0, "requests": 0, "passes": 0}
+        self._next_request = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def run_once(self, now: float = None) -> int:
+        """
+        Prunes every node once.
+
+        Args:
+            now (float): The current time in seconds since the epoch, defaults to now.
+
+        Returns:
+            int: The number of readings deleted.
+        """
+        now = time.time() if now is None else now
+        cutoff = now - self.max_age
+        if self.rollup is not None:
+            # Only whole windows are folded, so a window is never split
+            # between a rollup and raw readings
+            cutoff -= cutoff % ROLLUP_WINDOWS[self.rollup]
+        nodes = self.nodes
+        window_nodes = []
+        log_nodes = []
+        if nodes is None:
+            nodes = []
+            log_nodes.append(BACKFILL_NODE)
+            self._throttle()
+            prefixes = [""] + [
+                f"devices/{device}/" for device in self.db.list_devices_for_user()
+            ]
+            for prefix in prefixes:
+                nodes.append(prefix + "sensor_data")
+                self._throttle()
+                window_nodes += [
+                    prefix + key
+                    for key in self.db.list_children_for_user(prefix.rstrip("/"))
+                    if key.startswith("sensor_data_")
+                ]
+        window_cutoff = now - self.rollup_max_age
+        deleted = 0
+        with _metrics.timer("agribot_retention_pass_seconds"):
+            for node in nodes:
+                if self._stopped.is_set():
+                    break
+                deleted += self.prune(node, int(cutoff * 1000))
+            for node in window_nodes:
+                if self._stopped.is_set():
+                    break
+                # Already rollups, so they are deleted without folding
+                deleted += self.prune(node, int(window_cutoff * 1000), fold=False)
+            for node in log_nodes:
+                if self._stopped.is_set():
+                    break
+                deleted += self.prune(node, int(cutoff * 1000), fold=False)
+        self.stats["passes"] += 1
+        return deleted
+
+    def prune(self, node: str, cutoff_ms: int, fold: bool = True) -> int:
+        """
+        Deletes, and optionally folds, the readings of a node older than a time.
+
+        Args:
+            node (str): The node under the user, e.g. "sensor_data".
+            cutoff_ms (int): Readings from before this time in milliseconds are pruned.
+            fold (bool): Whether to fold the readings into the `rollup` windows first.
+
+        Returns:
+            int: The number of readings deleted.
+        """
+        end_at = push_key_for_time(cutoff_ms)  # Sorts after every older key
+        history = node.rpartition("sensor_data")[0] + f"sensor_history_{self.rollup}"
+        windows = {}  # Window start in ms -> _Rollup, kept while it may continue
+        deleted = 0
+        while not self._stopped.is_set():
+            self._throttle()
+            page = self.db.get_sensor_range_for_user(
+                node, end_at=end_at, limit=self.chunk_size
+            )
+            if not page:
+                break
+            if fold and self.rollup is not None:
+                self._fold(page, history, windows)
+            self._throttle()
+            self.db.delete_keys_for_user(node, [key for key, _ in page])
+            deleted += len(page)
+            self.stats["deleted"] += len(page)
+            _metrics.inc("agribot_retention_deleted_total", len(page))
+            if len(page) < self.chunk_size:
+                break
+        if deleted:
+            logger.info(
+                "Pruned %s readings from %s.", deleted, node, extra={"count": deleted}
+            )
+        return deleted
+
+    def start(self) -> None:
+        """
+        Runs a pass every `interval` seconds on a background thread.
+
+        Returns:
+            None
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="agribot-retention", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread after the current page.
+
+        Returns:
+            None
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(10.0)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # The next pass picks up where this one stopped
+                logger.warning("Retention pass failed: %s", e)
+            self._stopped.wait(self.interval)
+
+    def _throttle(self) -> None:
+        now = time.monotonic()
+        if self._next_request > now:
+            self._stopped.wait(self._next_request - now)
+        self._next_request = max(now, self._next_request) + 1.0 / self.rate
+        self.stats["requests"] += 1
+
+    def _fold(self, page: list, history: str, windows: dict) -> None:
+        # Folds a page into its windows and writes every window it touched
+        window_ms = ROLLUP_WINDOWS[self.rollup] * 1000
+        touched = []
+        for key, data in page:
+            if not isinstance(data, dict):
+                continue
+            try:
+                captured = push_key_time(key)
+            except ValueError:
+                data = decode_reading(data)
+                captured = data.get("timestamp")  # Not a push ID
+                if not isinstance(captured, int):
+                    continue
+            else:
+                data = decode_reading(data, captured)
+            start = captured // window_ms * window_ms
+            rollup = windows.get(start)
+            if rollup is None:
+                self._throttle()
+                stored = self.db.get_sensor_range_for_user(
+                    history, start_at=str(start), end_at=str(start)
+                )
+                rollup = windows[start] = _Rollup(
+                    start, start + window_ms, stored[0][1] if stored else None
+                )
+            if rollup.add(key, data) and start not in touched:
+                touched.append(start)
+        if touched:
+            self._throttle()
+            self.db.put_rollups_for_user(
+                history, {str(start): windows[start].to_dict() for start in touched}
+            )
+            self.stats["rollups"] += len(touched)
+        # Pages arrive in key order, so only the newest window can continue
+        for start in sorted(windows)[:-1]:
+            del windows[start]
+
+
+class _Rollup:
+    # Running min, max, sum and sum of squares per channel of one window
+
+    def __init__(self, start: int, end: int, stored: dict = None) -> None:
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.last_key = ""
+        self.channels = {}
+        if stored:
+            self.count = stored["count"]
+            self.last_key = stored.get("last_key", "")
+            for channel in SENSOR_CHANNELS:
+                if channel not in stored:
+                    continue
+                values = stored[channel]
+                mean = values["mean"]
+                # Rollups written before channels had their own count
+                count = values.get("count", self.count)
+                self.channels[channel] = [
+                    values["min"],
+                    values["max"],
+                    mean * count,
+                    (values["stddev"] ** 2 + mean**2) * count,
+                    values["last"],
+                    count,
+                ]
+
+    def add(self, key: str, data: dict) -> bool:
+        if key <= self.last_key:
+            return False  # Folded by an interrupted pass before it deleted
+        self.last_key = key
+        finite = False
+        for channel in SENSOR_CHANNELS:
+            value = data.get(channel)
+            if not isinstance(value, (int, float)) or not math.isfinite(value):
+                continue
+            finite = True
+            stats = self.channels.get(channel)
+            if stats is None:
+                self.channels[channel] = [value, value, value, value * value, value, 1]
+                continue
+            stats[0] = min(stats[0], value)
+            stats[1] = max(stats[1], value)
+            stats[2] += value
+            stats[3] += value * value
+            stats[4] = value
+            stats[5] += 1
+        # Like WindowAggregator, count the readings with a finite channel
+        self.count += finite
+        return True
+
+    def to_dict(self) -> dict:
+        result = {
+            "start": self.start,
+            "end": self.end,
+            "count": self.count,
+            "last_key": self.last_key,
+        }
+        for channel, (low, high, total, squares, last, count) in self.channels.items():
+            mean = total / count
+            result[channel] = {
+                "count": count,
+                "min": float(low),
+                "max": float(high),
+                "mean": mean,
+                "stddev": math.sqrt(max(0.0, squares / count - mean * mean)),
+                "last": float(last),
+            }
+        return result
@@ -6,7 +6,131 @@
 #define waterLevelSensorPin A1
 #define relayPin 8
 
+// Host commands are lines starting with "!":
+//   "!B"        switch to binary frames, answered "<ACK,B>"
+//   "!A"        switch back to ASCII frames, answered "<ACK,A>"
+//   "!V<seq>,1" force the pump on, "!V<seq>,0" force it off and "!V<seq>,A"
+//               return to automatic control, answered "<ACK,V,<seq>,<mode>,<pump>>"
+//               as soon as the relay is switched (mode ON, OFF or AUTO).
+// Acknowledgements are sent as text in both modes, between frames.
+
+// Binary frame, selected by the host sending "!B\n" ("!A\n" switches back).
+// Little-endian, matching BINARY_FRAME in frame_parser.py.
+struct __attribute__((packed)) BinaryFrame
+{
+    uint8_t magic[2];    // 0xAA 0x55
+    uint16_t sequence;   // Wraps at 65536, lets the host count lost frames
+    uint16_t humidity;   // Hundredths of a percent, 0xFFFF if the read failed
+    int16_t temperature; // Hundredths of a degree, -32768 if the read failed
+    uint8_t moisture;
+    uint8_t waterLevel;
+    uint8_t valve; // 1 if the pump is on
+    uint16_t crc;  // CRC-16/CCITT-FALSE over sequence..valve
+};
+
 DHT dht(DHTPin, DHTTYPE);
+bool binaryMode = false;
+uint16_t sequence = 0;
+char command[16];
+uint8_t commandLength = 0;
+int8_t valveOverride = -1; // -1 automatic, 0 forced off, 1 forced on
+int soilMoisture = 100;    // Last reading, so a command can switch the relay at once
+
+uint16_t crc16(const uint8_t *data, size_t length)
+{
+    uint16_t crc = 0xFFFF;
+    for (size_t i = 0; i < length; i++)
+    {
+        crc ^= (uint16_t)data[i] << 8;
+        for (uint8_t bit = 0; bit < 8; bit++)
+        {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+void updateRelay()
+{
+    bool pumpOn = valveOverride == -1 ? soilMoisture < 25 : valveOverride == 1;
+    digitalWrite(relayPin, pumpOn ? LOW : HIGH); // The relay is active low
+}
+
+void handleCommand()
+{
+    if (strcmp(command, "!B") == 0)
+    {
+        Serial.println("<ACK,B>");
+        binaryMode = true;
+    }
+    else if (strcmp(command, "!A") == 0)
+    {
+        binaryMode = false;
+        Serial.println("<ACK,A>");
+    }
+    else if (command[1] == 'V')
+    {
+        char *comma = strchr(command, ',');
+        if (comma == NULL)
+        {
+            return;
+        }
+        const char *mode = ",AUTO,";
+        valveOverride = -1;
+        if (comma[1] == '1')
+        {
+            valveOverride = 1;
+            mode = ",ON,";
+        }
+        else if (comma[1] == '0')
+        {
+            valveOverride = 0;
+            mode = ",OFF,";
+        }
+        updateRelay();
+        Serial.print("<ACK,V,");
+        Serial.print(atol(command + 2));
+        Serial.print(mode);
+        Serial.print(digitalRead(relayPin) == LOW ? "ON" : "OFF");
+        Serial.println(">");
+    }
+}
+
+void readCommands()
+{
+    while (Serial.available() > 0)
+    {
+        char c = Serial.read();
+        if (c == '!')
+        {
+            commandLength = 0; // A command always starts afresh
+        }
+        if (c == '\n' || c == '\r')
+        {
+            command[commandLength] = '\0';
+            if (commandLength > 1 && command[0] == '!')
+            {
+                handleCommand();
+            }
+            commandLength = 0;
+        }
+        else if (commandLength < sizeof(command) - 1)
+        {
+            command[commandLength++] = c;
+        }
+    }
+}
+
+// Waits between frames while still answering commands, so a valve command
+// is carried out within a millisecond instead of after the next frame
+void waitForCommands(unsigned long ms)
+{
+    unsigned long start = millis();
+    while (millis() - start < ms)
+    {
+        readCommands();
+    }
+}
 
 void setup()
 {
@@ -22,19 +146,30 @@ void loop()
 {
     float humidity = dht.readHumidity();
     float temperature = dht.readTemperature();
-    int soilMoisture = analogRead(soilMoistureSensorPin);
+    soilMoisture = analogRead(soilMoistureSensorPin);
     soilMoisture = map(soilMoisture, 1023, 0, 0, 100);
     int waterLevel = analogRead(waterLevelSensorPin);
     waterLevel = map(waterLevel, 1023, 0, 0, 100);
     String pumpState = (digitalRead(relayPin) == HIGH) ? "OFF" : "ON";
 
-    if (soilMoisture < 25)
-    {
-        digitalWrite(relayPin, LOW);
-    }
-    else
+    updateRelay();
+    readCommands();
+
+    if (binaryMode)
     {
-        digitalWrite(relayPin, HIGH);
+        BinaryFrame frame;
+        frame.magic[0] = 0xAA;
+        frame.magic[1] = 0x55;
+        frame.sequence = sequence++;
+        frame.humidity = isnan(humidity) ? 0xFFFF : (uint16_t)(humidity * 100 + 0.5);
+        frame.temperature = isnan(temperature) ? INT16_MIN : (int16_t)round(temperature * 100);
+        frame.moisture = constrain(soilMoisture, 0, 100);
+        frame.waterLevel = constrain(waterLevel, 0, 100);
+        frame.valve = pumpState == "ON" ? 1 : 0;
+        frame.crc = crc16((const uint8_t *)&frame.sequence, offsetof(BinaryFrame, crc) - offsetof(BinaryFrame, sequence));
+        Serial.write((const uint8_t *)&frame, sizeof(frame));
+        waitForCommands(100);
+        return;
     }
 
     // Write the data to the serial port
@@ -50,5 +185,5 @@ void loop()
     Serial.print(pumpState);
     Serial.println(">");
 
-    delay(100); // Wait for 100 milliseconds
+    waitForCommands(100); // Wait for 100 milliseconds
 }
@@ -0,0 +1,355 @@
+import argparse
+import fcntl
+import os
+import pty
+import random
+import threading
+import time
+import tty
+import serial
+from frame_parser import encode_binary_frame
+
+
+def load_trace(path: str) -> list:
+    """
+    Loads a trace recorded with record_trace.
+
+    Each line holds the seconds since the start of the recording and the raw
+    frame, e.g. "0.100 <55.00,21.30,40,60,ON>".
+
+    Args:
+        path (str): The path of the trace file.
+
+    Returns:
+        list: (seconds, frame) tuples in recording order.
+    """
+    trace = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                seconds, frame = line.split(" ", 1)
+                trace.append((float(seconds), frame))
+    return trace
+
+
+def record_trace(port: str, path: str, duration: float, baud_rate: int = 9600) -> int:
+    """
+    Records the frames a real board sends, for replay with VirtualArduino.
+
+    Args:
+        port (str): The serial port of the board.
+        path (str): The path of the trace file to write.
+        duration (float): Seconds to record for.
+        baud_rate (int): The baud rate of the board.
+
+    Returns:
+        int: The number of frames recorded.
+    """
+    count = 0
+    with serial.Serial(port, baud_rate, timeout=1) as ser, open(path, "w") as out:
+        started = time.monotonic()
+        while time.monotonic() - started < duration:
+            line = ser.readline().decode("utf-8", "ignore").strip()
+            if line.startswith("<") and line.endswith(">"):
+                out.write(f"{time.monotonic() - started:.3f} {line}\n")
+                count += 1
+    return count
+
+
+class VirtualArduino:
+    """
+    Class to emulate a board running sensors.ino on a pseudo-terminal.
+
+    The simulator emits "<h,t,m,w,valve>" frames, or binary frames after the
+    "!B" handshake, at a configurable rate and never faster than the baud rate
+    allows. It can replay a recorded trace with its original timing or sped up,
+    and inject faults: cut-off frames, line noise and disconnects. "!V" valve
+    commands are answered like sensors.ino does, once per frame. Point
+    AgribotAdmin at `port` as if it were a real serial port.
+
+    Attributes:
+        rate_hz: Frames per second when no trace is replayed.
+        baud_rate: The emulated line speed; a byte takes 10 bits.
+        trace: Optional list of (seconds, frame) tuples to replay.
+        speed: Replay speed factor, 2.0 replays twice as fast.
+        loop: Whether to restart the trace when it ends.
+        partial_rate: Probability that a frame is cut off.
+        noise_rate: Probability that random bytes are sent before a frame.
+        disconnect_every: Seconds between simulated disconnects, None for never.
+        disconnect_for: Seconds the board stays away after a disconnect.
+        link: Optional stable path symlinked to the current pty, which survives disconnects.
+        stats: Counters for frames, bytes, partial frames, noise, disconnects and valve commands.
+
+    Methods:
+        start: Opens the pty and starts emitting frames.
+        stop: Stops emitting frames and closes the pty.
+        port: Returns the path to open, the link if set.
+    """
+
+    def __init__(
+        self,
+        rate_hz: float = 10.0,
+        baud_rate: int = 9600,
+        trace: list = None,
+        speed: float = 1.0,
+        loop: bool = True,
+        partial_rate: float = 0.0,
+        noise_rate: float = 0.0,
+        disconnect_every: float = None,
+        disconnect_for: float = 2.0,
+        link: str = None,
+        seed: int = None,
+    ) -> None:
+        self.rate_hz = rate_hz
+        self.baud_rate = baud_rate
+        self.trace = trace
+        self.speed = speed
+        self.loop = loop
+        self.partial_rate = partial_rate
+        self.noise_rate = noise_rate
+        self.disconnect_every = disconnect_every
+        self.disconnect_for = disconnect_for
+        self.link = link
+        self.stats = {
+            "frames": 0,
+            "bytes": 0,
+            "partial": 0,
+            "noise": 0,
+            "disconnects": 0,
+            "commands": 0,
+        }
+        self._random = random.Random(seed)
+        self._binary = False
+        self._sequence = 0
+        self._commands = b""
+        self._override = None  # Valve forced on or off by a "!V" command
+        self._values = [60.0, 22.0, 50.0, 70.0]
+        self._master = None
+        self._slave = None
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self) -> str:
+        """
+        Returns the path to open, the link if set.
+
+        Returns:
+            str: The serial port path.
+        """
+        return self.link or os.ttyname(self._slave)
+
+    def start(self) -> None:
+        """
+        Opens the pty and starts emitting frames.
+
+        Returns:
+            None
+        """
+        self._open()
+        self._running.set()
+        self._thread = threading.Thread(
+            target=self._run, name="agribot-simulator", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops emitting frames and closes the pty.
+
+        Returns:
+            None
+        """
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(5.0)
+        self._close()
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+    def _open(self) -> None:
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        # A real board doesn't wait for a reader: drop bytes nobody reads
+        flags = fcntl.fcntl(self._master, fcntl.F_GETFL)
+        fcntl.fcntl(self._master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # A board comes back from a reset in ASCII mode and in auto
+        self._binary = False
+        self._override = None
+        if self.link:
+            tmp_link = self.link + ".tmp"
+            if os.path.lexists(tmp_link):
+                os.unlink(tmp_link)
+            os.symlink(os.ttyname(self._slave), tmp_link)
+            os.replace(tmp_link, self.link)
+
+    def _close(self) -> None:
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _frames(self):
+        # Yields (delay, frame) pairs, frame being the ASCII text
+        if self.trace:
+            while True:
+                previous = self.trace[0][0]
+                for seconds, frame in self.trace:
+                    yield (seconds - previous) / self.speed, frame
+                    previous = seconds
+                if not self.loop:
+                    return
+        while True:
+            # A slow random walk, so deadbands and rollups see realistic data
+            limits = (100.0, 40.0, 100.0, 100.0)
+            steps = (0.3, 0.1, 1.0, 1.0)
+            for i, (limit, step) in enumerate(zip(limits, steps)):
+                value = self._values[i] + self._random.uniform(-step, step)
+                self._values[i] = min(limit, max(0.0, value))
+            humidity, temperature, moisture, water_level = self._values
+            pump_on = moisture < 25 if self._override is None else self._override
+            valve = "ON" if pump_on else "OFF"
+            yield 1.0 / self.rate_hz, (
+                f"<{humidity:.2f},{temperature:.2f},{int(moisture)},{int(water_level)},{valve}>"
+            )
+
+    def _encode(self, frame: str) -> bytes:
+        if not self._binary:
+            return frame.encode() + b"\r\n"
+        parts = frame[1:-1].split(",")
+        self._sequence += 1
+        return encode_binary_frame(
+            self._sequence,
+            float(parts[0]),
+            float(parts[1]),
+            int(float(parts[2])),
+            int(float(parts[3])),
+            parts[4] in ("1", "ON"),
+        )
+
+    def _handle_commands(self) -> None:
+        try:
+            self._commands += os.read(self._master, 1024)
+        except (BlockingIOError, OSError):
+            return
+        *lines, self._commands = self._commands.split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if line in (b"!B", b"!A"):
+                self._write(b"<ACK," + line[1:] + b">\r\n")
+                self._binary = line == b"!B"
+            elif line.startswith(b"!V") and b"," in line:
+                sequence, state = line[2:].split(b",", 1)
+                self._override = {b"1": True, b"0": False}.get(state)
+                mode = {True: b"ON", False: b"OFF", None: b"AUTO"}[self._override]
+                pump_on = (
+                    self._values[2] < 25 if self._override is None else self._override
+                )
+                self._write(
+                    b"<ACK,V,%s,%s,%s>\r\n"
+                    % (sequence, mode, b"ON" if pump_on else b"OFF")
+                )
+                self.stats["commands"] += 1
+        self._commands = self._commands[-16:]
+
+    def _write(self, payload: bytes) -> None:
+        try:
+            os.write(self._master, payload)
+            self.stats["bytes"] += len(payload)
+        except (BlockingIOError, OSError):
+            pass
+        # Hold the line for as long as the bytes take at this baud rate
+        time.sleep(len(payload) * 10 / self.baud_rate)
+
+    def _disconnect(self) -> None:
+        self.stats["disconnects"] += 1
+        self._close()
+        time.sleep(self.disconnect_for)
+        self._open()
+
+    def _run(self) -> None:
+        next_disconnect = (
+            time.monotonic() + self.disconnect_every if self.disconnect_every else None
+        )
+        due = time.monotonic()
+        for delay, frame in self._frames():
+            due += delay
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if not self._running.is_set():
+                return
+            if next_disconnect is not None and time.monotonic() >= next_disconnect:
+                self._disconnect()
+                next_disconnect = time.monotonic() + self.disconnect_every
+                due = time.monotonic()
+            self._handle_commands()
+            payload = self._encode(frame)
+            if self._random.random() < self.noise_rate:
+                noise = bytes(
+                    self._random.randrange(256)
+                    for _ in range(self._random.randint(1, 8))
+                )
+                self._write(noise)
+                self.stats["noise"] += 1
+            if self._random.random() < self.partial_rate:
+                payload = payload[: self._random.randrange(1, len(payload))]
+                self.stats["partial"] += 1
+            self._write(payload)
+            self.stats["frames"] += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Emulate an Arduino running sensors.ino on a pseudo-terminal."
+    )
+    parser.add_argument("--rate", type=float, default=10.0, help="frames per second")
+    parser.add_argument("--baud", type=int, default=9600, help="emulated baud rate")
+    parser.add_argument("--trace", help="replay a trace recorded with --record")
+    parser.add_argument("--speed", type=float, default=1.0, help="trace replay speed")
+    parser.add_argument("--partial", type=float, default=0.0, help="cut-off frame rate")
+    parser.add_argument("--noise", type=float, default=0.0, help="line noise rate")
+    parser.add_argument(
+        "--disconnect-every", type=float, help="seconds between disconnects"
+    )
+    parser.add_argument(
+        "--disconnect-for", type=float, default=2.0, help="seconds per disconnect"
+    )
+    parser.add_argument(
+        "--link", default="/tmp/agribot-sim", help="stable path to the current pty"
+    )
+    parser.add_argument("--record", help="record a trace from this real port instead")
+    parser.add_argument(
+        "--duration", type=float, default=60.0, help="seconds to record for"
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.record:
+        path = args.trace or "trace.txt"
+        count = record_trace(args.record, path, args.duration, args.baud)
+        print(f"Recorded {count} frames to {path}.")
+    else:
+        simulator = VirtualArduino(
+            rate_hz=args.rate,
+            baud_rate=args.baud,
+            trace=load_trace(args.trace) if args.trace else None,
+            speed=args.speed,
+            partial_rate=args.partial,
+            noise_rate=args.noise,
+            disconnect_every=args.disconnect_every,
+            disconnect_for=args.disconnect_for,
+            link=args.link,
+            seed=args.seed,
+        )
+        simulator.start()
+        print(
+            f"Virtual Arduino on {simulator.port} at {args.baud} baud. Ctrl+C to stop."
+        )
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            simulator.stop()
+            print(simulator.stats)
@@ -0,0 +1,189 @@
+import json
+import sqlite3
+import threading
+import time
+from reading import to_wire
+
+
+class SensorSpool:
+    """
+    Class to keep sensor readings on disk until they are uploaded.
+
+    Readings are committed to an SQLite database in WAL mode before they are
+    queued for upload and are only deleted once the upload succeeded, so
+    nothing read during a connectivity gap or before a crash is lost.
+    Readings the database refuses to store are moved to a separate
+    rejected table instead, where they stay for inspection.
+
+    Attributes:
+        path: The path of the SQLite database file.
+        conn: The SQLite connection, shared between threads behind a lock.
+
+    Methods:
+        append: Commits a reading to the spool.
+        pending: Returns the oldest readings still waiting to be uploaded.
+        ack: Deletes readings that were uploaded successfully.
+        reject: Moves readings the database refused out of the upload backlog.
+        count: Returns the number of readings in the spool.
+        rejected_count: Returns the number of rejected readings.
+        close: Closes the database connection.
+    """
+
+    def __init__(self, path: str = "agribot_spool.db") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL survives process crashes and only risks
+        # the last transactions on power loss, at a fraction of the fsyncs.
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS readings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                push_key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                valve_status TEXT,
+                created_at REAL NOT NULL,
+                node TEXT NOT NULL DEFAULT 'sensor_data'
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rejected (
+                id INTEGER PRIMARY KEY,
+                push_key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                valve_status TEXT,
+                created_at REAL NOT NULL,
+                node TEXT NOT NULL,
+                rejected_at REAL NOT NULL
+            )
+            """
+        )
+        # Spools written before rollups existed have no node column
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(readings)")]
+        if "node" not in columns:
+            self.conn.execute(
+                "ALTER TABLE readings ADD COLUMN node TEXT NOT NULL DEFAULT 'sensor_data'"
+            )
+        self.conn.commit()
+
+    def append(
+        self, push_key: str, data, valve_status: str, node: str = "sensor_data"
+    ) -> int:
+        """
+        Commits a reading to the spool.
+
+        Args:
+            push_key (str): The push key the reading will be stored under.
+            data (Reading | dict): The sensor data, stored in its wire format.
+            valve_status (str): The valve_status reported with the reading.
+            node (str): The node under the user the reading is pushed to.
+
+        Returns:
+            int: The spool id of the reading.
+        """
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT INTO readings (push_key, data, valve_status, created_at, node) VALUES (?, ?, ?, ?, ?)",
+                (push_key, json.dumps(to_wire(data)), valve_status, time.time(), node),
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def pending(self, limit: int = 100, exclude=()) -> list:
+        """
+        Returns the oldest readings still waiting to be uploaded.
+
+        Args:
+            limit (int): The maximum number of readings to return.
+            exclude (set): Spool ids to skip, e.g. readings already queued for upload.
+
+        Returns:
+            list: (id, push_key, data, valve_status, created_at, node) tuples, oldest first.
+        """
+        rows = []
+        after = 0
+        with self._lock:
+            while len(rows) < limit:
+                chunk = self.conn.execute(
+                    "SELECT id, push_key, data, valve_status, created_at, node FROM readings WHERE id > ? ORDER BY id LIMIT ?",
+                    (after, limit),
+                ).fetchall()
+                if not chunk:
+                    break
+                after = chunk[-1][0]
+                rows += [row for row in chunk if row[0] not in exclude]
+        return [
+            (row_id, push_key, json.loads(data), valve_status, created_at, node)
+            for row_id, push_key, data, valve_status, created_at, node in rows[:limit]
+        ]
+
+    def ack(self, ids: list) -> None:
+        """
+        Deletes readings that were uploaded successfully.
+
+        Args:
+            ids (list): The spool ids of the uploaded readings.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.executemany(
+                "DELETE FROM readings WHERE id = ?", [(i,) for i in ids]
+            )
+            self.conn.commit()
+
+    def reject(self, ids: list) -> None:
+        """
+        Moves readings the database refused to store to the rejected table.
+
+        Args:
+            ids (list): The spool ids of the rejected readings.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rejected SELECT id, push_key, data, valve_status, created_at, node, ? FROM readings WHERE id = ?",
+                [(now, i) for i in ids],
+            )
+            self.conn.executemany(
+                "DELETE FROM readings WHERE id = ?", [(i,) for i in ids]
+            )
+            self.conn.commit()
+
+    def rejected_count(self) -> int:
+        """
+        Returns the number of readings the database refused to store.
+
+        Returns:
+            int: The number of rejected readings.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM rejected").fetchone()[0]
+
+    def count(self) -> int:
+        """
+        Returns the number of readings in the spool.
+
+        Returns:
+            int: The number of readings not yet acknowledged.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,50 @@
+import random
+import time
+from realtimedb import push_key_for_time
+from reading import to_wire
+
+
+class FakeDB:
+    """
+    Class to stand in for RealtimeDB with an in-memory tree of nodes.
+
+    Attributes:
+        nodes: Maps node paths to dicts of their children.
+        requests: The nodes of every range read, in order.
+        batch_size: The batch size of the pipeline.
+        max_linger: The linger of the pipeline.
+    """
+
+    def __init__(self) -> None:
+        self.nodes = {}
+        self.requests = []
+        self.batch_size = 10
+        self.max_linger = 0.1
+
+    def generate_push_key(self, ms: int = None) -> str:
+        ms = int(time.time() * 1000) if ms is None else ms
+        return push_key_for_time(ms) + "".join(
+            random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(12)
+        )
+
+    def push_sensor_batch_for_user(
+        self, readings, valve_status=None, keys=None, nodes=None
+    ) -> None:
+        for key, data, node in zip(keys, readings, nodes):
+            self.nodes.setdefault(node, {})[key] = to_wire(data)
+        if isinstance(valve_status, dict):
+            for path, value in valve_status.items():
+                node, _, key = path.rpartition("/")
+                self.nodes.setdefault(node, {})[key] = value
+
+    def get_sensor_range_for_user(
+        self, node="sensor_data", start_at=None, end_at=None, limit=None
+    ) -> list:
+        self.requests.append(node)
+        items = [
+            (key, value)
+            for key, value in sorted(self.nodes.get(node, {}).items())
+            if (start_at is None or key >= start_at)
+            and (end_at is None or key <= end_at)
+        ]
+        return items[:limit] if limit is not None else items
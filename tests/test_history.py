@@ -0,0 +1,53 @@
+import time
+from fakes import FakeDB
+from history import SensorHistory
+from pipeline import IngestPipeline
+from reading import Reading
+
+
+def upload(db, captured: float) -> None:
+    # Through the pipeline, which logs late uploads with them
+    key = db.generate_push_key(int(captured * 1000))
+    reading = Reading(55.0, 21.5, 40.0, 60.0, "off", captured)
+    IngestPipeline(lambda: None, db)._push(
+        [[key, reading, None, None, None, "sensor_data"]]
+    )
+
+
+def test_backfilled_reading_after_sync(tmp_path):
+    db = FakeDB()
+    now = time.time()
+    upload(db, now - 10)
+    history = SensorHistory(db, str(tmp_path / "history.db"))
+    assert history.sync() == 1
+
+    # Replayed from the spool after an outage, after the sync moved past it
+    upload(db, now - 7200)
+    end = now - 3600
+    assert [row[0] for row in history.query(now - 7300, end)] == [
+        int((now - 7200) * 1000)
+    ]
+    # Fetched once, later queries of the range are answered from the cache
+    requests = len(db.requests)
+    assert len(history.query(now - 7300, end)) == 1
+    assert db.requests[requests:] == ["sensor_backfill"]
+    history.close()
+
+
+def test_backfill_logged_before_first_sync_is_not_fetched_again(tmp_path):
+    db = FakeDB()
+    now = time.time()
+    upload(db, now - 7200)
+    history = SensorHistory(db, str(tmp_path / "history.db"))
+    assert history.sync() == 1
+    requests = len(db.requests)
+    history.sync()
+    # Only the log and the incremental page, the full sync had the range
+    assert db.requests[requests:] == ["sensor_backfill", "sensor_data"]
+    history.close()
+
+
+def test_live_uploads_are_not_logged():
+    db = FakeDB()
+    upload(db, time.time())
+    assert "sensor_backfill" not in db.nodes
@@ -0,0 +1,54 @@
+import time
+from types import SimpleNamespace
+from fakes import FakeDB
+from pipeline import IngestPipeline
+from reading import Reading
+from spool import SensorSpool
+
+
+class ExpiringDB(FakeDB):
+    """
+    Class to stand in for RealtimeDB refusing uploads with 401 until the token is refreshed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.id_token = "expired"
+
+    def push_sensor_batch_for_user(self, *args, **kwargs) -> None:
+        if self.id_token == "expired":
+            error = Exception("401 Client Error: Unauthorized")
+            error.response = SimpleNamespace(status_code=401, headers={})
+            raise error
+        super().push_sensor_batch_for_user(*args, **kwargs)
+
+
+def test_expired_token_is_refreshed_and_nothing_rejected(tmp_path):
+    db = ExpiringDB()
+    spool = SensorSpool(str(tmp_path / "spool.db"))
+    readings = [Reading(55.0, 21.5, 40.0, 60.0, "off", time.time()) for _ in range(20)]
+
+    def read_frame():
+        if readings:
+            return readings.pop()
+        time.sleep(0.01)
+
+    pipeline = IngestPipeline(
+        read_frame,
+        db,
+        retry_delay=0.01,
+        spool=spool,
+        refresh_token=lambda: setattr(db, "id_token", "fresh"),
+    )
+    pipeline.start()
+    deadline = time.monotonic() + 5
+    while len(db.nodes.get("sensor_data", {})) < 20 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pipeline.stop()
+
+    assert len(db.nodes["sensor_data"]) == 20
+    assert pipeline.stats["failed"] > 0
+    assert pipeline.stats["rejected"] == 0
+    assert spool.rejected_count() == 0
+    assert spool.count() == 0
+    spool.close()
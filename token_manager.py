@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+
+
+class TokenManager:
+    """
+    Class to cache Firebase tokens on disk and refresh the ID token before it expires.
+
+    ID tokens are only valid for an hour. The refresh token is kept in a file
+    readable only by the current user, so a restart can skip the password
+    prompt, and a background thread swaps in a fresh ID token ahead of expiry.
+
+    Attributes:
+        auth: The FirebaseAuthenticator used to sign in and refresh tokens.
+        cache_path: The path of the token cache file.
+        refresh_margin: Seconds before expiry at which the ID token is refreshed.
+        user_info: The localId, email, idToken and refreshToken of the signed-in user.
+        expires_at: The wall clock time at which the current ID token expires.
+
+    Methods:
+        load: Restores the session from the cache, refreshing the ID token if needed.
+        sign_in: Signs in with email and password and caches the tokens.
+        refresh: Exchanges the refresh token for a new ID token.
+        subscribe: Registers a callback that receives every new ID token.
+        start: Starts the background refresh thread.
+        stop: Stops the background refresh thread.
+    """
+
+    def __init__(
+        self,
+        auth,
+        cache_path: str = os.path.join("~", ".agribot", "token.json"),
+        refresh_margin: float = 300.0,
+    ) -> None:
+        self.auth = auth
+        self.cache_path = os.path.expanduser(cache_path)
+        self.refresh_margin = refresh_margin
+        self.user_info = None
+        self.expires_at = 0.0
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self, email: str) -> bool:
+        """
+        Restores the session from the cache, refreshing the ID token if needed.
+
+        A cached ID token that is still valid is used without any network
+        request; otherwise the cached refresh token costs one round-trip.
+
+        Args:
+            email (str): The email the session must belong to.
+
+        Returns:
+            bool: True if a usable session was restored.
+        """
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return False
+        if cached.get("email") != email or not cached.get("refreshToken"):
+            return False
+        self.user_info = cached["user_info"]
+        self.expires_at = cached.get("expiresAt", 0.0)
+        if self.expires_at - time.time() > self.refresh_margin:
+            return True
+        try:
+            self.refresh()
+        except Exception:
+            self.user_info = None
+            return False
+        return True
+
+    def sign_in(self, email: str, password: str) -> dict:
+        """
+        Signs in with email and password and caches the tokens.
+
+        Args:
+            email (str): The user's email address.
+            password (str): The user's password.
+
+        Returns:
+            dict: The user information, including the idToken and localId.
+        """
+        user_info = self.auth.sign_in_with_email_and_password(email, password)
+        with self._lock:
+            self.user_info = user_info
+            self.expires_at = time.time() + int(user_info.get("expiresIn", 3600))
+            self._save()
+        return user_info
+
+    def refresh(self) -> str:
+        """
+        Exchanges the refresh token for a new ID token and notifies the subscribers.
+
+        Returns:
+            str: The new ID token.
+        """
+        response = self.auth.refresh_id_token(self.user_info["refreshToken"])
+        with self._lock:
+            self.user_info = dict(
+                self.user_info,
+                idToken=response["id_token"],
+                refreshToken=response["refresh_token"],
+            )
+            self.expires_at = time.time() + int(response["expires_in"])
+            self._save()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(response["id_token"])
+        return response["id_token"]
+
+    def subscribe(self, callback) -> None:
+        """
+        Registers a callback that receives every new ID token.
+
+        Args:
+            callback (callable): Called with the new ID token after each refresh.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def start(self) -> None:
+        """
+        Starts the background refresh thread.
+
+        Returns:
+            None
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="agribot-token-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background refresh thread.
+
+        Returns:
+            None
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
+
+    def _refresh_loop(self) -> None:
+        retry_delay = 5.0
+        while not self._stopped.is_set():
+            wait = self.expires_at - self.refresh_margin - time.time()
+            if wait > 0 and self._stopped.wait(wait):
+                return
+            try:
+                self.refresh()
+                retry_delay = 5.0
+            except Exception:
+                # The old token stays valid for up to refresh_margin seconds
+                if self._stopped.wait(retry_delay):
+                    return
+                retry_delay = min(retry_delay * 2, 60.0)
+
+    def _save(self) -> None:
+        # Must be called with self._lock held. The file is written with
+        # owner-only permissions and swapped in atomically.
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(
+                {
+                    "email": self.user_info.get("email"),
+                    "refreshToken": self.user_info.get("refreshToken"),
+                    "expiresAt": self.expires_at,
+                    "user_info": {
+                        key: self.user_info.get(key)
+                        for key in ("localId", "email", "idToken", "refreshToken")
+                    },
+                },
+                cache_file,
+            )
+        os.replace(tmp_path, self.cache_path)
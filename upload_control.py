@@ -0,0 +1,295 @@
+import logging
+import random
+import threading
+import time
+from metrics import get_registry
+
+logger = logging.getLogger("agribot")
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_upload_backoff_seconds", "Delays before retrying a failed upload."
+)
+_metrics.describe(
+    "agribot_upload_circuit_trips_total", "Times the upload circuit breaker opened."
+)
+
+CIRCUIT_STATES = ("closed", "open", "half_open")
+# Besides 5xx, the statuses that mean "try again later"
+RETRYABLE_STATUSES = (408, 429)
+# An expired or revoked ID token, e.g. after an outage longer than its
+# lifetime: the same request succeeds once the token is refreshed
+AUTH_STATUSES = (401, 403)
+
+
+class UploadController:
+    """
+    Class to adapt the upload batch size and flush interval to what the link sustains.
+
+    Batches that come back within `target_latency` and were full grow the
+    batch size by an eighth, and let partial batches flush sooner; slow
+    batches shrink it by a quarter and let batches linger longer. A failure
+    halves the batch size and doubles the flush interval.
+
+    Failed uploads are retried after an exponential backoff with jitter,
+    at least as long as a Retry-After header asks for. Throttling (429),
+    timeouts, connection errors and 5xx responses count towards the
+    circuit breaker: after `failure_threshold` of them in a row it opens
+    and no upload is sent for `open_for` seconds, doubled every time it
+    opens again, while readings wait in the queue and overflow to the
+    spool. After that, one probe batch is let through: success closes the
+    breaker, failure opens it again.
+
+    Attributes:
+        batch_size: The current number of readings per batch.
+        linger: The current maximum time in seconds a reading waits for a batch.
+        min_batch: The smallest batch size.
+        max_batch: The largest batch size.
+        min_linger: The shortest flush interval.
+        max_linger: The longest flush interval.
+        target_latency: Upload latency in seconds above which batches shrink.
+        failure_threshold: Consecutive retryable failures that open the breaker.
+        open_for: Seconds the breaker first stays open.
+        max_open_for: The longest the breaker stays open.
+        base_backoff: The backoff after the first failure, in seconds.
+        max_backoff: The longest backoff, in seconds.
+        state: "closed", "open" or "half_open".
+        latency: Moving average of the upload latency in seconds.
+        stats: Counters for successes, failures, backoffs, trips and probes.
+
+    Methods:
+        admit: Returns how long to wait before sending an upload.
+        record_success: Adapts to a successful upload.
+        record_failure: Backs off after a failed upload.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 10,
+        max_linger: float = 5.0,
+        min_batch: int = 1,
+        max_batch: int = 500,
+        min_linger: float = 0.5,
+        target_latency: float = 1.0,
+        failure_threshold: int = 5,
+        open_for: float = 10.0,
+        max_open_for: float = 300.0,
+        base_backoff: float = 0.5,
+        max_backoff: float = 60.0,
+        seed: int = None,
+    ) -> None:
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.min_linger = min(min_linger, max_linger)
+        self.max_linger = max_linger
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.open_for = open_for
+        self.max_open_for = max_open_for
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = "closed"
+        self.latency = None
+        self.linger = max_linger
+        self.stats = {
+            "successes": 0,
+            "failures": 0,
+            "backoffs": 0,
+            "trips": 0,
+            "probes": 0,
+        }
+        self._size = float(max(min_batch, min(max_batch, batch_size)))
+        self._failures = 0  # Consecutive failures
+        self._retryable_failures = 0  # Consecutive failures the breaker counts
+        self._next_open_for = open_for
+        self._retry_at = 0.0
+        self._probing = False
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self) -> int:
+        """
+        Returns the current number of readings per batch.
+
+        Returns:
+            int: The batch size.
+        """
+        return int(self._size)
+
+    def admit(self) -> float:
+        """
+        Returns how long to wait before sending an upload.
+
+        When the breaker is half open, the first caller is admitted as the
+        probe and every other caller waits until its outcome is recorded.
+
+        Returns:
+            float: 0.0 if the upload may be sent now, otherwise seconds to wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._retry_at:
+                return self._retry_at - now
+            if self.state == "open":
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    return min(1.0, self.base_backoff)
+                self._probing = True
+                self.stats["probes"] += 1
+            return 0.0
+
+    def record_success(self, latency: float, count: int) -> None:
+        """
+        Adapts the batch size and flush interval to a successful upload.
+
+        Args:
+            latency (float): Seconds the upload took.
+            count (int): The number of readings in the batch.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.stats["successes"] += 1
+            if self.state != "closed":
+                logger.info("Uploads resumed.")
+            self.state = "closed"
+            self._probing = False
+            self._failures = 0
+            self._retryable_failures = 0
+            self._next_open_for = self.open_for
+            self._retry_at = 0.0
+            self.latency = (
+                latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            )
+            if latency > self.target_latency:
+                self._size *= 0.75
+                self.linger *= 1.5
+            else:
+                if count >= self.batch_size:
+                    # Readings are waiting, so a bigger batch moves more per request
+                    self._size += max(1.0, self._size / 8)
+                self.linger *= 0.9
+            self._clamp()
+
+    def record_failure(self, error: Exception) -> float:
+        """
+        Backs off after a failed upload, opening the breaker if the link looks down.
+
+        Args:
+            error (Exception): The exception raised by the upload.
+
+        Returns:
+            float: Seconds until the next upload is admitted.
+        """
+        response = _response(error)
+        status = None if response is None else response.status_code
+        retryable = status is None or status in RETRYABLE_STATUSES or status >= 500
+        with self._lock:
+            now = time.monotonic()
+            self.stats["failures"] += 1
+            self._failures += 1
+            self._retryable_failures = self._retryable_failures + 1 if retryable else 0
+            self._size /= 2  # Also what a 413 Payload Too Large needs
+            self.linger *= 2
+            self._clamp()
+            ceiling = min(
+                self.max_backoff, self.base_backoff * 2 ** (self._failures - 1)
+            )
+            delay = self._random.uniform(ceiling / 2, ceiling)
+            retry_after = _retry_after(response)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.max_open_for))
+            if self.state == "open":
+                # Another uploader failed before the breaker opened
+                delay = max(delay, self._retry_at - now)
+            elif self.state == "half_open" or (
+                retryable and self._retryable_failures >= self.failure_threshold
+            ):
+                self.stats["trips"] += 1
+                _metrics.inc("agribot_upload_circuit_trips_total")
+                logger.warning(
+                    "Uploads paused for %.0f s after %s failures (last status %s).",
+                    self._next_open_for,
+                    self._failures,
+                    status,
+                )
+                self.state = "open"
+                delay = max(delay, self._next_open_for)
+                self._next_open_for = min(self.max_open_for, self._next_open_for * 2)
+            self._probing = False
+            self._retry_at = now + delay
+            self.stats["backoffs"] += 1
+            _metrics.observe("agribot_upload_backoff_seconds", delay)
+            return delay
+
+    def _clamp(self) -> None:
+        # Must be called with self._lock held
+        self._size = max(self.min_batch, min(self.max_batch, self._size))
+        self.linger = max(self.min_linger, min(self.max_linger, self.linger))
+
+
+def is_rejected(error: Exception) -> bool:
+    """
+    Returns whether an upload failed because of what it sent rather than the link.
+
+    Every 4xx status except 408, 429, 401 and 403 means the database will
+    refuse the same request again, e.g. a 400 for a value it cannot store
+    or a 413 for a batch that is too large, so resending it would block
+    everything queued behind it.
+
+    Args:
+        error (Exception): The exception raised by the upload.
+
+    Returns:
+        bool: True for a 4xx other than 408, 429, 401 and 403, False for 5xx and
+            connection errors.
+    """
+    response = _response(error)
+    status = None if response is None else response.status_code
+    return (
+        status is not None
+        and 400 <= status < 500
+        and status not in RETRYABLE_STATUSES + AUTH_STATUSES
+    )
+
+
+def is_auth_failure(error: Exception) -> bool:
+    """
+    Returns whether an upload failed because the ID token expired or was revoked.
+
+    Args:
+        error (Exception): The exception raised by the upload.
+
+    Returns:
+        bool: True for a 401 or 403.
+    """
+    response = _response(error)
+    return response is not None and response.status_code in AUTH_STATUSES
+
+
+def _retry_after(response) -> float:
+    # Only the delay-seconds form; Firebase does not send HTTP dates
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _response(error: Exception):
+    # The Firebase clients wrap HTTP errors in their own exceptions, so the
+    # causes and contexts of the error are searched for a response
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        for candidate in (error,) + tuple(error.args):
+            response = getattr(candidate, "response", None)
+            if getattr(response, "status_code", None) is not None:
+                return response
+        error = error.__cause__ or error.__context__
+    return None
@@ -0,0 +1,550 @@
+import collections
+import json
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+from frame_parser import encode_valve_command
+from metrics import get_registry
+
+logger = logging.getLogger("agribot")
+
+_metrics = get_registry()
+_metrics.describe(
+    "agribot_valve_command_seconds",
+    "Valve command latency by stage: delivery from the dashboard to the "
+    "gateway, serial from the write to the board's acknowledgement, actuation "
+    "from receipt to acknowledgement and total from the dashboard to acknowledgement.",
+)
+_metrics.describe("agribot_valve_commands_total", "Valve commands by result.")
+
+VALVE_STATES = {"on": "1", "off": "0", "auto": "A"}
+
+
+class ValveCommandStream:
+    """
+    Class to follow a node of the Realtime Database over a streaming (SSE) connection.
+
+    Firebase pushes a "put" with the whole node as soon as the stream opens
+    and a "put" or "patch" on every change after that, so a command reaches
+    the gateway within one network round-trip and nothing is polled. The
+    node is mirrored locally and handed to the handler after every change.
+    The stream reconnects with exponential backoff and jitter when the
+    connection drops, the server stops sending keep-alives or the ID token
+    is revoked; the fresh snapshot after a reconnect is handed over like
+    any other change, so the handler must skip commands it already applied.
+
+    Attributes:
+        db: The RealtimeDB whose user, token and connection pool are used.
+        handler: Callable receiving the node value after every change.
+        path: The node under the user that is followed.
+        read_timeout: Seconds without any event, keep-alives included, after which the stream is reopened.
+        max_backoff: The longest wait in seconds between reconnection attempts.
+        value: The current value of the node.
+        connected: Whether the stream is open.
+        stats: Counters for connects, events, keep-alives and errors.
+
+    Methods:
+        start: Opens the stream on a background thread.
+        stop: Closes the stream.
+    """
+
+    def __init__(
+        self,
+        db,
+        handler,
+        path: str = "valve_command",
+        read_timeout: float = 75.0,
+        max_backoff: float = 30.0,
+    ) -> None:
+        self.db = db
+        self.handler = handler
+        self.path = path
+        self.read_timeout = read_timeout  # Firebase sends a keep-alive every 30 s
+        self.max_backoff = max_backoff
+        self.value = None
+        self.connected = False
+        self.stats = collections.Counter()
+        self._response = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        Opens the stream on a background thread.
+
+        Returns:
+            None
+        """
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="agribot-valve-stream", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Closes the stream.
+
+        Returns:
+            None
+        """
+        self._stopped.set()
+        response = self._response
+        if response is not None:
+            # Closing alone does not wake a thread blocked in recv
+            sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            response.close()
+        if self._thread is not None:
+            self._thread.join(5.0)
+
+    def _run(self) -> None:
+        backoff = 0.0
+        while not self._stopped.is_set():
+            opened = time.monotonic()
+            events = self.stats["events"]
+            try:
+                if self._listen():
+                    continue  # Revoked token: reopen with the fresh one at once
+            except Exception as e:
+                if self._stopped.is_set():
+                    return
+                self.stats["errors"] += 1
+                logger.warning("Valve command stream lost: %s", e)
+            finally:
+                self.connected = False
+                self._response = None
+            # A stream that stayed up through a keep-alive interval is reopened
+            # at once and one that delivered data soon; streams that keep
+            # failing before any data arrives back off further
+            if time.monotonic() - opened > 30.0:
+                backoff = 0.0
+            elif self.stats["events"] > events:
+                backoff = 0.25
+            else:
+                backoff = min(max(backoff * 2, 0.25), self.max_backoff)
+            self._stopped.wait(backoff * random.uniform(0.5, 1.0))
+
+    def _listen(self) -> bool:
+        # Returns True if the server revoked the token, so the caller
+        # reconnects at once
+        url = self.db.valve_command_url(self.path)
+        response = self.db.pool.session.get(
+            url,
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(5.0, self.read_timeout),
+        )
+        self._response = response
+        if response.status_code != 200:
+            response.close()
+            raise Exception(f"The stream was refused with HTTP {response.status_code}.")
+        self.connected = True
+        self.stats["connects"] += 1
+        event = None
+        data = []
+        for line in response.iter_lines(chunk_size=1024, decode_unicode=True):
+            if self._stopped.is_set():
+                return False
+            if line:
+                field, _, text = line.partition(":")
+                if field == "event":
+                    event = text.strip()
+                elif field == "data":
+                    data.append(text[1:] if text.startswith(" ") else text)
+                continue
+            if event is None:
+                continue  # A blank line without an event
+            if self._dispatch(event, "\n".join(data)):
+                return True
+            event = None
+            data = []
+        raise Exception("The server closed the stream.")
+
+    def _dispatch(self, event: str, data: str) -> bool:
+        if event == "keep-alive":
+            self.stats["keepalives"] += 1
+            return False
+        if event == "auth_revoked":
+            self.stats["revoked"] += 1
+            return True
+        if event == "cancel":
+            raise Exception("The stream was cancelled, check the database rules.")
+        if event not in ("put", "patch"):
+            return False
+        self.stats["events"] += 1
+        message = json.loads(data)
+        keys = [key for key in message["path"].split("/") if key]
+        if event == "put":
+            self.value = _put(self.value, keys, message["data"])
+        else:
+            for key, value in message["data"].items():
+                self.value = _put(
+                    self.value, keys + [k for k in key.split("/") if k], value
+                )
+        self.handler(self.value)
+        return False
+
+
+def _mode_key(device) -> str:
+    # JSON keys are strings, so a single board is stored under ""
+    return "" if device is None else str(device)
+
+
+def _put(node, keys: list, value):
+    # Sets value at keys below node, pruning empty dicts like Firebase does
+    if not keys:
+        return value
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _put(node.get(keys[0]), keys[1:], value)
+    if child is None or child == {}:
+        node.pop(keys[0], None)
+    else:
+        node[keys[0]] = child
+    return node or None
+
+
+class ValveController:
+    """
+    Class to forward valve commands from the database to the boards exactly once.
+
+    A command is a dict with an "id" that changes with every command, a
+    "state" of "on", "off" or "auto" and optionally the "device" it is for
+    and the server time it was "issued_at". The id of the last command
+    taken is stored on disk before it is forwarded, so neither a stream
+    reconnect nor a restart applies a command twice, and commands older
+    than `max_age` when first seen are skipped rather than replayed. The
+    command is written to the serial port with a sequence number that the
+    board echoes once the relay is switched; writes that are not
+    acknowledged in time are repeated, which is safe because setting a
+    state is idempotent. The outcome and latency of every command are
+    written back to the valve_command_ack node.
+
+    A board forgets a forced "on" or "off" when it resets, which opening its
+    port does, while the stored id keeps the command from being taken again.
+    The forced mode of every board is therefore stored with the id, and
+    `restore` writes it again once the port is reopened, repeating the write
+    for up to `restore_timeout` seconds while the board boots.
+
+    Attributes:
+        db: The RealtimeDB the acknowledgements are written to.
+        write: Callable taking a device id and the bytes to write to its port.
+        devices: The device ids a command without a device goes to.
+        state_path: The file the id of the last command taken is kept in.
+        ack_timeout: Seconds to wait for the board before writing again.
+        retries: The number of writes before a command is given up.
+        max_age: Seconds after which a command that was never seen is stale.
+        restore_timeout: Seconds a forced mode is written again for after a reset.
+        last_id: The id of the last command taken.
+        modes: Maps device ids ("" for a single board) to the id and state of
+            the command forcing their valve on or off.
+        stats: Counters for commands by result.
+
+    Methods:
+        handle: Takes a command from the stream and writes it to the boards.
+        restore: Writes the forced mode of a board again after its port was reopened.
+        acknowledge: Matches an acknowledgement from a board to its command.
+        start: Starts the thread that repeats writes and uploads acknowledgements.
+        stop: Stops the thread.
+    """
+
+    def __init__(
+        self,
+        db,
+        write,
+        devices: list = None,
+        state_path: str = os.path.join("~", ".agribot", "valve_command.json"),
+        ack_timeout: float = 1.0,
+        retries: int = 3,
+        max_age: float = 300.0,
+        restore_timeout: float = 10.0,
+    ) -> None:
+        self.db = db
+        self.write = write
+        self.devices = devices if devices else [None]
+        self.state_path = os.path.expanduser(state_path)
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.max_age = max_age
+        self.restore_timeout = restore_timeout
+        self.stats = collections.Counter()
+        self.last_id, self.modes = self._load()
+        self._sequence = 0
+        self._pending = {}  # (device, sequence) -> command state
+        self._uploads = collections.deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def handle(self, command) -> bool:
+        """
+        Takes a command from the stream and writes it to its boards.
+
+        Args:
+            command (dict): The value of the valve_command node.
+
+        Returns:
+            bool: True if the command was forwarded.
+        """
+        received = time.monotonic()
+        received_at = time.time()
+        if not isinstance(command, dict) or "id" not in command:
+            return False  # Deleted, or not written by the dashboard
+        command_id = str(command["id"])
+        if command_id == self.last_id:
+            self._count("duplicate")
+            return False
+        self.last_id = command_id
+        state = str(command.get("state", "")).lower()
+        if state not in VALVE_STATES:
+            self._save()
+            self._count("invalid")
+            logger.warning("Ignoring valve command with state %r.", state)
+            return False
+        issued_at = command.get("issued_at")
+        if isinstance(issued_at, (int, float)):
+            issued_at /= 1000  # Firebase server timestamps are in milliseconds
+            if received_at - issued_at > self.max_age:
+                self._save()
+                self._count("stale")
+                return False
+            # Only meaningful when the gateway clock is synchronized
+            _metrics.observe(
+                "agribot_valve_command_seconds",
+                max(0.0, received_at - issued_at),
+                stage="delivery",
+            )
+        else:
+            issued_at = None
+        device = command.get("device")
+        devices = [device] if device is not None else self.devices
+        with self._condition:
+            for device in devices:
+                if state == "auto":
+                    self.modes.pop(_mode_key(device), None)
+                else:
+                    self.modes[_mode_key(device)] = {"id": command_id, "state": state}
+            self._save()
+            for device in devices:
+                self._queue(command_id, state, device, issued_at, received)
+            self._condition.notify()
+        return True
+
+    def restore(self, device=None) -> bool:
+        """
+        Writes the forced mode of a board again after its port was reopened.
+
+        Args:
+            device (str): The device id of the board, None for a single board.
+
+        Returns:
+            bool: True if the board had a forced mode to write.
+        """
+        with self._condition:
+            mode = self.modes.get(_mode_key(device))
+            if mode is None:
+                return False  # The board is back in auto, as it should be
+            retries = max(
+                self.retries, math.ceil(self.restore_timeout / self.ack_timeout)
+            )
+            self._queue(
+                mode["id"], mode["state"], device, None, time.monotonic(), retries
+            )
+            self._condition.notify()
+        logger.info("Restoring valve mode %s.", mode["state"], extra={"device": device})
+        return True
+
+    def acknowledge(self, device, fields: list) -> bool:
+        """
+        Matches an acknowledgement from a board to its command.
+
+        Args:
+            device (str): The device id of the board, None for a single board.
+            fields (list): The fields after "ACK" of a "<ACK,V,sequence,mode,pump>" frame.
+
+        Returns:
+            bool: True if the acknowledgement completed a pending command.
+        """
+        now = time.monotonic()
+        if len(fields) < 4 or fields[0] != "V":
+            return False
+        try:
+            sequence = int(fields[1])
+        except ValueError:
+            return False
+        with self._condition:
+            pending = self._pending.pop((device, sequence), None)
+            if pending is None:
+                return False  # A repeated write was acknowledged twice
+            _metrics.observe(
+                "agribot_valve_command_seconds", now - pending["sent"], stage="serial"
+            )
+            _metrics.observe(
+                "agribot_valve_command_seconds",
+                now - pending["received"],
+                stage="actuation",
+            )
+            if pending["issued_at"] is not None:
+                _metrics.observe(
+                    "agribot_valve_command_seconds",
+                    max(0.0, time.time() - pending["issued_at"]),
+                    stage="total",
+                )
+            if pending["restore"]:
+                self._count("restored")
+                return True
+            self._count("applied")
+            self._uploads.append(
+                (
+                    device,
+                    {
+                        "id": pending["id"],
+                        "state": pending["state"],
+                        "status": "applied",
+                        "pump": "on" if fields[3].strip() == "ON" else "off",
+                        "latency_ms": round((now - pending["received"]) * 1000, 1),
+                        "acked_at": {".sv": "timestamp"},
+                    },
+                )
+            )
+            self._condition.notify()
+        return True
+
+    def start(self) -> None:
+        """
+        Starts the thread that repeats unacknowledged writes and uploads acknowledgements.
+
+        Returns:
+            None
+        """
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="agribot-valve", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the thread after uploading the acknowledgements still queued.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(10.0)
+
+    def _queue(
+        self, command_id, state, device, issued_at, received, retries=None
+    ) -> None:
+        # Must be called with self._condition held
+        self._sequence = self._sequence % 0xFFFF + 1
+        pending = {
+            "id": command_id,
+            "state": state,
+            "device": device,
+            "sequence": self._sequence,
+            "issued_at": issued_at,
+            "received": received,
+            "sent": None,
+            "attempts": 0,
+            "retries": self.retries if retries is None else retries,
+            "restore": retries is not None,
+        }
+        self._pending[(device, self._sequence)] = pending
+        self._send(pending)
+
+    def _send(self, pending: dict) -> None:
+        pending["attempts"] += 1
+        pending["sent"] = time.monotonic()
+        try:
+            self.write(
+                pending["device"],
+                encode_valve_command(
+                    pending["sequence"], VALVE_STATES[pending["state"]]
+                ),
+            )
+        except Exception as e:
+            # The port may be reconnecting; the write is repeated on timeout
+            logger.warning("Could not write the valve command: %s", e)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and not self._uploads:
+                    deadline = min(
+                        (p["sent"] + self.ack_timeout for p in self._pending.values()),
+                        default=None,
+                    )
+                    if deadline is not None and deadline <= time.monotonic():
+                        break
+                    self._condition.wait(
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                now = time.monotonic()
+                for key, pending in list(self._pending.items()):
+                    if now - pending["sent"] < self.ack_timeout:
+                        continue
+                    if pending["attempts"] < pending["retries"]:
+                        self._send(pending)
+                        continue
+                    del self._pending[key]
+                    self._count("timeout")
+                    logger.warning(
+                        "The board did not acknowledge valve command %s.",
+                        pending["id"],
+                        extra={"device": pending["device"]},
+                    )
+                    self._uploads.append(
+                        (
+                            pending["device"],
+                            {
+                                "id": pending["id"],
+                                "state": pending["state"],
+                                "status": "timeout",
+                                "acked_at": {".sv": "timestamp"},
+                            },
+                        )
+                    )
+                uploads = list(self._uploads)
+                self._uploads.clear()
+                stopped = self._stopped
+            for device, ack in uploads:
+                try:
+                    self.db.ack_valve_command_for_user(ack, device)
+                except Exception as e:
+                    logger.warning("Could not write the valve acknowledgement: %s", e)
+            if stopped:
+                return
+
+    def _count(self, result: str) -> None:
+        self.stats[result] += 1
+        _metrics.inc("agribot_valve_commands_total", result=result)
+
+    def _load(self) -> tuple:
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return None, {}
+        # Files written before modes were kept have only the id
+        return state.get("last_id"), state.get("modes", {})
+
+    def _save(self) -> None:
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump({"last_id": self.last_id, "modes": self.modes}, state_file)
+        os.replace(tmp_path, self.state_path)